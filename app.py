@@ -2,6 +2,10 @@ import dash
 import dash_auth
 import dash_bootstrap_components as dbc
 
+import data.mongo_setup as mongo_setup
+import services.index_management as index_management
+import set_up_globals
+
 # Keep this out of source code repository - save in a file or a database
 VALID_USERNAME_PASSWORD_PAIRS = {
     'prm88': 'xxx',
@@ -22,3 +26,8 @@ auth = dash_auth.BasicAuth(
     VALID_USERNAME_PASSWORD_PAIRS
 )
 server = app.server
+
+# Register connection to MongoDB (once, for every page)
+mongo_setup.global_init(database_name=set_up_globals.database_name)
+if set_up_globals.ensure_indexes_on_startup:
+    index_management.ensure_indexes()
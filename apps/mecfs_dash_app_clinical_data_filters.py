@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
@@ -7,19 +5,15 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.express as px
-import plotly.graph_objects as go
 import numpy as np
-import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
-from data.assay_classes import Proteomic
 from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
@@ -36,30 +30,10 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Data is read from the shared data cache (built on first use) when the page is displayed
 documentName = set_up_globals.clinical_document_name
-# data_list = svc.find_demographic_data_only()
-# for c in data_list:
-#     for field in c:
-#         print(field, c[field])
-#     print('\n')
-
-# data_list = svc.find_clinical_data()
-data_list = svc.find_proteomic_data_only()
-if data_list is None:
-    print(f'No {documentName} data records.')
-    sys.exit(2)
-
-df,_ = utilities.create_df_from_object_list(data_list, [Proteomic], ['proteomic'])
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+dataCacheName = 'demographic'
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -72,7 +46,6 @@ comparison3DropdownComponentID = 'compare-dropdown-3' + uniqueComponentForApp
 rangeSliderComponentID = 'range-slider-1' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity-scatter' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 clinicalGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual',
                      'qmep_sudevent', 'qmep_metimediagnosis', 'vo2change', 'atchange']
@@ -87,73 +60,77 @@ mark_values = {0:'0',5:'5',10:'10',15:'15',
                100:'100',105:'105',110:'110',115:'115'}
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        html.Div(dcc.Dropdown(
-            id=groupDropdownComponentID, value='phenotype', clearable=False,
-            options=[{'label': x, 'value': x} for x in clinicalGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison1DropdownComponentID, value='weight_lbs', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in clinicalNumericList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison2DropdownComponentID, value='bmi', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in clinicalNumericList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison3DropdownComponentID, value='none', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-    ], className='row'),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
-                min=0,
-                max=115,
-                value=[10,70],
-                marks=mark_values,
-                allowCross=False,
-                pushable=5,
-                tooltip={'always visible':False, 'placement':'bottom'},
-                step=1), width=12), justify="start"),
-    ], style={"width": "70%", "position":"absolute", "left":"5%"}),
-    html.Br(),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df, server_side=True)
+
+    return html.Div([
+
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            html.Div(dcc.Dropdown(
+                id=groupDropdownComponentID, value='phenotype', clearable=False,
+                options=[{'label': x, 'value': x} for x in clinicalGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison1DropdownComponentID, value='weight_lbs', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in clinicalNumericList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison2DropdownComponentID, value='bmi', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in clinicalNumericList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison3DropdownComponentID, value='none', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+        ], className='row'),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
+                    min=0,
+                    max=115,
+                    value=[10,70],
+                    marks=mark_values,
+                    allowCross=False,
+                    pushable=5,
+                    tooltip={'always visible':False, 'placement':'bottom'},
+                    step=1), width=12), justify="start"),
+        ], style={"width": "70%", "position":"absolute", "left":"5%"}),
+        html.Br(),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -181,9 +158,13 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
     colorSequence = utilities.set_color_sequence(group_chosen)
 
     # Filter based on range slider
-    df['numeric_age'] = pd.to_numeric(df['age'], errors='coerce')
+    df, _ = data_cache.get(dataCacheName)
     dff = df[(df['numeric_age']>=range_1[0])&(df['numeric_age']<=range_1[1])]
 
+    # Plot a sample of very large data sets that keeps the density of the points
+    plotColumns = [c for c in [compare_1_chosen, compare_2_chosen, compare_3_chosen] if c.lower() != 'none']
+    dff = utilities.grid_downsample(dff, plotColumns, set_up_globals.scatter_max_points)
+
     # Add age to title
     title = documentName.capitalize() + ' Data Scatter Plot for Ages ' + str(range_1[0]) + ' to ' + str(range_1[1])
 
@@ -201,6 +182,7 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
             # size='age',  # size of bubble
             # size_max=15,  # set the maximum mark size when using size
             hover_name='study_id',  # values appear in bold in the hover tooltip
+            render_mode=utilities.scatter_render_mode(dff),  # 'svg' or 'webgl'
             height=600)
     else:
         # Use for animation rotation at the end
@@ -242,11 +224,7 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
                                      ]
                         )
 
-        frames = []
-        for t in np.arange(0, 6.26, 0.1):
-            xe, ye, ze = rotate_z(x_eye, y_eye, z_eye, -t)
-            frames.append(go.Frame(layout=dict(scene_camera_eye=dict(x=xe, y=ye, z=ze))))
-        fig.frames = frames
+        fig.frames = utilities.rotation_frames(x_eye, y_eye, z_eye)
 
     return [
         dcc.Graph(id='scatter_plot' + uniqueComponentForApp, figure=fig)
@@ -317,6 +295,11 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
 #     ]
 
 
+# -------------------------------------------------------------------------------------
+# Page, filter and sort the data table on the server
+utilities.register_server_side_table(app, dataTableComponentID, lambda: data_cache.get(dataCacheName)[0])
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
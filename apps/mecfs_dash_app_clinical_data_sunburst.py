@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
@@ -12,14 +10,13 @@ import numpy as np
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
+from services.figure_cache import figure_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
-from data.proteomics import Proteomic
 from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
@@ -36,24 +33,10 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Data is read from the shared data cache (built on first use) when the page is displayed
 documentName = set_up_globals.clinical_document_name
-# data_list = svc.find_clinical_data()
-data_list = svc.find_proteomic_data_only()
-if data_list is None:
-    print(f'No {documentName} data records.')
-    sys.exit(2)
-
-df,_ = utilities.create_df_from_object_list(data_list, [Proteomic], ['proteomic'])
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+dataCacheName = 'demographic'
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -65,7 +48,6 @@ comparison2DropdownComponentID = 'compare-dropdown-2' + uniqueComponentForApp
 comparison3DropdownComponentID = 'compare-dropdown-3' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity-scatter' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 clinicalGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual',
                      'qmep_sudevent', 'qmep_metimediagnosis', 'vo2change', 'atchange']
@@ -73,59 +55,63 @@ clinicalNumericList = ['age', 'height_in', 'weight_lbs', 'bmi', 'mecfs_duration'
                        'vo2peak1', 'vo2peak2', 'at1', 'at2']
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df, server_side=True)
+
+    return html.Div([
 
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        html.Div(dcc.Dropdown(
-            id=groupDropdownComponentID, value='phenotype', clearable=False,
-            options=[{'label': x, 'value': x} for x in clinicalGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            html.Div(dcc.Dropdown(
+                id=groupDropdownComponentID, value='phenotype', clearable=False,
+                options=[{'label': x, 'value': x} for x in clinicalGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
 
-        html.Div(dcc.Dropdown(
-            id=comparison1DropdownComponentID, value='sex', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in clinicalGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
+            html.Div(dcc.Dropdown(
+                id=comparison1DropdownComponentID, value='sex', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in clinicalGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
 
-        html.Div(dcc.Dropdown(
-            id=comparison2DropdownComponentID, value='site', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
+            html.Div(dcc.Dropdown(
+                id=comparison2DropdownComponentID, value='site', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
 
-        html.Div(dcc.Dropdown(
-            id=comparison3DropdownComponentID, value='race', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-    ], className='row'),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+            html.Div(dcc.Dropdown(
+                id=comparison3DropdownComponentID, value='race', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+        ], className='row'),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -148,6 +134,17 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
     print(compare_2_chosen)
     print(compare_3_chosen)
 
+    # Reuse the figure if it has already been built for these inputs
+    figureKey = figure_cache.key(uniqueComponentForApp,
+                                 [group_chosen, compare_1_chosen, compare_2_chosen, compare_3_chosen])
+    fig = figure_cache.get(figureKey)
+    if fig is not None:
+        return [
+            dcc.Graph(id='sunburst_plot' + uniqueComponentForApp, figure=fig)
+        ]
+
+    df, _ = data_cache.get(dataCacheName)
+
     rootBranchesLeaves = [group_chosen, compare_1_chosen]
     if compare_2_chosen.lower() != 'none':
         rootBranchesLeaves.append(compare_2_chosen)
@@ -178,6 +175,7 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
 
     fig.update_traces(textinfo='label+percent entry')
     fig.update_layout(margin=dict(t=0, l=0, r=0, b=0))
+    fig = figure_cache.put(figureKey, fig)
 
     return [
         dcc.Graph(id='sunburst_plot' + uniqueComponentForApp, figure=fig)
@@ -248,6 +246,11 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
 #     ]
 
 
+# -------------------------------------------------------------------------------------
+# Page, filter and sort the data table on the server
+utilities.register_server_side_table(app, dataTableComponentID, lambda: data_cache.get(dataCacheName)[0])
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
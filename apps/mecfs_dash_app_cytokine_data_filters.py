@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
@@ -7,20 +5,18 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.express as px
-import plotly.graph_objects as go
 import numpy as np
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
+from services.figure_cache import figure_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.assay_classes import Proteomic
-from data.assay_classes import Cytokine
 from data.assay_classes import Metabolomic
 from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
@@ -38,24 +34,10 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Data is read from the shared data cache (built on first use) when the page is displayed
 documentName = set_up_globals.cytokines_document_name
-# data_list = svc.find_cytokine_data()
-data_list = svc.find_cytokine_data_only()
-if data_list is None:
-    print(f'No {documentName} data records.')
-    sys.exit(2)
-
-df, dataGeneSymbolList = utilities.create_df_from_object_list(data_list, [Cytokine], ['cytokine'], assayResultsFlag=True)
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+dataCacheName = 'cytokine'
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -65,66 +47,75 @@ groupDropdownComponentID = 'group-dropdown' + uniqueComponentForApp
 comparison1DropdownComponentID = 'compare-dropdown-1' + uniqueComponentForApp
 comparison2DropdownComponentID = 'compare-dropdown-2' + uniqueComponentForApp
 comparison3DropdownComponentID = 'compare-dropdown-3' + uniqueComponentForApp
+columnPickerComponentID = 'column-picker' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity-scatter' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 dataGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual', 'timepoint', 'biospecimen_type']
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        html.Div(dcc.Dropdown(
-            id=groupDropdownComponentID, value='phenotype', clearable=False,
-            options=[{'label': x, 'value': x} for x in dataGroupList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison1DropdownComponentID, value=dataGeneSymbolList[0], clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in dataGeneSymbolList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison2DropdownComponentID, value=dataGeneSymbolList[1], clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in dataGeneSymbolList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-
-        html.Div(dcc.Dropdown(
-            id=comparison3DropdownComponentID, value='none', clearable=False,
-            persistence=True, persistence_type='memory',
-            options=[{'label': x, 'value': x} for x in ['none'] + dataGeneSymbolList],
-            multi=False,
-            searchable=True,
-            placeholder='Select one',
-            style={"width": "90%"}
-        ), className='two columns', style={"width": "15rem"}),
-    ], className='row'),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+def layout():
+    df, dataGeneSymbolList = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df, server_side=True,
+                                              columns=utilities.metadata_columns(df, dataGeneSymbolList))
+
+    return html.Div([
+
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            html.Div(dcc.Dropdown(
+                id=groupDropdownComponentID, value='phenotype', clearable=False,
+                options=[{'label': x, 'value': x} for x in dataGroupList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison1DropdownComponentID, value=dataGeneSymbolList[0], clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in dataGeneSymbolList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison2DropdownComponentID, value=dataGeneSymbolList[1], clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in dataGeneSymbolList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+
+            html.Div(dcc.Dropdown(
+                id=comparison3DropdownComponentID, value='none', clearable=False,
+                persistence=True, persistence_type='memory',
+                options=[{'label': x, 'value': x} for x in ['none'] + dataGeneSymbolList],
+                multi=False,
+                searchable=True,
+                placeholder='Select one',
+                style={"width": "90%"}
+            ), className='two columns', style={"width": "15rem"}),
+        ], className='row'),
+        html.Br(),
+        html.Div([
+            html.Label(['Analyte Columns:',
+                        html.Div(utilities.column_picker(columnPickerComponentID, dataGeneSymbolList))]),
+        ]),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -142,13 +133,28 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
     print(compare_2_chosen)
     print(compare_3_chosen)
 
+    # Reuse the figure if it has already been built for these inputs
+    figureKey = figure_cache.key(uniqueComponentForApp,
+                                 [group_chosen, compare_1_chosen, compare_2_chosen, compare_3_chosen])
+    fig = figure_cache.get(figureKey)
+    if fig is not None:
+        return [
+            dcc.Graph(id='scatter_plot' + uniqueComponentForApp, figure=fig)
+        ]
+
+    df, _ = data_cache.get(dataCacheName)
+
+    # Plot a sample of very large data sets that keeps the density of the points
+    plotColumns = [c for c in [compare_1_chosen, compare_2_chosen, compare_3_chosen] if c.lower() != 'none']
+    dff = utilities.grid_downsample(df, plotColumns, set_up_globals.scatter_max_points)
+
     colorSequence = utilities.set_color_sequence(group_chosen)
 
     # If the third compare choice is 'none' then produce a
     # 2D scatter plot, otherwise produce a 3D scatter plot
     if compare_3_chosen.lower() == 'none':
         fig = px.scatter(
-            data_frame=df,
+            data_frame=dff,
             x=compare_1_chosen,
             y=compare_2_chosen,
             color=group_chosen,
@@ -158,6 +164,7 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
             # size='size',  # size of bubble
             # size_max=30,  # set the maximum mark size when using size
             hover_name='study_id',  # values appear in bold in the hover tooltip
+            render_mode=utilities.scatter_render_mode(dff),  # 'svg' or 'webgl'
             height=600)
     else:
         # Use for animation rotation at the end
@@ -166,7 +173,7 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
         z_eye = 0.5
 
         fig = px.scatter_3d(
-            data_frame=df,
+            data_frame=dff,
             x=compare_1_chosen,
             y=compare_2_chosen,
             z=compare_3_chosen,
@@ -199,17 +206,21 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
                                      ]
                         )
 
-        frames = []
-        for t in np.arange(0, 6.26, 0.1):
-            xe, ye, ze = rotate_z(x_eye, y_eye, z_eye, -t)
-            frames.append(go.Frame(layout=dict(scene_camera_eye=dict(x=xe, y=ye, z=ze))))
-        fig.frames = frames
+        fig.frames = utilities.rotation_frames(x_eye, y_eye, z_eye)
+    fig = figure_cache.put(figureKey, fig)
 
     return [
         dcc.Graph(id='scatter_plot' + uniqueComponentForApp, figure=fig)
     ]
 
 
+# -------------------------------------------------------------------------------------
+# Page, filter and sort the data table on the server
+utilities.register_server_side_table(app, dataTableComponentID, lambda: data_cache.get(dataCacheName)[0])
+utilities.register_column_picker(app, columnPickerComponentID, dataTableComponentID,
+                                 lambda: data_cache.get(dataCacheName))
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
@@ -1,27 +1,23 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
-import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
-import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+import services.distribution_summary as distribution_summary
+from services.data_cache import data_cache
+from services.figure_cache import figure_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.assay_classes import Proteomic
 from data.assay_classes import Cytokine
-from data.assay_classes import Metabolomic
 from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
@@ -39,25 +35,10 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Data is read from the shared data cache (built on first use) when the page is displayed
 documentName = set_up_globals.metabolomics_document_name
-
-data_list = svc.find_metabolomic_data_only()
-if data_list is None:
-    print(f'No {documentName} data records.')
-    sys.exit(2)
-
-df, dataLabelList = utilities.create_df_from_object_list(data_list, [Metabolomic], ['metabolomic'],
-                                                         assayResultsFlag=True)
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+dataCacheName = 'metabolomic'
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -69,9 +50,9 @@ comparison2DropdownComponentID = 'compare-dropdown-2' + uniqueComponentForApp
 comparison3DropdownComponentID = 'compare-dropdown-3' + uniqueComponentForApp
 radioItemsComponentID = 'radioitems-1' + uniqueComponentForApp
 rangeSliderComponentID = 'range-slider-1' + uniqueComponentForApp
+columnPickerComponentID = 'column-picker' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity-violin' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 clinicalGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual',
                      'qmep_sudevent', 'qmep_metimediagnosis', 'vo2change', 'atchange']
@@ -87,96 +68,105 @@ mark_values = {0: '0', 5: '5', 10: '10', 15: '15',
                100: '100', 105: '105', 110: '110', 115: '115'}
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        html.Label(['Group By:',
-                    html.Div(dcc.Dropdown(
-                        id=groupDropdownComponentID, value='phenotype', clearable=False,
-                        options=[{'label': x, 'value': x} for x in clinicalGroupList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        html.Label(['X-Axis:',
-                    html.Div(dcc.Dropdown(
-                        id=comparison1DropdownComponentID, value='timepoint', clearable=False,
-                        persistence=True, persistence_type='memory',
-                        options=[{'label': x, 'value': x} for x in xAxisList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        html.Label(['Y-Axis:',
-                    html.Div(dcc.Dropdown(
-                        id=comparison2DropdownComponentID, value=dataLabelList[0], clearable=False,
-                        persistence=True, persistence_type='memory',
-                        options=[{'label': x, 'value': x} for x in dataLabelList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        # html.Div(dcc.Dropdown(
-        #     id=comparison3DropdownComponentID, value='none', clearable=False,
-        #     persistence=True, persistence_type='memory',
-        #     options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
-        #     multi=False,
-        #     searchable=True,
-        #     placeholder='Select one',
-        #     style={"width": "90%"}
-        # ), className='two columns', style={"width": "15rem"}),
-    ], className='row'),
-    html.Br(),
-    html.Div([
-        html.P(children="Filter by Phenotype and Age",
-               style={"text-align": "left", "font-size": "100%"})
-    ]),
-
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RadioItems(id=radioItemsComponentID,
-                                       options=[
-                                           {'label': 'ME/CFS', 'value': 'ME/CFS'},
-                                           {'label': 'Healthy Control', 'value': 'HC'},
-                                           {'label': 'Both', 'value': 'BOTH'}
-                                       ],
-                                       value='BOTH',
-                                       labelStyle={'display': 'inline-block',
-                                                   'padding': '0.5rem 1rem',
-                                                   'border-radius': '0.5rem'}
-                                       ), width=12), justify="start"),
-    ], style={"width": "70%", "position": "absolute", "left": "5%"}),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
-                                        min=0,
-                                        max=115,
-                                        value=[10, 70],
-                                        marks=mark_values,
-                                        allowCross=False,
-                                        pushable=5,
-                                        tooltip={'always visible': False, 'placement': 'bottom'},
-                                        step=1), width=12), justify="start"),
-    ], style={"width": "70%", "position": "absolute", "left": "5%"}),
-    html.Br(),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+def layout():
+    df, dataLabelList = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df, server_side=True,
+                                              columns=utilities.metadata_columns(df, dataLabelList))
+
+    return html.Div([
+
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            html.Label(['Group By:',
+                        html.Div(dcc.Dropdown(
+                            id=groupDropdownComponentID, value='phenotype', clearable=False,
+                            options=[{'label': x, 'value': x} for x in clinicalGroupList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            html.Label(['X-Axis:',
+                        html.Div(dcc.Dropdown(
+                            id=comparison1DropdownComponentID, value='timepoint', clearable=False,
+                            persistence=True, persistence_type='memory',
+                            options=[{'label': x, 'value': x} for x in xAxisList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            html.Label(['Y-Axis:',
+                        html.Div(dcc.Dropdown(
+                            id=comparison2DropdownComponentID, value=dataLabelList[0], clearable=False,
+                            persistence=True, persistence_type='memory',
+                            options=[{'label': x, 'value': x} for x in dataLabelList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            # html.Div(dcc.Dropdown(
+            #     id=comparison3DropdownComponentID, value='none', clearable=False,
+            #     persistence=True, persistence_type='memory',
+            #     options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
+            #     multi=False,
+            #     searchable=True,
+            #     placeholder='Select one',
+            #     style={"width": "90%"}
+            # ), className='two columns', style={"width": "15rem"}),
+        ], className='row'),
+        html.Br(),
+        html.Div([
+            html.P(children="Filter by Phenotype and Age",
+                   style={"text-align": "left", "font-size": "100%"})
+        ]),
+
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RadioItems(id=radioItemsComponentID,
+                                           options=[
+                                               {'label': 'ME/CFS', 'value': 'ME/CFS'},
+                                               {'label': 'Healthy Control', 'value': 'HC'},
+                                               {'label': 'Both', 'value': 'BOTH'}
+                                           ],
+                                           value='BOTH',
+                                           labelStyle={'display': 'inline-block',
+                                                       'padding': '0.5rem 1rem',
+                                                       'border-radius': '0.5rem'}
+                                           ), width=12), justify="start"),
+        ], style={"width": "70%", "position": "absolute", "left": "5%"}),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
+                                            min=0,
+                                            max=115,
+                                            value=[10, 70],
+                                            marks=mark_values,
+                                            allowCross=False,
+                                            pushable=5,
+                                            tooltip={'always visible': False, 'placement': 'bottom'},
+                                            step=1), width=12), justify="start"),
+        ], style={"width": "70%", "position": "absolute", "left": "5%"}),
+        html.Br(),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            html.Label(['Analyte Columns:',
+                        html.Div(utilities.column_picker(columnPickerComponentID, dataLabelList))]),
+        ]),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -201,10 +191,19 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, radioitems_1
     print(radioitems_1)
     print(range_1)
 
+    # Reuse the figure if it has already been built for these inputs
+    figureKey = figure_cache.key(uniqueComponentForApp,
+                                 [group_chosen, compare_1_chosen, compare_2_chosen, radioitems_1, range_1])
+    fig = figure_cache.get(figureKey)
+    if fig is not None:
+        return [
+            dcc.Graph(id='violin_plot' + uniqueComponentForApp, figure=fig)
+        ]
+
     colorSequence = utilities.set_color_sequence(group_chosen)
 
     # Filter based on range slider
-    df['numeric_age'] = pd.to_numeric(df['age'], errors='coerce')
+    df, _ = data_cache.get(dataCacheName)
     dff = df[(df['numeric_age'] >= range_1[0]) & (df['numeric_age'] <= range_1[1])]
 
     # Filter based on radio items
@@ -216,46 +215,23 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, radioitems_1
     # Add age to title
     title = documentName.capitalize() + ' Violin Plot for Ages ' + str(range_1[0]) + ' to ' + str(range_1[1])
 
-    fig = px.violin(
-        # data_frame=df.query("State == ['{}','{}']".format('ALABAMA','NEW YORK')),
-        data_frame=dff2,
+    # Quartiles, whiskers and density are computed on the server (see services/distribution_summary.py),
+    # and only a sample of the points is sent to the browser
+    fig = distribution_summary.violin_figure(
+        df=dff2,
         x=compare_1_chosen,
         y=compare_2_chosen,
+        color=group_chosen,  # differentiate violins by color
         category_orders={
             'timepoint': ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST']},
-        orientation="v",  # vertical 'v' or horizontal 'h'
-        points='all',  # 'outliers','suspectedoutliers', 'all', or False
-        box=True,  # draw box inside the violins
-        color=group_chosen,  # differentiate markers by color
-        violinmode="group",  # 'overlay' or 'group'
         color_discrete_sequence=colorSequence,
-        # color_discrete_map={"ALABAMA": "blue" ,"NEW YORK":"magenta"}, # map your chosen colors
-
-        hover_name='study_id',  # values appear in bold in the hover tooltip
-        hover_data=[group_chosen, 'timepoint'],  # values appear as extra data in the hover tooltip
-        # custom_data=['Program'],    # values are extra data to be used in Dash callbacks
-
-        # facet_row='State',          # assign marks to subplots in the vertical direction
-        # facet_col='Period',         # assign marks to subplots in the horizontal direction
-        # facet_col_wrap=2,           # maximum number of subplot columns. Do not set facet_row
-
-        # log_x=True,                 # x-axis is log-scaled
-        # log_y=True,                 # y-axis is log-scaled
-
-        # labels={"State": "STATE"},  # map the labels
+        points=True,  # draw a sample of the points next to each violin
+        hover_name='study_id',  # values appear in the hover tooltip of the points
         title=title,
-        # width=1050,  # figure width in pixels
-        height=600,  # igure height in pixels
-        template='ggplot2',  # 'ggplot2', 'seaborn', 'simple_white', 'plotly',
-        # 'plotly_white', 'plotly_dark', 'presentation',
-        # 'xgridoff', 'ygridoff', 'gridon', 'none'
-
-        # animation_frame='Year',     # assign marks to animation frames
-        # animation_group='',         # use only when df has multiple rows with same object
-        # range_x=[5,50],             # set range of x-axis
-        # range_y=[-5,100],           # set range of y-axis
-        # category_orders={'Year':[2015,2016,2017,2018,2019]},    # set a specific ordering of values per column
+        height=600,
+        template='ggplot2',
     )
+    fig = figure_cache.put(figureKey, fig)
 
     return [
         dcc.Graph(id='violin_plot' + uniqueComponentForApp, figure=fig)
@@ -326,6 +302,13 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, radioitems_1
 #     ]
 
 
+# -------------------------------------------------------------------------------------
+# Page, filter and sort the data table on the server
+utilities.register_server_side_table(app, dataTableComponentID, lambda: data_cache.get(dataCacheName)[0])
+utilities.register_column_picker(app, columnPickerComponentID, dataTableComponentID,
+                                 lambda: data_cache.get(dataCacheName))
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
@@ -12,15 +10,13 @@ import numpy as np
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
 import services.data_service as svc
+import services.distribution_summary as distribution_summary
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
-from data.assay_classes import Proteomic
-from data.assay_classes import Cytokine
 from data.assay_classes import Metabolomic
 from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
@@ -39,85 +35,22 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Pathway scores are calculated in the database (and cached) when a pathway is chosen
 # documentName = set_up_globals.proteomics_document_name
 
-pathwayList = ['Cytokine / proteomic test']
-pathway_name = pathwayList[0]
-dataLabelPathwayIDs = svc.find_pathway_data(pathway_name)
-for idx, c in enumerate(dataLabelPathwayIDs.data_label_references):
-    print(' {}. {}: {}'.format(idx + 1, c.data_label, c.gene_symbol_references[0].data_label))
-
-data_list = svc.test_pathway_mapping()
-if data_list is None:
-    print(f'No data records.')
-    sys.exit(2)
-
-df, dataLabelList = utilities.create_df_from_object_list(data_list,
-                                                         [Proteomic, Cytokine],
-                                                         ['proteomic', 'cytokine'],
-                                                         assayResultsFlag=True,
-                                                         dataLabelPathwayIDs=dataLabelPathwayIDs)
-
-print('dataLabelList:', dataLabelList)
-
-# Normalize
-proteomicIndex = df[df['assay_type'] == set_up_globals.proteomics_document_name].index
-cytokineIndex = df[df['assay_type'] == set_up_globals.cytokines_document_name].index
-print(df.loc[cytokineIndex].head(10))
-for col in dataLabelList:
-    proteomicSum = df.loc[proteomicIndex, col].sum()
-    if proteomicSum > 0:
-        df.loc[proteomicIndex, col] = df.loc[proteomicIndex, col] / proteomicSum
-    cytokineSum = df.loc[cytokineIndex, col].sum()
-    if cytokineSum > 0:
-        df.loc[cytokineIndex, col] = df.loc[cytokineIndex, col] / cytokineSum
-print(df.loc[cytokineIndex].head(10))
-
-df['aggregated_result'] = 0
-df['proteomic_aggregated_result'] = 0
-df['cytokine_aggregated_result'] = 0
-for idx, c in df.iterrows():
-    # print(' {}. {}: {}'.format(idx + 1, c.study_id,
-    #                            'ME/CFS patient' if c.phenotype == 'ME/CFS' else 'Healthy control'))
-    # print('      * Assay summary: {}, {}'.format(c.assay_type, c.timepoint))
-    arList = []
-    for ar in dataLabelList:
-        if not np.isnan(c[ar]):
-            arList.append(c[ar])
-        # print('            * Results: {}, {}'.format(ar, c[ar]))
-    # print(np.ma.average(arList))
-    df.loc[idx, 'aggregated_result'] = np.ma.average(arList)
-    if df.loc[idx, 'assay_type'] == set_up_globals.proteomics_document_name:
-        df.loc[idx, 'proteomic_aggregated_result'] = np.ma.average(arList)
-    if df.loc[idx, 'assay_type'] == set_up_globals.cytokines_document_name:
-        df.loc[idx, 'cytokine_aggregated_result'] = np.ma.average(arList)
-
-for idx, c in df.iterrows():
-    # print(' {}. {}: {} {}'.format(idx + 1, c.study_id, c.assay_type, c.timepoint))
-    if df.loc[idx, 'assay_type'] == set_up_globals.proteomics_document_name:
-        study_id = df.loc[idx, 'study_id']
-        timepoint = df.loc[idx, 'timepoint']
-        cytokine_aggregated_result = df.loc[
-            (df['study_id'] == study_id) & (df['assay_type'] == set_up_globals.cytokines_document_name) & (
-                        df['timepoint'] == timepoint), 'cytokine_aggregated_result'].mean()
-        df.loc[idx, 'cytokine_aggregated_result'] = cytokine_aggregated_result
-    if df.loc[idx, 'assay_type'] == set_up_globals.cytokines_document_name:
-        study_id = df.loc[idx, 'study_id']
-        timepoint = df.loc[idx, 'timepoint']
-        proteomic_aggregated_result = df.loc[
-            (df['study_id'] == study_id) & (df['assay_type'] == set_up_globals.proteomics_document_name) & (
-                        df['timepoint'] == timepoint), 'proteomic_aggregated_result'].mean()
-        df.loc[idx, 'proteomic_aggregated_result'] = proteomic_aggregated_result
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+defaultPathway = 'Cytokine / proteomic test'
+
+
+# Get the proteomic / cytokine scores for a pathway
+def get_pathway_data_frame(pathway_name):
+    df = svc.pathway_scores(pathway_name).copy()  # The cached data frame is shared, so copy before adding columns
+
+    # Creating an ID column name gives us more interactive capabilities
+    df['id'] = df['study_id']
+    df.set_index('id', inplace=True, drop=False)
+
+    return df
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -133,7 +66,6 @@ plotRadioItemsComponentID = 'plot-radioitems-1' + uniqueComponentForApp
 rangeSliderComponentID = 'range-slider-1' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 clinicalGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual',
                      'qmep_sudevent', 'qmep_metimediagnosis', 'vo2change', 'atchange']
@@ -150,125 +82,131 @@ mark_values = {0: '0', 5: '5', 10: '10', 15: '15',
                100: '100', 105: '105', 110: '110', 115: '115'}
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    html.Div([
-        html.P(children="Select type of plot",
-               style={"text-align": "left", "font-size": "100%"})
-    ]),
-
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RadioItems(id=plotRadioItemsComponentID,
-                                       options=[
-                                           {'label': 'Scatter plot', 'value': 'SCATTER'},
-                                           {'label': 'Violin plot', 'value': 'VIOLIN'}
-                                       ],
-                                       value='VIOLIN',
-                                       labelStyle={'display': 'inline-block',
-                                                   'padding': '0.5rem 1rem',
-                                                   'border-radius': '0.5rem'}
-                                       ), width=12), justify="start"),
-    ], style={"width": "70%", "position": "absolute", "left": "5%"}),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        html.Label(['Pathway:',
-                    html.Div(dcc.Dropdown(
-                        id=pathwayDropdownComponentID, value=pathwayList[0], clearable=False,
-                        options=[{'label': x, 'value': x} for x in pathwayList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        html.Label(['Group By:',
-                    html.Div(dcc.Dropdown(
-                        id=groupDropdownComponentID, value='phenotype', clearable=False,
-                        options=[{'label': x, 'value': x} for x in clinicalGroupList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        html.Label(['X-Axis:',
-                    html.Div(dcc.Dropdown(
-                        id=comparison1DropdownComponentID, value='assay_type', clearable=False,
-                        persistence=True, persistence_type='memory',
-                        options=[{'label': x, 'value': x} for x in xAxisList],
-                        multi=False,
-                        searchable=True,
-                        placeholder='Select one',
-                        style={"width": "90%"}
-                    ), className='two columns', style={"width": "15rem"})]),
-
-        # html.Label(['Y-Axis:',
-        #             html.Div(dcc.Dropdown(
-        #                 id=comparison2DropdownComponentID, value=dataLabelList[0], clearable=False,
-        #                 persistence=True, persistence_type='memory',
-        #                 options=[{'label': x, 'value': x} for x in dataLabelList],
-        #                 multi=False,
-        #                 searchable=True,
-        #                 placeholder='Select one',
-        #                 style={"width": "90%"}
-        #             ), className='two columns', style={"width": "15rem"})]),
-
-        # html.Div(dcc.Dropdown(
-        #     id=comparison3DropdownComponentID, value='none', clearable=False,
-        #     persistence=True, persistence_type='memory',
-        #     options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
-        #     multi=False,
-        #     searchable=True,
-        #     placeholder='Select one',
-        #     style={"width": "90%"}
-        # ), className='two columns', style={"width": "15rem"}),
-    ], className='row'),
-    html.Br(),
-    html.Div([
-        html.P(children="Filter by Phenotype and Age",
-               style={"text-align": "left", "font-size": "100%"})
-    ]),
-
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RadioItems(id=filterRadioItemsComponentID,
-                                       options=[
-                                           {'label': 'ME/CFS', 'value': 'ME/CFS'},
-                                           {'label': 'Healthy Control', 'value': 'HC'},
-                                           {'label': 'Both', 'value': 'BOTH'}
-                                       ],
-                                       value='BOTH',
-                                       labelStyle={'display': 'inline-block',
-                                                   'padding': '0.5rem 1rem',
-                                                   'border-radius': '0.5rem'}
-                                       ), width=12), justify="start"),
-    ], style={"width": "70%", "position": "absolute", "left": "5%"}),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
-                                        min=0,
-                                        max=115,
-                                        value=[10, 70],
-                                        marks=mark_values,
-                                        allowCross=False,
-                                        pushable=5,
-                                        tooltip={'always visible': False, 'placement': 'bottom'},
-                                        step=1), width=12), justify="start"),
-    ], style={"width": "70%", "position": "absolute", "left": "5%"}),
-    html.Br(),
-    html.Br(),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+def layout():
+    pathwayList = svc.find_pathway_names()
+    pathway_name = defaultPathway if defaultPathway in pathwayList or len(pathwayList) < 1 else pathwayList[0]
+    df = get_pathway_data_frame(pathway_name)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df)
+
+    return html.Div([
+
+        html.Div([
+            html.P(children="Select type of plot",
+                   style={"text-align": "left", "font-size": "100%"})
+        ]),
+
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RadioItems(id=plotRadioItemsComponentID,
+                                           options=[
+                                               {'label': 'Scatter plot', 'value': 'SCATTER'},
+                                               {'label': 'Violin plot', 'value': 'VIOLIN'}
+                                           ],
+                                           value='VIOLIN',
+                                           labelStyle={'display': 'inline-block',
+                                                       'padding': '0.5rem 1rem',
+                                                       'border-radius': '0.5rem'}
+                                           ), width=12), justify="start"),
+        ], style={"width": "70%", "position": "absolute", "left": "5%"}),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            html.Label(['Pathway:',
+                        html.Div(dcc.Dropdown(
+                            id=pathwayDropdownComponentID, value=pathway_name, clearable=False,
+                            options=[{'label': x, 'value': x} for x in pathwayList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            html.Label(['Group By:',
+                        html.Div(dcc.Dropdown(
+                            id=groupDropdownComponentID, value='phenotype', clearable=False,
+                            options=[{'label': x, 'value': x} for x in clinicalGroupList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            html.Label(['X-Axis:',
+                        html.Div(dcc.Dropdown(
+                            id=comparison1DropdownComponentID, value='assay_type', clearable=False,
+                            persistence=True, persistence_type='memory',
+                            options=[{'label': x, 'value': x} for x in xAxisList],
+                            multi=False,
+                            searchable=True,
+                            placeholder='Select one',
+                            style={"width": "90%"}
+                        ), className='two columns', style={"width": "15rem"})]),
+
+            # html.Label(['Y-Axis:',
+            #             html.Div(dcc.Dropdown(
+            #                 id=comparison2DropdownComponentID, value=dataLabelList[0], clearable=False,
+            #                 persistence=True, persistence_type='memory',
+            #                 options=[{'label': x, 'value': x} for x in dataLabelList],
+            #                 multi=False,
+            #                 searchable=True,
+            #                 placeholder='Select one',
+            #                 style={"width": "90%"}
+            #             ), className='two columns', style={"width": "15rem"})]),
+
+            # html.Div(dcc.Dropdown(
+            #     id=comparison3DropdownComponentID, value='none', clearable=False,
+            #     persistence=True, persistence_type='memory',
+            #     options=[{'label': x, 'value': x} for x in ['none'] + clinicalNumericList],
+            #     multi=False,
+            #     searchable=True,
+            #     placeholder='Select one',
+            #     style={"width": "90%"}
+            # ), className='two columns', style={"width": "15rem"}),
+        ], className='row'),
+        html.Br(),
+        html.Div([
+            html.P(children="Filter by Phenotype and Age",
+                   style={"text-align": "left", "font-size": "100%"})
+        ]),
+
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RadioItems(id=filterRadioItemsComponentID,
+                                           options=[
+                                               {'label': 'ME/CFS', 'value': 'ME/CFS'},
+                                               {'label': 'Healthy Control', 'value': 'HC'},
+                                               {'label': 'Both', 'value': 'BOTH'}
+                                           ],
+                                           value='BOTH',
+                                           labelStyle={'display': 'inline-block',
+                                                       'padding': '0.5rem 1rem',
+                                                       'border-radius': '0.5rem'}
+                                           ), width=12), justify="start"),
+        ], style={"width": "70%", "position": "absolute", "left": "5%"}),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dcc.RangeSlider(id=rangeSliderComponentID,
+                                            min=0,
+                                            max=115,
+                                            value=[10, 70],
+                                            marks=mark_values,
+                                            allowCross=False,
+                                            pushable=5,
+                                            tooltip={'always visible': False, 'placement': 'bottom'},
+                                            step=1), width=12), justify="start"),
+        ], style={"width": "70%", "position": "absolute", "left": "5%"}),
+        html.Br(),
+        html.Br(),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -298,8 +236,9 @@ def display_value(pathway_chosen, group_chosen, compare_1_chosen, filter_radioit
     colorSequence = utilities.set_color_sequence(group_chosen)
 
     # Filter based on range slider
-    df['numeric_age'] = pd.to_numeric(df['age'], errors='coerce')
-    dff = df[(df['numeric_age'] >= range_1[0]) & (df['numeric_age'] <= range_1[1])]
+    df = get_pathway_data_frame(pathway_chosen)
+    numericAge = pd.to_numeric(df['age'], errors='coerce')
+    dff = df[(numericAge >= range_1[0]) & (numericAge <= range_1[1])]
 
     # Filter based on radio items
     if filter_radioitems_1 != 'BOTH':
@@ -325,45 +264,21 @@ def display_value(pathway_chosen, group_chosen, compare_1_chosen, filter_radioit
             hover_data=[group_chosen, 'timepoint'],  # values appear as extra data in the hover tooltip
             height=600)
     else:
-        fig = px.violin(
-            # data_frame=df.query("State == ['{}','{}']".format('ALABAMA','NEW YORK')),
-            data_frame=dff2,
+        # Quartiles, whiskers and density are computed on the server (see services/distribution_summary.py),
+        # and only a sample of the points is sent to the browser
+        fig = distribution_summary.violin_figure(
+            df=dff2,
             x=compare_1_chosen,
             y='aggregated_result',
+            color=group_chosen,  # differentiate violins by color
             category_orders={
                 'timepoint': ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST']},
-            orientation="v",  # vertical 'v' or horizontal 'h'
-            points='all',  # 'outliers','suspectedoutliers', 'all', or False
-            box=True,  # draw box inside the violins
-            color=group_chosen,  # differentiate markers by color
-            violinmode="group",  # 'overlay' or 'group'
             color_discrete_sequence=colorSequence,
-            # color_discrete_map={"ALABAMA": "blue" ,"NEW YORK":"magenta"}, # map your chosen colors
-
-            hover_name='study_id',  # values appear in bold in the hover tooltip
-            hover_data=[group_chosen, 'timepoint'],  # values appear as extra data in the hover tooltip
-            # custom_data=['Program'],    # values are extra data to be used in Dash callbacks
-
-            # facet_row='State',          # assign marks to subplots in the vertical direction
-            # facet_col='Period',         # assign marks to subplots in the horizontal direction
-            # facet_col_wrap=2,           # maximum number of subplot columns. Do not set facet_row
-
-            # log_x=True,                 # x-axis is log-scaled
-            # log_y=True,                 # y-axis is log-scaled
-
-            # labels={"State": "STATE"},  # map the labels
+            points=True,  # draw a sample of the points next to each violin
+            hover_name='study_id',  # values appear in the hover tooltip of the points
             title=title,
-            # width=1050,  # figure width in pixels
-            height=600,  # igure height in pixels
-            template='ggplot2',  # 'ggplot2', 'seaborn', 'simple_white', 'plotly',
-            # 'plotly_white', 'plotly_dark', 'presentation',
-            # 'xgridoff', 'ygridoff', 'gridon', 'none'
-
-            # animation_frame='Year',     # assign marks to animation frames
-            # animation_group='',         # use only when df has multiple rows with same object
-            # range_x=[5,50],             # set range of x-axis
-            # range_y=[-5,100],           # set range of y-axis
-            # category_orders={'Year':[2015,2016,2017,2018,2019]},    # set a specific ordering of values per column
+            height=600,
+            template='ggplot2',
         )
 
     return [
@@ -371,6 +286,16 @@ def display_value(pathway_chosen, group_chosen, compare_1_chosen, filter_radioit
     ]
 
 
+# -------------------------------------------------------------------------------------
+# Show the scores for the chosen pathway in the data table
+@app.callback(
+    Output(dataTableComponentID, 'data'),
+    [Input(pathwayDropdownComponentID, 'value')]
+)
+def update_table(pathway_chosen):
+    return get_pathway_data_frame(pathway_chosen).to_dict('records')
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output
 import dash_table
@@ -9,18 +7,15 @@ import dash_bootstrap_components as dbc
 import plotly.express as px
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.proteomics import Proteomic
-from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
 
@@ -38,43 +33,33 @@ MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
-scrnaseq_summary_data_list = svc.find_scrnaseq_summary_data_only()
-if scrnaseq_summary_data_list is None:
-    print(f'No scRNA-seq summary records.')
-    sys.exit(2)
-
-df,_ = utilities.create_df_from_object_list(scrnaseq_summary_data_list, [ScRNAseqSummary], ['scrnaseq_summary'])
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+# Data is read from the shared data cache (built on first use) when the page is displayed
+dataCacheName = 'scrnaseq_summary'
 
 # -------------------------------------------------------------------------------------
 # App layout
 graphComponentID = 'datatable-interactivity-container-3dscatter'
 dataTableComponentID = 'datatable-interactivity-3dscatter'
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary",))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df)
+
+    return html.Div([
 
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -111,7 +96,11 @@ def update_3d_scatter(all_rows_data, slctd_row_indices, slct_rows_names, slctd_r
     if slctd_row_indices is None:
         slctd_row_indices = []
 
-    dff = df if all_rows_data is None else pd.DataFrame(all_rows_data)
+    if all_rows_data is None:
+        df, _ = data_cache.get(dataCacheName)
+        dff = df.copy()  # The cached data frame is shared, so don't add columns to it
+    else:
+        dff = pd.DataFrame(all_rows_data)
     dff['size'] = dff['age'] / 4
 
     # data = []
@@ -173,11 +162,7 @@ def update_3d_scatter(all_rows_data, slctd_row_indices, slct_rows_names, slctd_r
                                  ]
                     )
 
-    frames = []
-    for t in np.arange(0, 6.26, 0.1):
-        xe, ye, ze = rotate_z(x_eye, y_eye, z_eye, -t)
-        frames.append(go.Frame(layout=dict(scene_camera_eye=dict(x=xe, y=ye, z=ze))))
-    fig.frames = frames
+    fig.frames = utilities.rotation_frames(x_eye, y_eye, z_eye)
 
     return [
         dcc.Graph(id='3d_scatter_plot', figure=fig)
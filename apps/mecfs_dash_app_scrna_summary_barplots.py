@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output
 import dash_table
@@ -10,15 +8,13 @@ import plotly.express as px
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.proteomics import Proteomic
-from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
 
@@ -31,15 +27,9 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
-scrnaseq_summary_data_list = svc.find_scrnaseq_summary_data_only()
-if scrnaseq_summary_data_list is None:
-    print(f'No scRNA-seq summary records.')
-    sys.exit(2)
+# Data is read from the shared data cache (built on first use) when the page is displayed
+dataCacheName = 'scrnaseq_summary'
 
 # property_names = [p for p in dir(ScRNAseqSummary) if isinstance(getattr(ScRNAseqSummary, p), property)]
 # attribute_names = [i for i in ScRNAseqSummary.__dict__.keys() if i[:1] != '_']
@@ -68,17 +58,11 @@ if scrnaseq_summary_data_list is None:
 #
 # df = pd.DataFrame(dataList, columns=attribute_names)
 
-df,_ = utilities.create_df_from_object_list(scrnaseq_summary_data_list, [ScRNAseqSummary], ['scrnaseq_summary'])
-print(df.head(5))
-
 # db = 'mecfs_db_test1'
 # collection = 'mecfs_collection'
 # df = mongo_utilities.read_mongo(db, collection, query={}, host='localhost', port=27017, username=None, password=None, no_id=True)
 # # df = df[df['year'] == 2019]
 
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -137,62 +121,65 @@ df.set_index('id', inplace=True, drop=False)
 graphComponentID = 'datatable-interactivity-container-bar'
 dataTableComponentID = 'datatable-interactivity-bar'
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary",))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    # dash_table.DataTable(
-    #     id='datatable-interactivity',
-    #     columns=[
-    #         {"name": i, "id": i, "deletable": True, "selectable": True, "hideable": True}
-    #         if i == "study_id" or i == "site" or i == "id" or i == "created_date" or i == "last_modified_date"
-    #         else {"name": i, "id": i, "deletable": True, "selectable": True}
-    #         for i in df.columns
-    #     ],
-    #     data=df.to_dict('records'),  # the contents of the table
-    #     editable=False,  # allow editing of data inside all cells
-    #     filter_action="native",  # allow filtering of data by user ('native') or not ('none')
-    #     sort_action="native",  # enables data to be sorted per-column by user or not ('none')
-    #     sort_mode="single",  # sort across 'multi' or 'single' columns
-    #     column_selectable="multi",  # allow users to select 'multi' or 'single' columns
-    #     row_selectable="multi",  # allow users to select 'multi' or 'single' rows
-    #     row_deletable=True,  # choose if user can delete a row (True) or not (False)
-    #     selected_columns=[],  # ids of columns that user selects
-    #     selected_rows=[],  # indices of rows that user selects
-    #     page_action="native",  # all data is passed to the table up-front or not ('none')
-    #     page_current=0,  # page number that user is on
-    #     page_size=9,  # number of rows visible per page
-    #     style_cell={  # ensure adequate header width when text is shorter than cell's text
-    #         'minWidth': 95, 'maxWidth': 95, 'width': 95
-    #     },
-    #     style_cell_conditional=[  # align text columns to left. By default they are aligned to right
-    #         {
-    #             'if': {'column_id': c},
-    #             'textAlign': 'left'
-    #         } for c in ['sex', 'phenotype']
-    #     ],
-    #     style_data={  # overflow cells' content into multiple lines
-    #         'whiteSpace': 'normal',
-    #         'height': 'auto'
-    #     }
-    # ),
-    # dbc.Row(dbc.Col(card_table, width=12), justify="start"),
-
-    html.Br(),
-    # html.Div(id='datatable-interactivity-container')
-    # html.Div(id='bar-container')
-    # html.Div(id='choromap-container')
-
-])
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df)
+
+    return html.Div([
+
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        # dash_table.DataTable(
+        #     id='datatable-interactivity',
+        #     columns=[
+        #         {"name": i, "id": i, "deletable": True, "selectable": True, "hideable": True}
+        #         if i == "study_id" or i == "site" or i == "id" or i == "created_date" or i == "last_modified_date"
+        #         else {"name": i, "id": i, "deletable": True, "selectable": True}
+        #         for i in df.columns
+        #     ],
+        #     data=df.to_dict('records'),  # the contents of the table
+        #     editable=False,  # allow editing of data inside all cells
+        #     filter_action="native",  # allow filtering of data by user ('native') or not ('none')
+        #     sort_action="native",  # enables data to be sorted per-column by user or not ('none')
+        #     sort_mode="single",  # sort across 'multi' or 'single' columns
+        #     column_selectable="multi",  # allow users to select 'multi' or 'single' columns
+        #     row_selectable="multi",  # allow users to select 'multi' or 'single' rows
+        #     row_deletable=True,  # choose if user can delete a row (True) or not (False)
+        #     selected_columns=[],  # ids of columns that user selects
+        #     selected_rows=[],  # indices of rows that user selects
+        #     page_action="native",  # all data is passed to the table up-front or not ('none')
+        #     page_current=0,  # page number that user is on
+        #     page_size=9,  # number of rows visible per page
+        #     style_cell={  # ensure adequate header width when text is shorter than cell's text
+        #         'minWidth': 95, 'maxWidth': 95, 'width': 95
+        #     },
+        #     style_cell_conditional=[  # align text columns to left. By default they are aligned to right
+        #         {
+        #             'if': {'column_id': c},
+        #             'textAlign': 'left'
+        #         } for c in ['sex', 'phenotype']
+        #     ],
+        #     style_data={  # overflow cells' content into multiple lines
+        #         'whiteSpace': 'normal',
+        #         'height': 'auto'
+        #     }
+        # ),
+        # dbc.Row(dbc.Col(card_table, width=12), justify="start"),
+
+        html.Br(),
+        # html.Div(id='datatable-interactivity-container')
+        # html.Div(id='bar-container')
+        # html.Div(id='choromap-container')
+
+    ])
 
 # -------------------------------------------------------------------------------------
 # Create bar charts
@@ -228,7 +215,10 @@ def update_bar(all_rows_data, slctd_row_indices, slct_rows_names, slctd_rows,
     if slctd_row_indices is None:
         slctd_row_indices = []
 
-    dff = df if all_rows_data is None else pd.DataFrame(all_rows_data)
+    if all_rows_data is None:
+        dff, _ = data_cache.get(dataCacheName)
+    else:
+        dff = pd.DataFrame(all_rows_data)
     # dff = pd.DataFrame(all_rows_data)
 
     colorSequence = utilities.set_color_sequence()
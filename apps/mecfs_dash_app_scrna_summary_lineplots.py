@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output
 import dash_table
@@ -10,15 +8,13 @@ import plotly.express as px
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
 
 from data.clinical_data import ClinicalData
 from data.redcap import Redcap
 from data.proteomics import Proteomic
-from data.scrnaseq_summary import ScRNAseqSummary
 from data.biospecimens import Biospecimen
 from data.users import User
 
@@ -29,43 +25,33 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
-scrnaseq_summary_data_list = svc.find_scrnaseq_summary_data_only()
-if scrnaseq_summary_data_list is None:
-    print(f'No scRNA-seq summary records.')
-    sys.exit(2)
-
-df,_ = utilities.create_df_from_object_list(scrnaseq_summary_data_list, [ScRNAseqSummary], ['scrnaseq_summary'])
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+# Data is read from the shared data cache (built on first use) when the page is displayed
+dataCacheName = 'scrnaseq_summary'
 
 # -------------------------------------------------------------------------------------
 # App layout
 graphComponentID = 'datatable-interactivity-container-line'
 dataTableComponentID = 'datatable-interactivity-line'
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary",))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df)
+
+    return html.Div([
 
-    html.Div([
-        dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
-        # justify="start", "center", "end", "between", "around"
-    ]),
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
-    ]),
-    html.Br(),
-])
+        html.Div([
+            dbc.Row(dbc.Col(card_graph, width=12), justify="start"),
+            # justify="start", "center", "end", "between", "around"
+        ]),
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent, width=12), justify="start"),
+        ]),
+        html.Br(),
+    ])
 
 
 # -------------------------------------------------------------------------------------
@@ -102,7 +88,10 @@ def update_line(all_rows_data, slctd_row_indices, slct_rows_names, slctd_rows,
     if slctd_row_indices is None:
         slctd_row_indices = []
 
-    dff_all = df if all_rows_data is None else pd.DataFrame(all_rows_data)
+    if all_rows_data is None:
+        dff_all, _ = data_cache.get(dataCacheName)
+    else:
+        dff_all = pd.DataFrame(all_rows_data)
     data = []
     for index, row in dff_all.iterrows():
         for col in slctd_columns:
@@ -1,5 +1,3 @@
-import sys
-
 import dash  # (version 1.12.0)
 from dash.dependencies import Input, Output, State
 import dash_table
@@ -13,10 +11,9 @@ import numpy as np
 import pandas as pd
 from app import app
 
-import data.mongo_setup as mongo_setup
 from infrastructure.switchlang import switch
 import infrastructure.state as state
-import services.data_service as svc
+from services.data_cache import data_cache
 
 from data.clinical_data import ClinicalData
 from data.clinical_data import ClinicalDataVersionHistory
@@ -100,24 +97,10 @@ import set_up_globals
 MECFSVersion = set_up_globals.MECFSVersion
 data_folder = set_up_globals.data_folder
 
-# Register connection to MongoDB
-mongo_setup.global_init(database_name=set_up_globals.database_name)
-
 # -------------------------------------------------------------------------------------
-# Import data into pandas
+# Data is read from the shared data cache (built on first use) when the page is displayed
 documentName = set_up_globals.clinical_document_name
-# data_list = svc.find_clinical_data()
-data_list = svc.find_proteomic_data_only()
-if data_list is None:
-    print(f'No {documentName} data records.')
-    sys.exit(2)
-
-df, _ = utilities.create_df_from_object_list(data_list, [Proteomic], ['proteomic'])
-print(df.head(5))
-
-# Creating an ID column name gives us more interactive capabilities
-df['id'] = df['study_id']
-df.set_index('id', inplace=True, drop=False)
+dataCacheName = 'demographic'
 
 # -------------------------------------------------------------------------------------
 # App layout
@@ -137,7 +120,6 @@ comparison2DropdownComponentID = 'compare-dropdown-2' + uniqueComponentForApp
 comparison3DropdownComponentID = 'compare-dropdown-3' + uniqueComponentForApp
 dataTableComponentID = 'datatable-interactivity' + uniqueComponentForApp
 card_graph = utilities.spinner_wrapper(dbc.Card(id=graphComponentID, body=True, color="secondary", ))
-dataTableComponent = utilities.data_table(dataTableComponentID, df)
 
 clinicalGroupList = ['phenotype', 'site', 'sex', 'ethnicity', 'race', 'mecfs_sudden_gradual',
                      'qmep_sudevent', 'qmep_metimediagnosis', 'vo2change', 'atchange']
@@ -145,222 +127,226 @@ clinicalNumericList = ['age', 'height_in', 'weight_lbs', 'bmi', 'mecfs_duration'
                        'vo2peak1', 'vo2peak2', 'at1', 'at2']
 
 # Sorting operators (https://dash.plotly.com/datatable/filtering)
-layout = html.Div([
-
-    # Buttons at top of window
-    dbc.Row([
-        dbc.Col(dbc.Button(
-            "Show / hide database schematic",
-            id=buttonQuestion1ID,
-            className="mb-3",
-            color="primary",
-        ), width=5),
-
-        dbc.Col(dbc.Button(
-            "Show / hide SQL statement entry",
-            id=buttonQuestion2ID,
-            className="mb-3",
-            color="primary",
-        ), width=5)
-    ], justify="center"),
-
-    # Database schema
-    dbc.Collapse(
-        dbc.Row([
-            dbc.Col(
-                cyto.Cytoscape(
-                    id=graphComponentID,
-                    zoomingEnabled=False,
-                    pan={'x': 100, 'y': 100},
-                    layout={'name': 'preset'},
-                    style={'width': '100%', 'height': '500px'},
-                    elements=[
-                        # Nodes elements
-                        {'data': {'id': 'demographic_data', 'label': 'Demographic data'},
-                         'position': {'x': 270, 'y': 10},
-                         'selected': True
-                         },
-
-                        {'data': {'id': 'demographic_history', 'label': 'Demographic history'},
-                         'position': {'x': 20, 'y': 30},
-                         },
-
-                        {'data': {'id': 'users', 'label': 'Users'},
-                         'position': {'x': 50, 'y': 90},
-                         },
-
-                        {'data': {'id': 'event_log', 'label': 'Event log'},
-                         'position': {'x': 20, 'y': 150},
-                         },
-
-                        {'data': {'id': 'biospecimen_data', 'label': 'Biospecimen data'},
-                         'position': {'x': 440, 'y': 10},
-                         },
-
-                        {'data': {'id': 'biospecimen_history', 'label': 'Biospecimen history'},
-                         'position': {'x': 550, 'y': 30},
-                         },
-
-                        {'data': {'id': 'biospecimen_tube_info', 'label': 'Biospecimen tube info'},
-                         'position': {'x': 570, 'y': 100},
-                         },
-
-                        {'data': {'id': 'redcap', 'label': 'Redcap'},
-                         'position': {'x': 120, 'y': 120},
-                         },
-
-                        {'data': {'id': 'proteomic', 'label': 'Proteomic'},
-                         'position': {'x': 220, 'y': 140},
-                         },
-
-                        {'data': {'id': 'cytokine', 'label': 'Cytokine'},
-                         'position': {'x': 340, 'y': 150},
-                         },
-
-                        {'data': {'id': 'metabolomic', 'label': 'Metabolomic'},
-                         'position': {'x': 460, 'y': 160}
-                         },
-
-                        {'data': {'id': 'assay_results', 'label': 'Assay results'},
-                         'position': {'x': 280, 'y': 250}
-                         },
-
-                        {'data': {'id': 'data_labels', 'label': 'Data labels'},
-                         'position': {'x': 430, 'y': 260}
-                         },
-
-                        {'data': {'id': 'data_label_pathways', 'label': 'Data label pathways'},
-                         'position': {'x': 480, 'y': 320}
-                         },
-
-                        {'data': {'id': 'gene_symbol_ref', 'label': 'Gene symbol ref'},
-                         'position': {'x': 130, 'y': 190}
-                         },
-
-                        {'data': {'id': 'ensembl_geneid_ref', 'label': 'Ensembl gene ID ref'},
-                         'position': {'x': 50, 'y': 240}
-                         },
-
-                        {'data': {'id': 'cytokine_label_ref', 'label': 'Cytokine label ref'},
-                         'position': {'x': 20, 'y': 290}
-                         },
-
-                        {'data': {'id': 'metabolomic_label_ref', 'label': 'Metabolomic label ref'},
-                         'position': {'x': 70, 'y': 340}
-                         },
-
-                        # Edge elements
-                        {'data': {'source': 'users', 'target': 'event_log'}},
-                        {'data': {'source': 'demographic_data', 'target': 'demographic_history'}},
-                        {'data': {'source': 'demographic_data', 'target': 'users'}},
-                        {'data': {'source': 'demographic_data', 'target': 'redcap'}},
-                        {'data': {'source': 'demographic_data', 'target': 'proteomic'}},
-                        {'data': {'source': 'demographic_data', 'target': 'cytokine'}},
-                        {'data': {'source': 'demographic_data', 'target': 'metabolomic'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'users'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'biospecimen_history'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'biospecimen_tube_info'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'proteomic'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'cytokine'}},
-                        {'data': {'source': 'biospecimen_data', 'target': 'metabolomic'}},
-                        {'data': {'source': 'proteomic', 'target': 'assay_results'}},
-                        {'data': {'source': 'cytokine', 'target': 'assay_results'}},
-                        {'data': {'source': 'metabolomic', 'target': 'assay_results'}},
-                        {'data': {'source': 'assay_results', 'target': 'data_labels'}},
-                        {'data': {'source': 'data_labels', 'target': 'data_label_pathways'}},
-                        {'data': {'source': 'assay_results', 'target': 'gene_symbol_ref'}},
-                        {'data': {'source': 'assay_results', 'target': 'ensembl_geneid_ref'}},
-                        {'data': {'source': 'assay_results', 'target': 'cytokine_label_ref'}},
-                        {'data': {'source': 'assay_results', 'target': 'metabolomic_label_ref'}},
-                    ]
-                ), width=9, align="start"),
-
-            dbc.Col(
-                # Show table columns
-                dbc.Card(
-                    id=tableDefinitionID,
-                    body=True
-                ),
-                width=3,
-                align="center",
-                style={'width': '100%',
-                       'height': '500px',
-                       'overflowY': 'scroll',
-                       'padding-top': '25px',
-                       'padding-bottom': '25px'
-                       }
-            )
-        ], justify="center"),
-        id=collapse1ID, is_open=True
-    ),
+def layout():
+    df, _ = data_cache.get(dataCacheName)
+    dataTableComponent = utilities.data_table(dataTableComponentID, df, server_side=True)
 
-    html.Br(),
+    return html.Div([
 
-    # SQL entry
-    dbc.Collapse(
+        # Buttons at top of window
         dbc.Row([
-            dbc.Textarea(id=sqlInputID, placeholder="Enter SQL...")
+            dbc.Col(dbc.Button(
+                "Show / hide database schematic",
+                id=buttonQuestion1ID,
+                className="mb-3",
+                color="primary",
+            ), width=5),
+
+            dbc.Col(dbc.Button(
+                "Show / hide SQL statement entry",
+                id=buttonQuestion2ID,
+                className="mb-3",
+                color="primary",
+            ), width=5)
+        ], justify="center"),
+
+        # Database schema
+        dbc.Collapse(
+            dbc.Row([
+                dbc.Col(
+                    cyto.Cytoscape(
+                        id=graphComponentID,
+                        zoomingEnabled=False,
+                        pan={'x': 100, 'y': 100},
+                        layout={'name': 'preset'},
+                        style={'width': '100%', 'height': '500px'},
+                        elements=[
+                            # Nodes elements
+                            {'data': {'id': 'demographic_data', 'label': 'Demographic data'},
+                             'position': {'x': 270, 'y': 10},
+                             'selected': True
+                             },
+
+                            {'data': {'id': 'demographic_history', 'label': 'Demographic history'},
+                             'position': {'x': 20, 'y': 30},
+                             },
+
+                            {'data': {'id': 'users', 'label': 'Users'},
+                             'position': {'x': 50, 'y': 90},
+                             },
+
+                            {'data': {'id': 'event_log', 'label': 'Event log'},
+                             'position': {'x': 20, 'y': 150},
+                             },
+
+                            {'data': {'id': 'biospecimen_data', 'label': 'Biospecimen data'},
+                             'position': {'x': 440, 'y': 10},
+                             },
+
+                            {'data': {'id': 'biospecimen_history', 'label': 'Biospecimen history'},
+                             'position': {'x': 550, 'y': 30},
+                             },
+
+                            {'data': {'id': 'biospecimen_tube_info', 'label': 'Biospecimen tube info'},
+                             'position': {'x': 570, 'y': 100},
+                             },
+
+                            {'data': {'id': 'redcap', 'label': 'Redcap'},
+                             'position': {'x': 120, 'y': 120},
+                             },
+
+                            {'data': {'id': 'proteomic', 'label': 'Proteomic'},
+                             'position': {'x': 220, 'y': 140},
+                             },
+
+                            {'data': {'id': 'cytokine', 'label': 'Cytokine'},
+                             'position': {'x': 340, 'y': 150},
+                             },
+
+                            {'data': {'id': 'metabolomic', 'label': 'Metabolomic'},
+                             'position': {'x': 460, 'y': 160}
+                             },
+
+                            {'data': {'id': 'assay_results', 'label': 'Assay results'},
+                             'position': {'x': 280, 'y': 250}
+                             },
+
+                            {'data': {'id': 'data_labels', 'label': 'Data labels'},
+                             'position': {'x': 430, 'y': 260}
+                             },
+
+                            {'data': {'id': 'data_label_pathways', 'label': 'Data label pathways'},
+                             'position': {'x': 480, 'y': 320}
+                             },
+
+                            {'data': {'id': 'gene_symbol_ref', 'label': 'Gene symbol ref'},
+                             'position': {'x': 130, 'y': 190}
+                             },
+
+                            {'data': {'id': 'ensembl_geneid_ref', 'label': 'Ensembl gene ID ref'},
+                             'position': {'x': 50, 'y': 240}
+                             },
+
+                            {'data': {'id': 'cytokine_label_ref', 'label': 'Cytokine label ref'},
+                             'position': {'x': 20, 'y': 290}
+                             },
+
+                            {'data': {'id': 'metabolomic_label_ref', 'label': 'Metabolomic label ref'},
+                             'position': {'x': 70, 'y': 340}
+                             },
+
+                            # Edge elements
+                            {'data': {'source': 'users', 'target': 'event_log'}},
+                            {'data': {'source': 'demographic_data', 'target': 'demographic_history'}},
+                            {'data': {'source': 'demographic_data', 'target': 'users'}},
+                            {'data': {'source': 'demographic_data', 'target': 'redcap'}},
+                            {'data': {'source': 'demographic_data', 'target': 'proteomic'}},
+                            {'data': {'source': 'demographic_data', 'target': 'cytokine'}},
+                            {'data': {'source': 'demographic_data', 'target': 'metabolomic'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'users'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'biospecimen_history'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'biospecimen_tube_info'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'proteomic'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'cytokine'}},
+                            {'data': {'source': 'biospecimen_data', 'target': 'metabolomic'}},
+                            {'data': {'source': 'proteomic', 'target': 'assay_results'}},
+                            {'data': {'source': 'cytokine', 'target': 'assay_results'}},
+                            {'data': {'source': 'metabolomic', 'target': 'assay_results'}},
+                            {'data': {'source': 'assay_results', 'target': 'data_labels'}},
+                            {'data': {'source': 'data_labels', 'target': 'data_label_pathways'}},
+                            {'data': {'source': 'assay_results', 'target': 'gene_symbol_ref'}},
+                            {'data': {'source': 'assay_results', 'target': 'ensembl_geneid_ref'}},
+                            {'data': {'source': 'assay_results', 'target': 'cytokine_label_ref'}},
+                            {'data': {'source': 'assay_results', 'target': 'metabolomic_label_ref'}},
+                        ]
+                    ), width=9, align="start"),
+
+                dbc.Col(
+                    # Show table columns
+                    dbc.Card(
+                        id=tableDefinitionID,
+                        body=True
+                    ),
+                    width=3,
+                    align="center",
+                    style={'width': '100%',
+                           'height': '500px',
+                           'overflowY': 'scroll',
+                           'padding-top': '25px',
+                           'padding-bottom': '25px'
+                           }
+                )
+            ], justify="center"),
+            id=collapse1ID, is_open=True
+        ),
+
+        html.Br(),
+
+        # SQL entry
+        dbc.Collapse(
+            dbc.Row([
+                dbc.Textarea(id=sqlInputID, placeholder="Enter SQL...")
+            ]),
+            id=collapse2ID, is_open=True
+        ),
+
+        # html.Br(),
+        # html.Div([
+        #     html.Div(dcc.Dropdown(
+        #         id=groupDropdownComponentID, value='phenotype', clearable=False,
+        #         options=[{'label': x, 'value': x} for x in clinicalGroupList],
+        #         multi=False,
+        #         searchable=True,
+        #         placeholder='Select one',
+        #         style={"width": "90%"}
+        #     ), className='two columns', style={"width": "15rem"}),
+        #
+        #     html.Div(dcc.Dropdown(
+        #         id=comparison1DropdownComponentID, value='sex', clearable=False,
+        #         persistence=True, persistence_type='memory',
+        #         options=[{'label': x, 'value': x} for x in clinicalGroupList],
+        #         multi=False,
+        #         searchable=True,
+        #         placeholder='Select one',
+        #         style={"width": "90%"}
+        #     ), className='two columns', style={"width": "15rem"}),
+        #
+        #     html.Div(dcc.Dropdown(
+        #         id=comparison2DropdownComponentID, value='site', clearable=False,
+        #         persistence=True, persistence_type='memory',
+        #         options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
+        #         multi=False,
+        #         searchable=True,
+        #         placeholder='Select one',
+        #         style={"width": "90%"}
+        #     ), className='two columns', style={"width": "15rem"}),
+        #
+        #     html.Div(dcc.Dropdown(
+        #         id=comparison3DropdownComponentID, value='race', clearable=False,
+        #         persistence=True, persistence_type='memory',
+        #         options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
+        #         multi=False,
+        #         searchable=True,
+        #         placeholder='Select one',
+        #         style={"width": "90%"}
+        #     ), className='two columns', style={"width": "15rem"}),
+        # ], className='row'),
+
+        # Data table
+        html.Br(),
+        html.Div([
+            dbc.Row(dbc.Col(dataTableComponent,
+                            width=12,
+                            style={'width': '100%',
+                                   'height': '500px',
+                                   'overflow': 'scroll',
+                                   # 'padding-top': '25px',
+                                   # 'padding-bottom': '25px'
+                                   }
+                            ), justify="start"),
         ]),
-        id=collapse2ID, is_open=True
-    ),
-
-    # html.Br(),
-    # html.Div([
-    #     html.Div(dcc.Dropdown(
-    #         id=groupDropdownComponentID, value='phenotype', clearable=False,
-    #         options=[{'label': x, 'value': x} for x in clinicalGroupList],
-    #         multi=False,
-    #         searchable=True,
-    #         placeholder='Select one',
-    #         style={"width": "90%"}
-    #     ), className='two columns', style={"width": "15rem"}),
-    #
-    #     html.Div(dcc.Dropdown(
-    #         id=comparison1DropdownComponentID, value='sex', clearable=False,
-    #         persistence=True, persistence_type='memory',
-    #         options=[{'label': x, 'value': x} for x in clinicalGroupList],
-    #         multi=False,
-    #         searchable=True,
-    #         placeholder='Select one',
-    #         style={"width": "90%"}
-    #     ), className='two columns', style={"width": "15rem"}),
-    #
-    #     html.Div(dcc.Dropdown(
-    #         id=comparison2DropdownComponentID, value='site', clearable=False,
-    #         persistence=True, persistence_type='memory',
-    #         options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
-    #         multi=False,
-    #         searchable=True,
-    #         placeholder='Select one',
-    #         style={"width": "90%"}
-    #     ), className='two columns', style={"width": "15rem"}),
-    #
-    #     html.Div(dcc.Dropdown(
-    #         id=comparison3DropdownComponentID, value='race', clearable=False,
-    #         persistence=True, persistence_type='memory',
-    #         options=[{'label': x, 'value': x} for x in ['none'] + clinicalGroupList],
-    #         multi=False,
-    #         searchable=True,
-    #         placeholder='Select one',
-    #         style={"width": "90%"}
-    #     ), className='two columns', style={"width": "15rem"}),
-    # ], className='row'),
-
-    # Data table
-    html.Br(),
-    html.Div([
-        dbc.Row(dbc.Col(dataTableComponent,
-                        width=12,
-                        style={'width': '100%',
-                               'height': '500px',
-                               'overflow': 'scroll',
-                               # 'padding-top': '25px',
-                               # 'padding-bottom': '25px'
-                               }
-                        ), justify="start"),
-    ]),
-    html.Br(),
-])
+        html.Br(),
+    ])
 
 
 # Show / hide regions
@@ -419,6 +405,8 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
     print(compare_2_chosen)
     print(compare_3_chosen)
 
+    df, _ = data_cache.get(dataCacheName)
+
     rootBranchesLeaves = [group_chosen, compare_1_chosen]
     if compare_2_chosen.lower() != 'none':
         rootBranchesLeaves.append(compare_2_chosen)
@@ -519,6 +507,11 @@ def display_value(group_chosen, compare_1_chosen, compare_2_chosen, compare_3_ch
 #     ]
 
 
+# -------------------------------------------------------------------------------------
+# Page, filter and sort the data table on the server
+utilities.register_server_side_table(app, dataTableComponentID, lambda: data_cache.get(dataCacheName)[0])
+
+
 # -------------------------------------------------------------------------------------
 # Highlight selected column
 @app.callback(
@@ -37,6 +37,7 @@ class Proteomic(mongoengine.EmbeddedDocument):
     units = mongoengine.StringField()
     normalization_method = mongoengine.StringField()
     pipeline = mongoengine.StringField()
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     assay_results = mongoengine.EmbeddedDocumentListField(AssayResults)
 
@@ -75,6 +76,7 @@ class Cytokine(mongoengine.EmbeddedDocument):
     units = mongoengine.StringField()
     normalization_method = mongoengine.StringField()
     pipeline = mongoengine.StringField()
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     assay_results = mongoengine.EmbeddedDocumentListField(AssayResults)
 
@@ -108,5 +110,6 @@ class Metabolomic(mongoengine.EmbeddedDocument):
     units = mongoengine.StringField()
     normalization_method = mongoengine.StringField()
     pipeline = mongoengine.StringField()
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     assay_results = mongoengine.EmbeddedDocumentListField(AssayResults)
@@ -0,0 +1,36 @@
+import datetime
+import mongoengine
+from data.users import User
+import set_up_globals
+
+data_label_type_choices = set_up_globals.data_label_type_choices
+
+
+# Columnar alternative to the assay_results lists embedded in ClinicalData (see
+# set_up_globals.assay_results_storage). There is one block per sample (unique_id) per
+# assay, data label type, and dataset; data_labels holds the column names, and results holds
+# the matching values packed as little-endian float64 (NaN for missing values).
+class AssayResultBlock(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+    last_modified_by = mongoengine.ReferenceField(User, required=True)
+    last_modified_date = mongoengine.DateTimeField(default=datetime.datetime.now)
+
+    study_id = mongoengine.IntField(required=True)
+    assay_type = mongoengine.StringField(required=True)  # Sub-document name, e.g. proteomic, cytokine, metabolomic
+    data_label_type = mongoengine.StringField(required=True, choices=data_label_type_choices)
+    dataset_name = mongoengine.StringField()
+    data_file_name = mongoengine.StringField(required=True)
+    unique_id = mongoengine.StringField(required=True)
+    timepoint = mongoengine.StringField()
+
+    data_labels = mongoengine.ListField(mongoengine.StringField())
+    results = mongoengine.BinaryField()
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'assay_result_blocks',
+        'indexes': [('study_id', 'assay_type', 'data_label_type'),
+                    {'fields': ('unique_id', 'assay_type', 'data_label_type', 'study_id', 'dataset_name'),
+                     'unique': True}]
+    }
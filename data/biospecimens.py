@@ -25,6 +25,7 @@ class BiospecimenTubeInfo(mongoengine.EmbeddedDocument):
     analysis_id = mongoengine.StringField()
     is_removed = mongoengine.BooleanField()
     comments = mongoengine.StringField()
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
 
 class Biospecimen(mongoengine.Document):
@@ -49,8 +50,8 @@ class Biospecimen(mongoengine.Document):
     #     return dt.days
     meta = {
         'db_alias': 'core',
-        'collection': 'biospecimen_data'
-        # 'indexes': ['study_id', 'site', '$phenotype']
+        'collection': 'biospecimen_data',
+        'indexes': ['specimen_id', 'study_id']
     }
 
 
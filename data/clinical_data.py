@@ -77,6 +77,7 @@ class ClinicalData(mongoengine.Document):
     at1 = mongoengine.StringField()
     at2 = mongoengine.StringField()
     atchange = mongoengine.StringField(choices=change_choice)
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     # biospecimens = mongoengine.EmbeddedDocumentListField(Biospecimen)
     redcap = mongoengine.EmbeddedDocumentListField(Redcap)
@@ -92,7 +93,7 @@ class ClinicalData(mongoengine.Document):
                          'biospecimen_data_references', 'redcap', 'proteomic', 'cytokine', 'metabolomic',
                          'scrnaseq_summary', 'get_demographic_attributes', 'demographic_data_only',
                          'redcap_data_only', 'proteomic_data_only', 'cytokine_data_only',
-                         'metabolomic_data_only', 'scrnaseq_summary_data_only']
+                         'metabolomic_data_only', 'scrnaseq_summary_data_only', 'content_hash']
         return [i for i in cls.__dict__.keys() if not i.startswith('_') and i not in excludeFields]
 
     @mongoengine.queryset_manager
@@ -150,9 +151,11 @@ class ClinicalData(mongoengine.Document):
         'ordering': ['-study_id'],
         'indexes': ['study_id',
                     '$phenotype',
+                    'phenotype',  # The text index above can't be used for sorting
                     'proteomic.unique_id',
                     'cytokine.unique_id',
-                    'metabolomic.unique_id']
+                    'metabolomic.unique_id',
+                    'scrnaseq_summary.sampleid']
     }
 
 
@@ -192,6 +195,7 @@ class ClinicalDataVersionHistory(mongoengine.Document):
     at1 = mongoengine.StringField()
     at2 = mongoengine.StringField()
     atchange = mongoengine.StringField(choices=change_choice)
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     # biospecimens = mongoengine.EmbeddedDocumentListField(Biospecimen)
     redcap = mongoengine.EmbeddedDocumentListField(Redcap)
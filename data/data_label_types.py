@@ -18,7 +18,8 @@ class DataLabels(mongoengine.Document):
         'db_alias': 'core',
         'collection': 'data_labels',
         'ordering': ['-data_label'],
-        'indexes': ['data_label']
+        'indexes': ['data_label',
+                    ('data_label_type', 'data_label')]
     }
 
 
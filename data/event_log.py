@@ -4,6 +4,7 @@ import mongoengine
 from data.users import User
 
 event_type_choice = ('Import',
+                     'Unchanged',  # Rows skipped on re-import - not a new dataset version (svc.find_dataset_version)
                      'Query',
                      'Login'
                      'Logout')
@@ -34,6 +35,6 @@ class Event_log(mongoengine.Document):
     #     return dt.days
     meta = {
         'db_alias': 'core',
-        'collection': 'event_log'
-        # 'indexes': ['study_id', 'site', '$phenotype']
+        'collection': 'event_log',
+        'indexes': [('success', '-created_date')]  # Latest successful import (svc.find_dataset_version)
     }
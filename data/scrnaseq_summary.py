@@ -46,6 +46,7 @@ class ScRNAseqSummary(mongoengine.EmbeddedDocument):
     sample_name = mongoengine.StringField()
     bc = mongoengine.StringField()
     notes = mongoengine.StringField()
+    content_hash = mongoengine.StringField()  # Fingerprint of the imported row, to skip unchanged rows
 
     # @property
     # def target(self):
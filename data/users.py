@@ -12,5 +12,6 @@ class User(mongoengine.Document):
 
     meta = {
         'db_alias': 'core',
-        'collection': 'users'
+        'collection': 'users',
+        'indexes': ['email']
     }
@@ -0,0 +1,28 @@
+import mongoengine
+from data.users import User
+
+document_type_choices = ('demographic',
+                         'biospecimen')
+
+
+# Delta alternative to ClinicalDataVersionHistory / BiospecimenVersionHistory (see
+# set_up_globals.version_history_mode). Each version of a document is stored either as a full
+# snapshot of the raw document, or as a JSON-patch style list of operations that turns the
+# previous version into this one. snapshot_version is the version of the snapshot the patch
+# chain starts from, so a version can be rebuilt from one snapshot and the patches after it.
+class VersionHistoryDelta(mongoengine.Document):
+    created_by = mongoengine.ReferenceField(User, required=True)
+    created_date = mongoengine.DateTimeField(required=True)
+
+    document_type = mongoengine.StringField(required=True, choices=document_type_choices)
+    document_id = mongoengine.ObjectIdField(required=True)
+    version_number = mongoengine.IntField(required=True)
+    snapshot_version = mongoengine.IntField(required=True)
+    snapshot = mongoengine.DictField()  # Raw document, for snapshot versions
+    patch = mongoengine.ListField(mongoengine.DictField())  # e.g. {'op': 'replace', 'path': '/age', 'value': 42}
+
+    meta = {
+        'db_alias': 'core',
+        'collection': 'version_history_deltas',
+        'indexes': [{'fields': ('document_type', 'document_id', 'version_number'), 'unique': True}]
+    }
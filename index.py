@@ -149,25 +149,25 @@ def display_page(pathname):
     # else:
     #     return "404 Page Error! Please choose a link"
     # if pathname in ["/", "/page-1"]:
-    #     return mecfs_dash_app_clinical_data_lineplots.layout
+    #     return mecfs_dash_app_clinical_data_lineplots.layout()
     if pathname in ["/", "/page-1"]:
-        return mecfs_dash_app_clinical_data_sunburst.layout
+        return mecfs_dash_app_clinical_data_sunburst.layout()
     elif pathname == "/page-2":
-        return mecfs_dash_app_clinical_data_filters.layout
+        return mecfs_dash_app_clinical_data_filters.layout()
     elif pathname == "/page-3":
-        return mecfs_dash_app_sql_interface.layout
+        return mecfs_dash_app_sql_interface.layout()
     elif pathname == "/page-4":
-        return mecfs_dash_app_cytokine_data_filters.layout
+        return mecfs_dash_app_cytokine_data_filters.layout()
     elif pathname == "/page-5":
-        return mecfs_dash_app_proteomic_cytokine_comparison.layout
+        return mecfs_dash_app_proteomic_cytokine_comparison.layout()
     elif pathname == "/page-6":
-        return mecfs_dash_app_metabolomic_violin_plots.layout
+        return mecfs_dash_app_metabolomic_violin_plots.layout()
     elif pathname == "/page-7":
-        return mecfs_dash_app_scrna_summary_3dscatterplot.layout
+        return mecfs_dash_app_scrna_summary_3dscatterplot.layout()
     elif pathname == "/page-8":
-        return mecfs_dash_app_scrna_summary_lineplots.layout
+        return mecfs_dash_app_scrna_summary_lineplots.layout()
     # elif pathname == "/page-8":
-    #     return mecfs_dash_app_scrna_summary_barplots.layout
+    #     return mecfs_dash_app_scrna_summary_barplots.layout()
     # elif pathname == "/page-4":
     #     return dbc.Jumbotron(html.H1("Oh cool, this is page 4!", className="text-success"))
     #     # return html.P("Oh cool, this is page 3!")
@@ -8,7 +8,12 @@
 # Created: 10/19/2020
 
 
+import argparse
+import glob
+import multiprocessing
 import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 # import sys
 # import datetime
 from colorama import Fore
@@ -16,9 +21,11 @@ from colorama import Fore
 from mongoengine import ValidationError
 
 import data.mongo_setup as mongo_setup
+from workbook_reader import WorkbookReader
 from infrastructure.switchlang import switch
 import infrastructure.state as state
 import services.data_service as svc
+import services.index_management as index_management
 from data.assay_classes import Proteomic
 from data.assay_classes import Cytokine
 from data.assay_classes import Metabolomic
@@ -35,9 +42,29 @@ data_folder = set_up_globals.data_folder
 
 
 def main():
+    args = parse_arguments()
     mongo_setup.global_init(set_up_globals.database_name)
     print_header()
 
+    # Index maintenance
+    if args.ensure_indexes or args.audit_indexes:
+        if args.ensure_indexes:
+            index_management.ensure_indexes()
+            success_msg('Indexes are up to date.')
+        if args.audit_indexes:
+            index_management.print_index_report()
+        return
+
+    # Non-interactive batch import
+    if args.batch:
+        active_account = svc.find_account_by_email(args.user) if args.user else None
+        if not active_account:
+            error_msg('Error: --batch needs the email address of an existing user (--user)')
+            return
+        state.active_account = active_account
+        batch_import(args.batch, active_account, args.workers, args.writers)
+        return
+
     while not state.active_account:
         try:
             response = log_into_account()
@@ -81,6 +108,22 @@ def main():
         return
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Import data into the ME/CFS database')
+    parser.add_argument('--batch', metavar='PATH',
+                        help='import every Excel file in a folder (or matching a glob pattern), without prompting')
+    parser.add_argument('--user', metavar='EMAIL', help='email address of the user doing a batch import')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes used to read files in a batch import (default: one per core)')
+    parser.add_argument('--writers', type=int, default=set_up_globals.batch_import_writers,
+                        help='number of threads used to save data in a batch import')
+    parser.add_argument('--ensure-indexes', action='store_true',
+                        help='create any missing indexes declared in the data models, then exit')
+    parser.add_argument('--audit-indexes', action='store_true',
+                        help='report missing indexes, and queries that scan a whole collection or sort in memory')
+    return parser.parse_args()
+
+
 def show_commands():
     print('What action would you like to take:')
     print(f'[D] Import {set_up_globals.clinical_document_name} data')
@@ -182,9 +225,18 @@ def modify_df_column_names(column_names, classColumnList=None):
     return renamed_columns
 
 
-def create_custom_columns(df, documentName, data_file_name, index_column=None):
-    #  Acts like pass by reference if I add data to df, rather than
-    #  assigning a new value to df, so no need to return a value
+# Normalize a spreadsheet that has just been read, using vectorized pandas operations:
+# standardize timepoints, build unique_id / specimen_id / study_id columns, and drop rows that can't be imported.
+# Returns the normalized data frame and a validation report listing anything that was changed or dropped.
+def normalize_data_frame(df, documentName, data_file_name, index_column=None):
+    df = df.copy()
+    validationReport = {'document_name': documentName,
+                        'data_file_name': data_file_name,
+                        'row_count': len(df),
+                        'dropped_rows': [],
+                        'invalid_timepoints': [],
+                        'invalid_study_ids': []}
+
     df['data_file_name'] = data_file_name
 
     if documentName == set_up_globals.scrnaseq_summary_document_name:
@@ -195,37 +247,29 @@ def create_custom_columns(df, documentName, data_file_name, index_column=None):
             documentName == set_up_globals.metabolomics_document_name:
         df['study_id'] = df['ENID']
 
+        # Valid time points are kept as is, known aliases are translated, and anything else is blanked out
         validTimePoints = ['D1-PRE', 'D1-POST', 'D2-PRE', 'D2-POST']
-        timepoint_list = []
-        for val in df['timepoint']:
-            if val in validTimePoints:
-                timepoint_list.append(val)
-            elif val.lower() == 'pre-day1':
-                timepoint_list.append('D1-PRE')
-            elif val.lower() == 'post-day1':
-                timepoint_list.append('D1-POST')
-            elif val.lower() == 'pre-day2':
-                timepoint_list.append('D2-PRE')
-            elif val.lower() == 'post-day2':
-                timepoint_list.append('D2-POST')
-            else:
-                timepoint_list.append('')
-        df['timepoint'] = timepoint_list
+        timepointAliasDict = {'pre-day1': 'D1-PRE',
+                              'post-day1': 'D1-POST',
+                              'pre-day2': 'D2-PRE',
+                              'post-day2': 'D2-POST'}
+        timepoints = df['timepoint'].astype(str)
+        normalizedTimepoints = timepoints.where(timepoints.isin(validTimePoints),
+                                                timepoints.str.lower().map(timepointAliasDict))
+        validationReport['invalid_timepoints'] = sorted(timepoints[normalizedTimepoints.isna()].unique())
+        df['timepoint'] = normalizedTimepoints.fillna('')
 
         # Set up unique_id column
         if index_column == 'AnalysisID':
-            # df.dropna(axis=0, subset=[index_column], inplace=True)  # Remove nulls from index
             # //--- flag null value in the event log
-            index_names = df[df[index_column] == ''].index
-            df.drop(index_names, inplace=True)
+            blankIndex = df[index_column] == ''
+            validationReport['dropped_rows'].extend(df.index[blankIndex].tolist())
+            df = df[~blankIndex].copy()
             df['unique_id'] = df[index_column]
         elif index_column == 'ENID+Timepoint':
             # //--- flag null values in the event log
-            # //--- I'm sure there's a way of doing this in one line, but this way is more readable : )
-            unique_id_list = []
-            for index, row in df.iterrows():
-                unique_id_list.append(svc.convert_to_string(row.study_id) + '-' + row.timepoint + '-' + data_file_name)
-            df['unique_id'] = unique_id_list
+            df['unique_id'] = svc.convert_series_to_string(df['study_id']) + '-' + df['timepoint'] + '-' + \
+                data_file_name
         # else:
         #     error_msg(f'Error: {index_column} is not a valid sample identifier type')
         #     error_msg('Exiting data load')
@@ -235,17 +279,16 @@ def create_custom_columns(df, documentName, data_file_name, index_column=None):
         df['sample_id'] = df['id']
         # Set Specimen ID to ENID, CPET Day, Pre/Post, and Specimen type
         # //--- this may not be needed in biospecimen spread sheet removes tube number from specimen id column
-        # //--- I'm sure there's a way of doing this in one line, but this way is more readable : )
-        specimen_id_list = []
-        for val in df['specimen_id']:
-            valMinusTubeNumberList = val.split('-')[0:4]
-            specimen_id_list.append('-'.join(valMinusTubeNumberList))
-        df['specimen_id'] = specimen_id_list
+        df['specimen_id'] = df['specimen_id'].astype(str).str.split('-').str[0:4].str.join('-')
 
     if documentName == set_up_globals.clinical_document_name:
         # Make sure study ID is numeric (i.e. strip off 'ENID' if it exists)
-        study_id_list = [int(val.strip('ENID')) for val in df['study_id']]
-        df['study_id'] = study_id_list
+        study_ids = pd.to_numeric(df['study_id'].astype(str).str.strip('ENID'), errors='coerce')
+        invalidStudyIds = study_ids.isna()
+        validationReport['invalid_study_ids'] = df.loc[invalidStudyIds, 'study_id'].astype(str).tolist()
+        validationReport['dropped_rows'].extend(df.index[invalidStudyIds].tolist())
+        df = df[~invalidStudyIds].copy()
+        df['study_id'] = study_ids[~invalidStudyIds].astype(int)
 
     if documentName == set_up_globals.data_label_type_document_name:
         df['unique_id'] = df.index
@@ -260,6 +303,19 @@ def create_custom_columns(df, documentName, data_file_name, index_column=None):
             df['cytokine_label'] = ''
         # //--- set up remaining data labels - let's do this without the hardcoding
 
+    return df, validationReport
+
+
+# Display anything from the validation report that needs the user's attention
+def print_validation_report(validationReport):
+    if len(validationReport['invalid_timepoints']) > 0:
+        error_msg(f"Invalid time points (left blank): {', '.join(validationReport['invalid_timepoints'])}")
+    if len(validationReport['invalid_study_ids']) > 0:
+        error_msg(f"Invalid study IDs (rows dropped): {', '.join(validationReport['invalid_study_ids'])}")
+    if len(validationReport['dropped_rows']) > 0:
+        error_msg(f"{len(validationReport['dropped_rows'])} of {validationReport['row_count']} rows dropped from "
+                  f"{validationReport['data_file_name']}")
+
 
 def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name=0, skiprows=None):
     print(f' ******************** Import {documentName} data ******************** ')
@@ -288,11 +344,18 @@ def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name
         error_msg('\nError: You did not make a valid file selection \n')
         return None, None
 
-    engine = 'openpyxl'  # Support for xlxs file format
-    if data_file_name.split('.')[1] == 'xls':
-        engine = 'xlrd'  # Support for xls file format
-    df = pd.read_excel(data_folder + data_file_name,
-                       sheet_name=sheet_name, skiprows=skiprows, engine=engine, keep_default_na=False)
+    df, validationReport = read_data_file(documentName, data_folder + data_file_name, data_file_name, index_column,
+                                          verifyIntegrityFlag, sheet_name, skiprows)
+    print_validation_report(validationReport)
+
+    return df, data_file_name
+
+
+# Read and normalize one sheet of a (non-assay) spreadsheet, indexed by index_column
+def read_data_file(documentName, file_path, data_file_name, index_column, verifyIntegrityFlag=True, sheet_name=0,
+                   skiprows=None):
+    with WorkbookReader(file_path) as workbook:
+        df = workbook.read_sheet(sheet_name=sheet_name, skiprows=skiprows)
 
     df.columns = modify_df_column_names(df.columns)
     index_names = df[df[index_column] == ''].index
@@ -300,10 +363,10 @@ def import_data(documentName, index_column, verifyIntegrityFlag=True, sheet_name
     # df.dropna(axis=0, subset=[index_column], inplace=True)  # Remove nulls from index
 
     # Create custom columns
-    create_custom_columns(df, documentName, data_file_name)
+    df, validationReport = normalize_data_frame(df, documentName, data_file_name)
     df.set_index(index_column, drop=False, inplace=True, verify_integrity=verifyIntegrityFlag)
 
-    return df, data_file_name
+    return df, validationReport
 
 
 def import_assay_data():
@@ -334,31 +397,19 @@ def import_assay_data():
 
     # Start by reading metadata sheet
     # Need to know: documentName, index_column, sheet_name, and skiprows before reading data sheet
-    metaDataDict = {'submitter_name': None,
-                    'submitter_netid': None,
-                    'pi_name': None,
-                    'assay_type': None,
-                    'assay_method': None,
-                    'biospecimen_type': None,
-                    'sample_identifier_type': None,
-                    'dataset_name': None,
-                    'dataset_annotation': None,
-                    'data_label_type': None,
-                    'comment': None,
-                    'units': None,
-                    'normalization_method': None,
-                    'pipeline': None}
-    engine = 'openpyxl'  # Support for xlxs file format
-    if data_file_name.split('.')[1] == 'xls':
-        engine = 'xlrd'  # Support for xls file format
-    skiprows = range(0, 3)
-    metaDataDF = pd.read_excel(data_folder + data_file_name,
-                               sheet_name='Metadata', skiprows=skiprows, engine=engine, keep_default_na=False)
-    for i, row in metaDataDF.iterrows():
-        metaDataType = modify_df_column_names([str(row[0]).lower()])[0]
-        response = str(row[1])
-        if metaDataType in metaDataDict and len(response) > 0:
-            metaDataDict[metaDataType] = response
+    metaDataDict = new_metadata_dict()
+
+    # Open the workbook once, and read both the metadata and data sheets from it
+    with WorkbookReader(data_folder + data_file_name) as workbook:
+        import_assay_workbook(workbook, data_file_name, metaDataDict)
+
+    return  # df, data_file_name
+
+
+# Read the metadata sheet of an assay workbook, then import the data sheet a chunk of rows at a time,
+# so that memory use doesn't grow with the size of the workbook
+def import_assay_workbook(workbook, data_file_name, metaDataDict):
+    read_assay_metadata(workbook, metaDataDict)
 
     # Display what was just read
     print('')
@@ -366,11 +417,6 @@ def import_assay_data():
         print(key, ':', val)
 
     # Check assay type
-    # //--- replace all these with global references
-    validAssayTypes = [set_up_globals.proteomics_document_name,
-                       set_up_globals.cytokines_document_name,
-                       set_up_globals.metabolomics_document_name,
-                       'BDNF', 'CPET', 'LPS', 'miRNA', 'scRNAseq', 'Survey']
     documentName = metaDataDict['assay_type']
     if documentName not in validAssayTypes:
         error_msg(f'Error: {documentName} is not a valid assay type')
@@ -384,10 +430,99 @@ def import_assay_data():
 
     print(f' ******************** Import {documentName} data ******************** ')
 
+    classColumnList = assay_class_columns(documentName)
+    if classColumnList is None:
+        error_msg(f'Error: {documentName} is not a valid assay type')
+        error_msg('No data saved')
+        return
+
+    # Check every chunk before any of them is saved, so that a duplicate unique_id
+    # in a later chunk doesn't leave the earlier chunks in the database
+    try:
+        check_assay_chunks(workbook, documentName, data_file_name, metaDataDict, classColumnList)
+    except (ValueError, ValidationError) as e:
+        message = f'Create of index for {documentName} data resulted in exception: {e}'
+        error_msg(message)
+        error_msg('No data saved')
+        return  # Skip the rest of this function
+
+    for df, validationReport in prepare_assay_chunks(workbook, documentName, data_file_name, metaDataDict,
+                                                     classColumnList):
+        print_validation_report(validationReport)
+        save_assay_data(state.active_account, df, documentName, data_file_name, metaDataDict)
+
+
+# //--- replace all these with global references
+validAssayTypes = [set_up_globals.proteomics_document_name,
+                   set_up_globals.cytokines_document_name,
+                   set_up_globals.metabolomics_document_name,
+                   'BDNF', 'CPET', 'LPS', 'miRNA', 'scRNAseq', 'Survey']
+
+
+# Fill in metaDataDict from the Metadata sheet of an assay workbook
+def read_assay_metadata(workbook, metaDataDict):
+    metaDataDF = workbook.read_sheet(sheet_name='Metadata', skiprows=range(0, 3))
+    for i, row in metaDataDF.iterrows():
+        metaDataType = modify_df_column_names([str(row[0]).lower()])[0]
+        response = str(row[1])
+        if metaDataType in metaDataDict and len(response) > 0:
+            metaDataDict[metaDataType] = response
+
+    return metaDataDict
+
+
+def new_metadata_dict():
+    return {'submitter_name': None,
+            'submitter_netid': None,
+            'pi_name': None,
+            'assay_type': None,
+            'assay_method': None,
+            'biospecimen_type': None,
+            'sample_identifier_type': None,
+            'dataset_name': None,
+            'dataset_annotation': None,
+            'data_label_type': None,
+            'comment': None,
+            'units': None,
+            'normalization_method': None,
+            'pipeline': None}
+
+
+# Columns of the assay class, or None if the assay type can't be imported yet
+def assay_class_columns(documentName):
+    # //--- add remaining assay types
+    if documentName == set_up_globals.proteomics_document_name:
+        return utilities.attributes(Proteomic)
+    elif documentName == set_up_globals.cytokines_document_name:
+        return utilities.attributes(Cytokine)
+    elif documentName == set_up_globals.metabolomics_document_name:
+        return utilities.attributes(Metabolomic)
+    return None
+
+
+def read_assay_chunks(workbook):
     skiprows = range(0, 1)  # //--- for now, define skiprows as the top row - can adjust this later
-    df = pd.read_excel(data_folder + data_file_name,
-                       sheet_name='Data Table', skiprows=skiprows, engine=engine, keep_default_na=False)
+    return workbook.iter_sheet_chunks(sheet_name='Data Table', skiprows=skiprows,
+                                      chunk_size=set_up_globals.import_chunk_size)
+
+
+# Read and prepare the data sheet of an assay workbook a chunk at a time (see prepare_assay_chunk)
+def prepare_assay_chunks(workbook, documentName, data_file_name, metaDataDict, classColumnList):
+    uniqueIdSet = set()  # unique_ids read so far, to check the index across all chunks
+    for df in read_assay_chunks(workbook):
+        yield prepare_assay_chunk(df, documentName, data_file_name, metaDataDict, classColumnList, uniqueIdSet)
+
 
+# Read through the data sheet of an assay workbook without keeping the data, to check the
+# unique_ids across the whole sheet. Raises ValueError if one is repeated.
+def check_assay_chunks(workbook, documentName, data_file_name, metaDataDict, classColumnList):
+    for _ in prepare_assay_chunks(workbook, documentName, data_file_name, metaDataDict, classColumnList):
+        pass
+
+
+# Normalize one chunk of rows from the data sheet of an assay workbook, and index it by unique_id.
+# Raises ValueError if a unique_id is repeated, within the chunk or across chunks (uniqueIdSet).
+def prepare_assay_chunk(df, documentName, data_file_name, metaDataDict, classColumnList, uniqueIdSet):
     # Remove nulls from ENID
     index_names = df[df['ENID'] == ''].index
     df.drop(index_names, inplace=True)
@@ -397,45 +532,34 @@ def import_assay_data():
     unnamedColList = [colName for colName in df.columns if str(colName).startswith('Unnamed')]
     df.drop(labels=unnamedColList, axis='columns', inplace=True)
 
-    # //--- add remaining assay types
-    if documentName == set_up_globals.proteomics_document_name:
-        classColumnList = utilities.attributes(Proteomic)
-    elif documentName == set_up_globals.cytokines_document_name:
-        classColumnList = utilities.attributes(Cytokine)
-    elif documentName == set_up_globals.metabolomics_document_name:
-        classColumnList = utilities.attributes(Metabolomic)
-    else:
-        error_msg(f'Error: {documentName} is not a valid assay type')
-        error_msg('No data saved')
-        return
-
     df.columns = modify_df_column_names(df.columns, classColumnList)
 
     # Create custom columns
-    create_custom_columns(df, documentName, data_file_name, metaDataDict['sample_identifier_type'])
+    df, validationReport = normalize_data_frame(df, documentName, data_file_name,
+                                                metaDataDict['sample_identifier_type'])
 
-    try:
-        df.set_index('unique_id', drop=False, inplace=True, verify_integrity=True)
-    except (ValueError, ValidationError) as e:
-        message = f'Create of index for {documentName} data resulted in exception: {e}'
-        error_msg(message)
-        error_msg('No data saved')
-        return  # Skip the rest of this function
+    df.set_index('unique_id', drop=False, inplace=True, verify_integrity=True)
+    duplicateIds = uniqueIdSet.intersection(df.index)
+    if len(duplicateIds) > 0:
+        raise ValueError(f'Index has duplicate keys: {sorted(duplicateIds)}')
+    uniqueIdSet.update(df.index)
+
+    return df, validationReport
 
-    # Assay specific save functions
+
+# Assay specific save functions
+def save_assay_data(active_account, df, documentName, data_file_name, metaDataDict):
     # //--- still need svc code for other documents
     if documentName == set_up_globals.proteomics_document_name:
-        svc.add_proteomic_data(state.active_account, df, data_file_name, metaDataDict)
+        svc.add_proteomic_data(active_account, df, data_file_name, metaDataDict)
     elif documentName == set_up_globals.cytokines_document_name:
-        svc.add_cytokine_data(state.active_account, df, data_file_name, metaDataDict)
+        svc.add_cytokine_data(active_account, df, data_file_name, metaDataDict)
     elif documentName == set_up_globals.metabolomics_document_name:
-        svc.add_metabolomic_data(state.active_account, df, data_file_name, metaDataDict)
+        svc.add_metabolomic_data(active_account, df, data_file_name, metaDataDict)
     else:
         error_msg(f'Error: {documentName} is not a valid assay type')
         error_msg('No data saved')
 
-    return  # df, data_file_name
-
 
 def import_data_label_types():
     documentName = set_up_globals.data_label_type_document_name
@@ -573,6 +697,254 @@ def import_scrnaseq_summary_data():
     #         f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {index}.')
 
 
+# -------------------------------------------------------------------------------------
+# Batch import
+# Workbooks are read and checked in a pool of processes, then saved by a small pool of threads.
+# Data is saved in stages, since later data refers to earlier data: clinical (demographic) data and
+# data labels, then biospecimens and pathways (which refer to the data labels), then assay and scRNA-seq data.
+
+# Import settings for each type of (non-assay) workbook. Every assay type is imported in stage 2.
+# Data label workbooks are recognised by their gene_name column; compound ID workbooks
+# (see import_compound_ids) aren't recognised, and have to be imported before the batch.
+batchDocumentDict = {
+    set_up_globals.clinical_document_name: {'stage': 0,
+                                            'index_column': 'study_id',
+                                            'verifyIntegrityFlag': True,
+                                            'skiprows': None,
+                                            'save': svc.add_clinical_data},
+    set_up_globals.biospecimen_document_name: {'stage': 1,
+                                               'index_column': 'specimen_id',
+                                               'verifyIntegrityFlag': False,
+                                               'skiprows': None,
+                                               'save': svc.add_biospecimen_data},
+    set_up_globals.scrnaseq_summary_document_name: {'stage': 2,
+                                                    'index_column': 'sampleid',
+                                                    'verifyIntegrityFlag': True,
+                                                    'skiprows': range(0, 3),
+                                                    'save': svc.add_scrnaseq_summary_data},
+    set_up_globals.data_label_type_document_name: {'stage': 0,
+                                                   'index_column': 'gene_name',
+                                                   'verifyIntegrityFlag': False,
+                                                   'skiprows': None,
+                                                   'save': svc.add_data_label_types},
+    set_up_globals.data_label_pathway_document_name: {'stage': 1,
+                                                      'index_column': 'pathway_name',
+                                                      'verifyIntegrityFlag': False,
+                                                      'skiprows': None,
+                                                      'save': svc.add_data_label_pathways},
+}
+assayImportStage = 2
+
+
+def find_batch_files(path):
+    if os.path.isdir(path):
+        fileList = [os.path.join(path, names) for names in sorted(os.listdir(path))]
+    else:
+        fileList = sorted(glob.glob(path))
+
+    return [names for names in fileList
+            if (names.endswith('.xlsx') or names.endswith('.xls')) and not os.path.basename(names).startswith('~')]
+
+
+# Work out what kind of data a workbook holds from its sheet names and column headers.
+# Returns the document name, or None if it can't be told (or read). Runs in a worker process.
+def classify_workbook(file_path):
+    try:
+        with WorkbookReader(file_path) as workbook:
+            if 'Metadata' in workbook.sheet_names and 'Data Table' in workbook.sheet_names:
+                return read_assay_metadata(workbook, new_metadata_dict())['assay_type']
+
+            columns = modify_df_column_names(workbook.read_header())
+            if 'pathway_name' in columns:
+                return set_up_globals.data_label_pathway_document_name
+            if 'gene_name' in columns:
+                return set_up_globals.data_label_type_document_name
+            if 'specimen_id' in columns:
+                return set_up_globals.biospecimen_document_name
+            if 'study_id' in columns:
+                return set_up_globals.clinical_document_name
+            if 'sampleid' in modify_df_column_names(workbook.read_header(skiprows=range(0, 3))):
+                return set_up_globals.scrnaseq_summary_document_name
+    except Exception as e:  # Any problem with one file must not stop the rest of the batch
+        error_msg(f'Unable to read {file_path}: {e}')
+
+    return None
+
+
+def batch_import_stage(documentName):
+    if documentName in batchDocumentDict:
+        return batchDocumentDict[documentName]['stage']
+    if assay_class_columns(documentName) is not None:
+        return assayImportStage
+    return None
+
+
+# Read, normalize and check a workbook. Runs in a worker process, so must not use the database.
+# Other data is returned as a single data frame. Assay workbooks are only checked here (their data
+# frames are not returned): the data sheet is read again a chunk at a time when it is saved, so that
+# a large assay workbook is never held in memory (or sent back from the worker) all at once.
+def parse_workbook(file_path, documentName):
+    parsedWorkbook = {'document_name': documentName,
+                      'file_path': file_path,
+                      'data_file_name': os.path.basename(file_path),
+                      'metadata': None,
+                      'data_frames': [],
+                      'validation_reports': [],
+                      'error': None,
+                      'exception_type': None}
+    try:
+        if documentName in batchDocumentDict:
+            settings = batchDocumentDict[documentName]
+            df, validationReport = read_data_file(documentName, file_path, parsedWorkbook['data_file_name'],
+                                                  settings['index_column'], settings['verifyIntegrityFlag'],
+                                                  skiprows=settings['skiprows'])
+            parsedWorkbook['data_frames'].append(df)
+            parsedWorkbook['validation_reports'].append(validationReport)
+            return parsedWorkbook
+
+        classColumnList = assay_class_columns(documentName)
+        with WorkbookReader(file_path) as workbook:
+            metaDataDict = read_assay_metadata(workbook, new_metadata_dict())
+            parsedWorkbook['metadata'] = metaDataDict
+            for _, validationReport in prepare_assay_chunks(workbook, documentName, parsedWorkbook['data_file_name'],
+                                                            metaDataDict, classColumnList):
+                parsedWorkbook['validation_reports'].append(validationReport)
+    except Exception as e:  # Any problem with one file must not stop the rest of the batch
+        parsedWorkbook['data_frames'] = []
+        parsedWorkbook['error'] = str(e)  # Not the exception itself, which may not survive pickling
+        parsedWorkbook['exception_type'] = e.__class__.__name__
+
+    return parsedWorkbook
+
+
+# Log a batch import failure for one file
+def log_batch_import_error(active_account, parsedWorkbook, action, error, exception_type):
+    message = f"{action} of {parsedWorkbook['document_name']} data from " \
+              f"{parsedWorkbook['data_file_name']} resulted in exception: {error}"
+    svc.add_event_log(active_account,
+                      message,
+                      success=False,
+                      event_type='Import',
+                      exception_type=exception_type,
+                      file_name=parsedWorkbook['data_file_name'])
+    error_msg(message)
+
+
+# Save a parsed workbook. The data sheet of an assay workbook is read and saved a chunk at a time.
+def save_parsed_workbook(active_account, parsedWorkbook):
+    documentName = parsedWorkbook['document_name']
+    data_file_name = parsedWorkbook['data_file_name']
+    print(f' ******************** Import {documentName} data from {data_file_name} ******************** ')
+    try:
+        if documentName in batchDocumentDict:
+            for df in parsedWorkbook['data_frames']:
+                batchDocumentDict[documentName]['save'](active_account, df, data_file_name)
+            return
+
+        classColumnList = assay_class_columns(documentName)
+        with WorkbookReader(parsedWorkbook['file_path']) as workbook:
+            for df, _ in prepare_assay_chunks(workbook, documentName, data_file_name, parsedWorkbook['metadata'],
+                                              classColumnList):
+                save_assay_data(active_account, df, documentName, data_file_name, parsedWorkbook['metadata'])
+    except Exception as e:  # Any problem with one file must not stop the rest of the batch
+        log_batch_import_error(active_account, parsedWorkbook, 'Save', e, e.__class__.__name__)
+        error_msg('The rest of this file was not saved')
+
+
+# Files are read (earliest stage first) while earlier ones are being saved. At most
+# batch_import_max_parsed workbooks are being read, waiting to be saved, or being saved at any one time,
+# so memory use depends on that limit rather than on the size of the whole batch (an assay workbook
+# only holds one chunk of import_chunk_size rows at a time - see parse_workbook).
+# Workbooks of the same type update the same documents, so they are saved one at a time, in file order;
+# different types are saved in parallel. Each stage is finished before the next one starts.
+def batch_import(path, active_account, workers=None, writers=1):
+    fileList = find_batch_files(path)
+    if len(fileList) < 1:
+        error_msg(f'Error: No Excel files found in {path}')
+        return
+
+    try:
+        # Worker processes are spawned rather than forked: a forked worker would inherit the
+        # MongoDB client and the event log buffer's lock and thread, which aren't fork-safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as parsePool, \
+                ThreadPoolExecutor(max_workers=writers) as writePool:
+            fileQueue = []  # (stage, file path, document name), earliest stage first
+            for file_path, documentName in zip(fileList, parsePool.map(classify_workbook, fileList)):
+                stage = batch_import_stage(documentName)
+                if stage is None:
+                    error_msg(f'Skipping {file_path}: unable to tell what kind of data it holds')
+                    continue
+                fileQueue.append((stage, file_path, documentName))
+            fileQueue = deque(sorted(fileQueue, key=lambda f: f[0]))  # Files stay in order within a stage
+
+            saveOrderDict = {}  # (stage, document name) -> files still to be saved, in file order
+            for stage, file_path, documentName in fileQueue:
+                saveOrderDict.setdefault((stage, documentName), deque()).append(file_path)
+
+            maxParsed = max(1, set_up_globals.batch_import_max_parsed)
+            parseFutureDict = {}  # Future -> (stage, file path, document name)
+            parsedDict = {}  # File path -> parsed workbook waiting to be saved
+            writeFutureDict = {}  # Future -> (stage, document name, file path)
+            while len(saveOrderDict) > 0:
+                # Read ahead, up to the limit
+                while len(fileQueue) > 0 and len(parseFutureDict) + len(parsedDict) + len(writeFutureDict) < maxParsed:
+                    stage, file_path, documentName = fileQueue.popleft()
+                    future = parsePool.submit(parse_workbook, file_path, documentName)
+                    parseFutureDict[future] = (stage, file_path, documentName)
+
+                # Start saving the next workbook of each type in the current stage, once it has been read
+                currentStage = min(stage for stage, _ in saveOrderDict)
+                savingSet = {(stage, documentName) for stage, documentName, _ in writeFutureDict.values()}
+                for (stage, documentName), fileOrder in saveOrderDict.items():
+                    if stage == currentStage and (stage, documentName) not in savingSet and fileOrder[0] in parsedDict:
+                        future = writePool.submit(save_parsed_workbook, active_account, parsedDict.pop(fileOrder[0]))
+                        writeFutureDict[future] = (stage, documentName, fileOrder[0])
+
+                if len(parseFutureDict) + len(writeFutureDict) < 1:
+                    error_msg('Error: batch import stalled')  # Shouldn't happen - the next file is always in hand
+                    break
+
+                doneSet, _ = wait(list(parseFutureDict) + list(writeFutureDict), return_when=FIRST_COMPLETED)
+                for future in doneSet:
+                    if future in writeFutureDict:
+                        stage, documentName, file_path = writeFutureDict.pop(future)
+                        future.result()
+                        remove_batch_file(saveOrderDict, stage, documentName, file_path)
+                        continue
+
+                    stage, file_path, documentName = parseFutureDict.pop(future)
+                    try:
+                        parsedWorkbook = future.result()
+                    except Exception as e:  # e.g. the worker process died
+                        parsedWorkbook = {'document_name': documentName,
+                                          'data_file_name': os.path.basename(file_path),
+                                          'validation_reports': [],
+                                          'error': str(e),
+                                          'exception_type': e.__class__.__name__}
+                    for validationReport in parsedWorkbook['validation_reports']:
+                        print_validation_report(validationReport)
+
+                    if parsedWorkbook['error'] is not None:
+                        log_batch_import_error(active_account, parsedWorkbook, 'Read', parsedWorkbook['error'],
+                                               parsedWorkbook['exception_type'])
+                        error_msg('No data saved')
+                        remove_batch_file(saveOrderDict, stage, documentName, file_path)
+                        continue
+                    parsedDict[file_path] = parsedWorkbook
+    finally:
+        # Write out the event log even if the batch was stopped part way through
+        svc.flush_event_log()
+    success_msg(f'Batch import of {len(fileList)} files from {path} finished')
+
+
+# Take a file that has been saved (or couldn't be read) off the list of files to save
+def remove_batch_file(saveOrderDict, stage, documentName, file_path):
+    fileOrder = saveOrderDict[(stage, documentName)]
+    fileOrder.remove(file_path)
+    if len(fileOrder) < 1:
+        del saveOrderDict[(stage, documentName)]
+
+
 def test_pathway_mapping():
     print(' ********************     Test pathway mapping     ******************** ')
 
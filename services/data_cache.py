@@ -0,0 +1,150 @@
+# Shared, lazily-built cache of the data frames used by the Dash pages.
+# Each dataset is registered with a builder function and is only queried and built the first
+# time a page asks for it. Entries are kept in a size-bounded LRU and expire after ttl seconds.
+# Each entry also records the dataset version (svc.cached_dataset_version) it was built from, and is
+# rebuilt as soon as new data has been imported; refresh() drops one (or all) of them explicitly.
+# Cached data frames are shared between pages and callbacks, so treat them as read-only.
+
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+import services.data_service as svc
+from data.clinical_data import ClinicalData
+from data.assay_classes import Proteomic
+from data.assay_classes import Cytokine
+from data.assay_classes import Metabolomic
+from data.scrnaseq_summary import ScRNAseqSummary
+
+import set_up_globals
+import utilities
+
+
+class DataCache:
+    def __init__(self, max_size=8, ttl=600, dataset_version=None):
+        self.max_size = max_size
+        self.ttl = ttl  # Seconds, or None for no expiry
+        self.dataset_version = dataset_version  # Function returning the current dataset version
+        self.version = 0  # Incremented every time the cache is refreshed
+        self._builders = {}
+        self._entries = OrderedDict()  # Dataset name -> (time built, dataset version, value), least recently used first
+        self._lock = threading.RLock()
+        self._build_locks = {}  # Make sure each dataset is only built by one thread at a time
+
+    def register(self, name, builder):
+        with self._lock:
+            self._builders[name] = builder
+            self._entries.pop(name, None)
+
+    def get(self, name):
+        datasetVersion = self.dataset_version() if self.dataset_version is not None else None
+        value = self._get_entry(name, datasetVersion)
+        if value is not None:
+            return value
+
+        with self._lock:
+            if name not in self._builders:
+                raise KeyError(f'No data cache builder registered for {name}')
+            buildLock = self._build_locks.setdefault(name, threading.Lock())
+            builder = self._builders[name]
+
+        with buildLock:
+            # Another thread may have built the dataset while we were waiting
+            value = self._get_entry(name, datasetVersion)
+            if value is not None:
+                return value
+
+            value = builder()
+            with self._lock:
+                self._entries[name] = (time.time(), datasetVersion, value)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def refresh(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+            self.version += 1
+
+    def _get_entry(self, name, datasetVersion):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if (self.ttl is not None and time.time() - entry[0] > self.ttl) or entry[1] != datasetVersion:
+                del self._entries[name]
+                return None
+            self._entries.move_to_end(name)
+            return entry[2]
+
+
+# Build a data frame (and list of data labels) from one type of sub-document. If the assay results
+# are stored as blocks (set_up_globals.assay_results_storage), they are read from the blocks.
+def build_sub_document_data_frame(dataClass, subDocumentName, assayResultsFlag=False):
+    columnarStorage = assayResultsFlag and set_up_globals.assay_results_storage == 'columnar'
+    data_list = svc.find_sub_document_data_as_dicts([subDocumentName])
+    df, dataLabelList = utilities.create_df_from_object_list(data_list, [dataClass], [subDocumentName],
+                                                             assayResultsFlag=assayResultsFlag and not columnarStorage)
+    if columnarStorage:
+        df, dataLabelList = add_assay_result_block_columns(df, subDocumentName)
+
+    return add_page_columns(df), dataLabelList
+
+
+# Add one column per data label from the assay result blocks of a sub-document. Each sub-document row
+# gets the results of its own dataset; if it has blocks for more than one data label type, they are combined.
+def add_assay_result_block_columns(df, subDocumentName):
+    blockDF = svc.find_assay_results_data_frame(subDocumentName)
+    if len(blockDF) < 1:
+        return df, []
+
+    keyColumns = ['study_id', 'unique_id', 'dataset_name']
+    blockDF = blockDF.drop(columns=['timepoint', 'data_label_type']).rename_axis('unique_id').reset_index()
+    blockDF = blockDF.groupby(keyColumns, dropna=False, sort=False).last().reset_index()
+    dataLabelList = [column for column in blockDF.columns if column not in keyColumns]
+
+    return df.merge(blockDF, on=keyColumns, how='left'), dataLabelList
+
+
+# Build a data frame of the demographic data only (one row per study id).
+# Returns an empty list of data labels, to match the other datasets.
+def build_demographic_data_frame():
+    columns = svc.get_demographic_data_fields()
+    dbFields = [utilities.db_field_name(ClinicalData, column) for column in columns]
+    data = [[d.get(dbField) for dbField in dbFields] for d in svc.find_demographic_data_as_dicts()]
+    df = pd.DataFrame(data, columns=columns)
+
+    return add_page_columns(df), []
+
+
+def add_page_columns(df):
+    # Creating an ID column name gives us more interactive capabilities
+    df['id'] = df['study_id']
+    df.set_index('id', inplace=True, drop=False)
+
+    # Age as a number, for the age range sliders
+    if 'age' in df.columns:
+        df['numeric_age'] = pd.to_numeric(df['age'], errors='coerce')
+
+    return df
+
+
+data_cache = DataCache(max_size=set_up_globals.data_cache_max_size, ttl=set_up_globals.data_cache_ttl,
+                       dataset_version=svc.cached_dataset_version)
+
+data_cache.register('demographic', build_demographic_data_frame)
+data_cache.register('proteomic', functools.partial(build_sub_document_data_frame, Proteomic, 'proteomic'))
+data_cache.register('cytokine', functools.partial(build_sub_document_data_frame, Cytokine, 'cytokine',
+                                                  assayResultsFlag=True))
+data_cache.register('metabolomic', functools.partial(build_sub_document_data_frame, Metabolomic, 'metabolomic',
+                                                     assayResultsFlag=True))
+data_cache.register('scrnaseq_summary', functools.partial(build_sub_document_data_frame, ScRNAseqSummary,
+                                                          'scrnaseq_summary'))
@@ -9,10 +9,21 @@
 
 
 from typing import List, Optional
+import atexit
 import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
 
 from colorama import Fore
 from mongoengine import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from data.clinical_data import ClinicalData, ClinicalDataVersionHistory
 from data.redcap import Redcap
@@ -24,6 +35,7 @@ from data.biospecimens import Biospecimen, BiospecimenVersionHistory, Biospecime
 from data.users import User
 from data.event_log import Event_log
 from data.assay_results import AssayResults
+from data.assay_result_blocks import AssayResultBlock
 from data.data_label_types import DataLabels
 from data.data_label_types import DataLabelPathways
 # from data.data_label_types import GeneSymbols
@@ -32,10 +44,18 @@ from data.data_label_types import DataLabelPathways
 # from data.data_label_types import CytokineLabels
 # from data.data_label_types import GeneSymbolsToEnsemblGeneIDs
 from mongoengine.queryset.visitor import Q
+from services.event_log_buffer import EventLogBuffer
+import services.version_history as version_history
 
 import set_up_globals
 import utilities
 
+# Event log entries are buffered and written in batches, rather than one save per entry.
+# Anything still in the buffer is written when the process exits.
+event_log_buffer = EventLogBuffer(flush_size=set_up_globals.event_log_flush_size,
+                                  flush_interval=set_up_globals.event_log_flush_interval)
+atexit.register(event_log_buffer.close)
+
 
 def get_users() -> List[User]:
     users = User.objects().all()
@@ -75,6 +95,43 @@ def find_biospecimen_data_by_study_id(study_id: int) -> List[Biospecimen]:
     return list(Biospecimen.objects(study_id=study_id).all())
 
 
+# Fetch all of the biospecimens needed by an import with a single query, rather than one query per row.
+# Returns a dict of specimen_id -> Biospecimen, and a dict of study_id -> list of Biospecimens
+# (the second one only for the study ids asked for).
+def find_biospecimen_maps(specimen_ids=None, study_ids=None):
+    specimenIdSet = {str(specimen_id) for specimen_id in (specimen_ids if specimen_ids is not None else [])}
+    studyIdSet = {int(study_id) for study_id in (study_ids if study_ids is not None else [])}
+    conditionList = []
+    if len(specimenIdSet) > 0:
+        conditionList.append({'specimen_id': {'$in': list(specimenIdSet)}})
+    if len(studyIdSet) > 0:
+        conditionList.append({'study_id': {'$in': list(studyIdSet)}})
+
+    biospecimenDict = {}
+    biospecimenStudyDict = {study_id: [] for study_id in studyIdSet}
+    if len(conditionList) < 1:
+        return biospecimenDict, biospecimenStudyDict
+
+    for biospecimen_data in Biospecimen.objects(__raw__={'$or': conditionList}):
+        if biospecimen_data.specimen_id in specimenIdSet:
+            biospecimenDict.setdefault(biospecimen_data.specimen_id, biospecimen_data)
+        if biospecimen_data.study_id in studyIdSet:
+            biospecimenStudyDict[biospecimen_data.study_id].append(biospecimen_data)
+
+    return biospecimenDict, biospecimenStudyDict
+
+
+# Specimen ID of the biospecimen for a row of assay data
+def assay_specimen_id(study_id, timepoint, biospecimen_type):
+    return str(int(float(study_id))) + '-' + timepoint + '-' + biospecimen_type
+
+
+# Specimen ID of the biospecimen for a row of scRNA-seq data (the sample name minus its tube number)
+def scrnaseq_specimen_id(sample_name):
+    valMinusTubeNumberList = sample_name.split('-')[0:4]
+    return '-'.join(valMinusTubeNumberList)
+
+
 def find_cytokine_data() -> List[ClinicalData]:
     return list(ClinicalData.objects(cytokine__unique_id__exists=True).all().order_by('phenotype'))
 
@@ -113,10 +170,247 @@ def find_scrnaseq_summary_data_only() -> List[ClinicalData]:
     #                                                               'age', 'scrnaseq_summary').order_by('phenotype'))
 
 
+# Return the demographic data plus the given sub-documents (e.g. ['proteomic']) as raw (pymongo)
+# dictionaries, for building data frames without the cost of creating mongoengine documents
+def find_sub_document_data_as_dicts(subDocumentList) -> List[dict]:
+    projection = {ClinicalData._fields[f].db_field: 1
+                  for f in ClinicalData.get_demographic_attributes() if f in ClinicalData._fields}
+    for subDocument in subDocumentList:
+        projection[subDocument] = 1
+
+    return list(ClinicalData._get_collection().find({}, projection).sort('phenotype', 1))
+
+
+# Return only the demographic fields, as raw (pymongo) dictionaries, for pages that don't need any
+# assay data (so that none of the assay_results arrays are read from the database)
+def find_demographic_data_as_dicts() -> List[dict]:
+    return find_sub_document_data_as_dicts([])
+
+
 def find_pathway_data(pathway_name: str) -> DataLabelPathways:
     return DataLabelPathways.objects(pathway_name=pathway_name).first()
 
 
+# Demographic fields that are returned with aggregated data (references and audit fields are left out)
+def get_demographic_data_fields() -> List[str]:
+    excludeFields = ['created_by', 'last_modified_by', 'created_date', 'last_modified_date',
+                     'biospecimen_data_references']
+    return [f for f in ClinicalData.get_demographic_attributes()
+            if f not in excludeFields and f in ClinicalData._fields]
+
+
+def find_pathway_names() -> List[str]:
+    return sorted(DataLabelPathways.objects().distinct('pathway_name'))
+
+
+# Score samples from one or more assays (proteomic and cytokine by default) over the data labels in a pathway,
+# optionally only for some timepoints. The pathway filter, normalization, and aggregation are all done in MongoDB:
+#  - each result is divided by the sum of that data label over all samples of the same assay
+#  - aggregated_result is the average normalized result for each sample
+#  - <assay>_aggregated_result is filled in for every sample from the samples of that assay
+#    with the same study ID and timepoint (averaged if there is more than one)
+# Returns one row per sample, with the demographic data and sample metadata needed for plotting.
+# If the assay results are stored as blocks (set_up_globals.assay_results_storage), the packed results
+# can't be read by the aggregation, so the same scores are computed from the blocks in pandas instead.
+# Use pathway_scores (below), which caches the results, rather than calling this directly.
+def find_pathway_scores(pathway_name, subDocumentList=('proteomic', 'cytokine'), timepoints=None) -> pd.DataFrame:
+    sampleFields = ['unique_id', 'timepoint', 'assay_type', 'assay_method', 'biospecimen_type', 'dataset_name']
+    demographicFields = get_demographic_data_fields()
+    aggregatedResultFields = [subDocument + '_aggregated_result' for subDocument in subDocumentList]
+    columns = demographicFields + sampleFields + ['aggregated_result'] + aggregatedResultFields
+
+    pathwayDataLabelIDs = list(utilities.pathway_data_label_ids(find_pathway_data(pathway_name)))
+    if len(pathwayDataLabelIDs) < 1:
+        return pd.DataFrame(columns=columns)
+
+    if set_up_globals.assay_results_storage == 'columnar':
+        sampleDF = find_pathway_block_scores(pathwayDataLabelIDs, subDocumentList, timepoints, sampleFields)
+    else:
+        pipeline = pathway_scores_pipeline(pathwayDataLabelIDs, subDocumentList, timepoints, sampleFields)
+        sampleDF = pd.DataFrame(list(ClinicalData._get_collection().aggregate(pipeline, allowDiskUse=True)),
+                                columns=['document_id', 'aggregated_result'] + sampleFields + aggregatedResultFields)
+    if len(sampleDF) < 1:
+        return pd.DataFrame(columns=columns)
+
+    # Add the demographic data (one small document per study)
+    projection = {ClinicalData._fields[f].db_field: 1 for f in demographicFields}
+    demographicDF = pd.DataFrame([{f: d.get(ClinicalData._fields[f].db_field) for f in demographicFields + ['id']}
+                                  for d in ClinicalData._get_collection().find(
+                                      {'_id': {'$in': sampleDF['document_id'].unique().tolist()}}, projection)],
+                                 columns=demographicFields + ['id'])
+    df = sampleDF.merge(demographicDF, left_on='document_id', right_on='id', how='inner')
+
+    return df.sort_values(['phenotype', 'study_id', 'timepoint']).reset_index(drop=True)[columns]
+
+
+# The aggregation pipeline of find_pathway_scores, which returns the per-sample scores
+def pathway_scores_pipeline(pathwayDataLabelIDs, subDocumentList, timepoints, sampleFields) -> List[dict]:
+    return [
+        # Put the sub-documents for all assays in one list, tagged with the assay they came from
+        {'$project': {'sub_documents': {'$concatArrays': [
+            {'$map': {'input': {'$ifNull': ['$' + subDocument, []]},
+                      'as': 'sd',
+                      'in': {'$mergeObjects': ['$$sd', {'sub_document': subDocument}]}}}
+            for subDocument in subDocumentList]}}},
+        {'$unwind': '$sub_documents'},
+        {'$match': {} if timepoints is None else {'sub_documents.timepoint': {'$in': list(timepoints)}}},
+        {'$unwind': '$sub_documents.assay_results'},
+        {'$match': {'sub_documents.assay_results.data_label_reference': {'$in': pathwayDataLabelIDs},
+                    'sub_documents.assay_results.result': {'$type': 'number', '$ne': float('nan')}}},
+
+        # Normalize each data label by its sum over all samples of the same assay
+        {'$group': {'_id': {'sub_document': '$sub_documents.sub_document',
+                            'data_label': '$sub_documents.assay_results.data_label'},
+                    'label_sum': {'$sum': '$sub_documents.assay_results.result'},
+                    'results': {'$push': dict({'document_id': '$_id',
+                                               'result': '$sub_documents.assay_results.result'},
+                                              **{f: '$sub_documents.' + f for f in sampleFields})}}},
+        {'$unwind': '$results'},
+        {'$project': {'_id': 0,
+                      'sub_document': '$_id.sub_document',
+                      'sample': '$results',
+                      'normalized_result': {'$cond': [{'$gt': ['$label_sum', 0]},
+                                                      {'$divide': ['$results.result', '$label_sum']},
+                                                      '$results.result']}}},
+
+        # Average the normalized results for each sample
+        {'$group': {'_id': {'document_id': '$sample.document_id',
+                            'sub_document': '$sub_document',
+                            'unique_id': '$sample.unique_id'},
+                    'sample': {'$first': '$sample'},
+                    'aggregated_result': {'$avg': '$normalized_result'}}},
+
+        # Share each assay's aggregated result between samples with the same study and timepoint
+        {'$group': dict({'_id': {'document_id': '$_id.document_id', 'timepoint': '$sample.timepoint'},
+                         'samples': {'$push': {'sub_document': '$_id.sub_document',
+                                               'sample': '$sample',
+                                               'aggregated_result': '$aggregated_result'}}},
+                        **{subDocument + '_aggregated_result':
+                           {'$avg': {'$cond': [{'$eq': ['$_id.sub_document', subDocument]},
+                                               '$aggregated_result', None]}}
+                           for subDocument in subDocumentList})},
+        {'$unwind': '$samples'},
+        {'$project': dict({'_id': 0,
+                           'document_id': '$_id.document_id',
+                           'aggregated_result': '$samples.aggregated_result'},
+                          **{f: '$samples.sample.' + f for f in sampleFields},
+                          **{subDocument + '_aggregated_result':
+                             {'$cond': [{'$eq': ['$samples.sub_document', subDocument]},
+                                        '$samples.aggregated_result',
+                                        '$' + subDocument + '_aggregated_result']}
+                             for subDocument in subDocumentList})},
+    ]
+
+
+# The per-sample scores of find_pathway_scores (the output of its aggregation pipeline), computed from
+# assay result blocks. Each sub-document is scored from the block(s) of its own dataset.
+def find_pathway_block_scores(pathwayDataLabelIDs, subDocumentList, timepoints, sampleFields) -> pd.DataFrame:
+    columns = ['document_id', 'aggregated_result'] + sampleFields + \
+              [subDocument + '_aggregated_result' for subDocument in subDocumentList]
+    pathwayDataLabels = {(d['data_label_type'], d['data_label']) for d in DataLabels._get_collection().find(
+        {'_id': {'$in': pathwayDataLabelIDs}}, {'data_label_type': 1, 'data_label': 1})}
+
+    resultList = []
+    for subDocument in subDocumentList:
+        # Sample metadata, without reading any assay_results arrays
+        projection = {f'{subDocument}.{f}': 1 for f in sampleFields}
+        projection['study_id'] = 1
+        sampleDict = {}
+        for d in ClinicalData._get_collection().find({}, projection):
+            for sd in d.get(subDocument) or []:
+                sampleDict[(d['study_id'], sd.get('unique_id'), sd.get('dataset_name'))] = dict(sd, document_id=d['_id'])
+
+        for block in find_assay_result_blocks(subDocument):
+            sample = sampleDict.get((block['study_id'], block['unique_id'], block.get('dataset_name')))
+            if sample is None or (timepoints is not None and sample.get('timepoint') not in timepoints):
+                continue
+            for data_label, result in zip(block.get('data_labels', []), unpack_assay_results(block.get('results'))):
+                if (block['data_label_type'], data_label) in pathwayDataLabels and not np.isnan(result):
+                    resultList.append(dict({f: sample.get(f) for f in sampleFields},
+                                           document_id=sample['document_id'],
+                                           sub_document=subDocument,
+                                           data_label=data_label,
+                                           result=result))
+
+    if len(resultList) < 1:
+        return pd.DataFrame(columns=columns)
+
+    # Normalize each data label by its sum over all samples of the same assay
+    resultDF = pd.DataFrame(resultList)
+    labelSum = resultDF.groupby(['sub_document', 'data_label'])['result'].transform('sum')
+    resultDF['normalized_result'] = resultDF['result'].where(labelSum <= 0, resultDF['result'] / labelSum)
+
+    # Average the normalized results for each sample
+    sampleDF = resultDF.groupby(['document_id', 'sub_document', 'unique_id'], dropna=False, sort=False).agg(
+        dict({'normalized_result': 'mean'}, **{f: 'first' for f in sampleFields if f != 'unique_id'})).reset_index()
+    sampleDF = sampleDF.rename(columns={'normalized_result': 'aggregated_result'})
+
+    # Share each assay's aggregated result between samples with the same study and timepoint
+    for subDocument in subDocumentList:
+        column = subDocument + '_aggregated_result'
+        assayDF = sampleDF[sampleDF['sub_document'] == subDocument].groupby(
+            ['document_id', 'timepoint'], dropna=False)['aggregated_result'].mean().rename(column).reset_index()
+        sampleDF = sampleDF.merge(assayDF, on=['document_id', 'timepoint'], how='left')
+        ownAssay = sampleDF['sub_document'] == subDocument
+        sampleDF.loc[ownAssay, column] = sampleDF.loc[ownAssay, 'aggregated_result']
+
+    return sampleDF[columns]
+
+
+# The dataset version is the time of the most recent successful import, so
+# cached results are recalculated whenever new data has been imported
+def find_dataset_version():
+    flush_event_log()
+    event_log_data = Event_log._get_collection().find_one({'event_type': 'Import', 'success': True},
+                                                          {'created_date': 1},
+                                                          sort=[('created_date', -1)])
+    return event_log_data['created_date'] if event_log_data else None
+
+
+_dataset_version_cache = {}  # 'time' -> when the version was read, 'version' -> dataset version
+_dataset_version_lock = threading.Lock()
+
+
+# Dataset version for the Dash page caches, re-read at most every dataset_version_ttl seconds,
+# so that a cache hit doesn't cost a round trip to the database
+def cached_dataset_version():
+    with _dataset_version_lock:
+        if 'time' in _dataset_version_cache and \
+                time.time() - _dataset_version_cache['time'] < set_up_globals.dataset_version_ttl:
+            return _dataset_version_cache['version']
+
+        _dataset_version_cache['version'] = find_dataset_version()
+        _dataset_version_cache['time'] = time.time()
+        return _dataset_version_cache['version']
+
+
+_pathway_scores_cache = OrderedDict()  # (pathway, assays, timepoints, dataset version) -> data frame
+_pathway_scores_cache_lock = threading.Lock()
+
+
+# Cached version of find_pathway_scores, so that switching between pathways (or back to
+# a previous one) does not re-read the assay data. The data frames returned are shared, so
+# treat them as read-only.
+def pathway_scores(pathway_name, assays=('proteomic', 'cytokine'), timepoints=None) -> pd.DataFrame:
+    assays = tuple(assays)
+    timepoints = None if timepoints is None else tuple(sorted(timepoints))
+    key = (pathway_name, assays, timepoints, cached_dataset_version())
+
+    with _pathway_scores_cache_lock:
+        if key in _pathway_scores_cache:
+            _pathway_scores_cache.move_to_end(key)
+            return _pathway_scores_cache[key]
+
+    df = find_pathway_scores(pathway_name, subDocumentList=assays, timepoints=timepoints)
+
+    with _pathway_scores_cache_lock:
+        _pathway_scores_cache[key] = df
+        while len(_pathway_scores_cache) > set_up_globals.pathway_scores_cache_size:
+            _pathway_scores_cache.popitem(last=False)
+
+    return df
+
+
 def test_pathway_mapping() -> List[ClinicalData]:
     # pathway = DataLabelPathways.objects(pathway_name=pathway_name).first()
     # print('pathway_labels:', pathway.data_label_references)
@@ -145,14 +439,62 @@ def convert_to_string(val):
         return str(val)
 
 
+# Vectorized version of convert_to_string for a whole column (numbers become
+# integer strings, e.g. 101.0 -> '101', and anything else is left as a string)
+def convert_series_to_string(series):
+    numericSeries = pd.to_numeric(series, errors='coerce')
+    integerStrings = numericSeries.fillna(0).astype('int64').astype(str)
+    return integerStrings.where(numericSeries.notna(), series.astype(str))
+
+
+# Fingerprint of a normalized spreadsheet row, stored with each record as content_hash so that rows which
+# haven't changed since the last import can be skipped. extra holds anything else that ends up in the record
+# (e.g. metadata, or references to biospecimens). The file name isn't included, so the same data
+# re-imported from a new file counts as unchanged.
+def row_content_hash(row, extra=None):
+    rowData = {str(column): '' if isinstance(value, float) and np.isnan(value) else str(value)
+               for column, value in row.items() if column != 'data_file_name'}
+    content = json.dumps([rowData, extra], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+# Log (once per import) how many rows were skipped because they haven't changed. This is logged as an
+# 'Unchanged' event rather than an 'Import', so that it doesn't count as a new dataset version.
+def log_unchanged_rows(active_account: User, documentName, data_file_name, unchangedCount):
+    if unchangedCount < 1:
+        return
+
+    message = f'Skipped {unchangedCount} unchanged {documentName} rows in {data_file_name}.'
+    add_event_log(active_account,
+                  message,
+                  success=True,
+                  event_type='Unchanged',
+                  file_name=data_file_name)
+    success_msg(message)
+
+
 # def add_clinical_data(active_account: User, biospecimen_data_list, index, row) -> ClinicalData:
 def add_clinical_data(active_account: User, df, data_file_name):  # -> ClinicalData:
     documentName = set_up_globals.clinical_document_name
+    unchangedCount = 0
+
+    # Biospecimens for every clinical record in the spreadsheet, fetched in one query
+    _, biospecimenStudyDict = find_biospecimen_maps(study_ids=df.index)
 
     for index, row in df.iterrows():
         currentVersion = 0
+        previousDocument = None
         clinical_data = find_clinical_data_by_study_id(row.study_id)
 
+        # Get list of biospecimens for this clinical record
+        biospecimen_data_list = biospecimenStudyDict.get(int(index), [])
+
+        # Skip rows that haven't changed, without adding to the version history
+        contentHash = row_content_hash(row, [str(b.id) for b in biospecimen_data_list])
+        if clinical_data and clinical_data.content_hash == contentHash:
+            unchangedCount += 1
+            continue
+
         if clinical_data:
             # If data exists, save in version history
             #     Update version history before current version
@@ -164,24 +506,25 @@ def add_clinical_data(active_account: User, df, data_file_name):  # -> ClinicalD
             # //--- run full flow to make sure clean up works correctly
 
             currentVersion = clinical_data.version_number
-            clinical_data_version_history = ClinicalDataVersionHistory()
+            if set_up_globals.version_history_mode == 'delta':
+                # Recorded as a diff just before the save, below
+                previousDocument = clinical_data.to_mongo().to_dict()
+            else:
+                clinical_data_version_history = ClinicalDataVersionHistory()
 
-            attributeList = utilities.attributes(ClinicalData)
-            # print(attributeList)
-            for attrib in attributeList:
-                # print(attrib)
-                clinical_data_version_history[attrib] = clinical_data[attrib]
+                attributeList = utilities.attributes(ClinicalData)
+                # print(attributeList)
+                for attrib in attributeList:
+                    # print(attrib)
+                    clinical_data_version_history[attrib] = clinical_data[attrib]
 
-            clinical_data_version_history.save()
+                clinical_data_version_history.save()
         else:
             # If no data exists for this study id, set created info
             clinical_data = ClinicalData()
             clinical_data.created_by = active_account
             clinical_data.created_date = datetime.datetime.now()
 
-        # Get list of biospecimens for this clinical record
-        biospecimen_data_list = find_biospecimen_data_by_study_id(index)
-
         clinical_data.last_modified_by = active_account
         clinical_data.last_modified_date = datetime.datetime.now()
         clinical_data.study_id = index
@@ -211,9 +554,18 @@ def add_clinical_data(active_account: User, df, data_file_name):  # -> ClinicalD
         clinical_data.at1 = convert_to_string(row.at1)
         clinical_data.at2 = convert_to_string(row.at2)
         clinical_data.atchange = convert_to_string(row.atchange)
+        clinical_data.content_hash = contentHash
 
         try:
+            if previousDocument is not None:
+                version_history.record_version(active_account, 'demographic', clinical_data.id, previousDocument,
+                                               currentVersion, clinical_data.to_mongo().to_dict(),
+                                               clinical_data.version_number)
             clinical_data.save()
+            if set_up_globals.version_history_mode == 'delta' and currentVersion == 0:
+                # New documents only have an id once saved
+                version_history.record_version(active_account, 'demographic', clinical_data.id, None, 0,
+                                               clinical_data.to_mongo().to_dict(), clinical_data.version_number)
         except (ValueError, ValidationError) as e:
             message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
             add_event_log(active_account,
@@ -236,11 +588,25 @@ def add_clinical_data(active_account: User, df, data_file_name):  # -> ClinicalD
                       document_id=str(clinical_data.id))
         success_msg(message)
 
+    log_unchanged_rows(active_account, documentName, data_file_name, unchangedCount)
+
     return  # clinical_data
 
 
+# Build a dictionary of sub-documents keyed on one of their fields (e.g. unique_id or sampleid),
+# so that existing rows can be matched in constant time rather than by scanning the whole list
+def index_sub_documents(subDocumentList, keyField):
+    return {sd[keyField]: sd for sd in subDocumentList}
+
+
+# Build a dictionary of assay results keyed on (data_label_type, data_label)
+def index_assay_results(assayResultsList):
+    return {(a.data_label_type, a.data_label): a for a in assayResultsList}
+
+
 # Add data that is common to each class (proteomic, cytokines, etc.)
-def add_common_data(active_account: User, row, dataClass, metaDataDict):
+# If includeAssayResults is False, only the metadata is set (used when assay results are stored in blocks)
+def add_common_data(active_account: User, row, dataClass, metaDataDict, includeAssayResults=True):
     dataClass.last_modified_by = active_account
     dataClass.last_modified_date = datetime.datetime.now()
     dataClass.data_file_name = row.data_file_name
@@ -307,7 +673,15 @@ def add_common_data(active_account: User, row, dataClass, metaDataDict):
             and metaDataDict['pipeline'].strip().lower() != 'nan':
         dataClass.pipeline = metaDataDict['pipeline'].strip()
 
+    if not includeAssayResults:
+        return dataClass
+
     # Add assay results to data as a subdocument
+    # Existing results are looked up by (data_label_type, data_label), so
+    # re-importing a wide spreadsheet does not rescan the results for every column
+    data_label_type = metaDataDict['data_label_type'].strip()
+    assayResultsDict = index_assay_results(dataClass.assay_results)
+
     # Data labels (e.g. gene symbols) start at column 6.
     # Subtract 3 from end to account for data_file_name, study_id, and unique_id
     for i in range(6, len(row) - 3):
@@ -317,28 +691,22 @@ def add_common_data(active_account: User, row, dataClass, metaDataDict):
         #     print(data_label, result)
 
         # Is this a new or existing assay result for this gene symbol?
-        assay_results: Optional[AssayResults] = None
-        newAssayResults = True
-
-        for a in dataClass.assay_results:
-            if a.data_label == data_label and a.data_label_type == metaDataDict['data_label_type'].strip():
-                assay_results = a
-                newAssayResults = False
-                break
+        assay_results: Optional[AssayResults] = assayResultsDict.get((data_label_type, data_label))
+        newAssayResults = assay_results is None
 
         if not assay_results:
             assay_results = AssayResults()
-            assay_results.data_label_type = metaDataDict['data_label_type'].strip()
+            assay_results.data_label_type = data_label_type
             assay_results.data_label = data_label
 
         assay_results.result = result
 
-        data_label_ref = find_data_label_reference(data_label, metaDataDict['data_label_type'].strip())
+        data_label_ref = resolve_data_label(data_label, data_label_type)
         if data_label_ref:
             assay_results.data_label_reference = data_label_ref
         else:
             # Flag error if gene symbol does not exist
-            message = f"Error in save of assay data: {metaDataDict['data_label_type'].strip()} {data_label} not found"
+            message = f"Error in save of assay data: {data_label_type} {data_label} not found"
             add_event_log(active_account,
                           message,
                           success=False,
@@ -368,10 +736,104 @@ def add_common_data(active_account: User, row, dataClass, metaDataDict):
 
         if newAssayResults:
             dataClass.assay_results.append(assay_results)
+            assayResultsDict[(data_label_type, data_label)] = assay_results
 
     return dataClass
 
 
+# Split one spreadsheet row of assay data into its data labels and results.
+# Data labels (e.g. gene symbols) start at column 6; the last 3 columns are data_file_name, study_id, and unique_id
+def get_row_assay_results(row):
+    data_labels = [str(data_label) for data_label in row.index[6:len(row) - 3]]
+    results = pd.to_numeric(pd.Series(row.values[6:len(row) - 3]), errors='coerce').to_numpy(dtype='<f8')
+    return data_labels, results
+
+
+# Assay result blocks store their results as packed little-endian float64 values
+def pack_assay_results(results) -> bytes:
+    return np.asarray(results, dtype='<f8').tobytes()
+
+
+def unpack_assay_results(packedResults) -> np.ndarray:
+    if not packedResults:
+        return np.empty(0, dtype='<f8')
+    return np.frombuffer(packedResults, dtype='<f8')
+
+
+# Flag any data labels that have not been imported yet. Used for block storage,
+# where the data labels are checked once per upload rather than once per row.
+def check_data_labels(active_account: User, data_labels, data_label_type, data_file_name):
+    for data_label in data_labels:
+        if not resolve_data_label(data_label, data_label_type):
+            message = f"Error in save of assay data: {data_label_type} {data_label} not found"
+            add_event_log(active_account,
+                          message,
+                          success=False,
+                          event_type='Import',
+                          file_name=data_file_name,
+                          sub_document_id=str(data_label))
+            error_msg(message)
+
+
+# Build the upsert for one sample's assay result block. Results for data labels that
+# are not in this row are kept from the existing block, so a partial re-import behaves
+# the same way as it does for embedded assay results.
+def build_assay_result_block_operation(active_account: User, row, assay_data, study_id, assay_type,
+                                       data_label_type, existingBlock=None) -> UpdateOne:
+    data_labels, results = get_row_assay_results(row)
+
+    if existingBlock:
+        resultsDict = dict(zip(existingBlock.get('data_labels', []), unpack_assay_results(existingBlock.get('results'))))
+        resultsDict.update(zip(data_labels, results))
+        data_labels = list(resultsDict.keys())
+        results = list(resultsDict.values())
+
+    now = datetime.datetime.now()
+    return UpdateOne({'study_id': study_id,
+                      'assay_type': assay_type,
+                      'data_label_type': data_label_type,
+                      'unique_id': str(assay_data.unique_id),
+                      'dataset_name': assay_data.dataset_name},
+                     {'$set': {'last_modified_by': active_account.id,
+                               'last_modified_date': now,
+                               'data_file_name': assay_data.data_file_name,
+                               'timepoint': assay_data.timepoint,
+                               'data_labels': data_labels,
+                               'results': pack_assay_results(results)},
+                      '$setOnInsert': {'created_by': active_account.id,
+                                       'created_date': now}},
+                     upsert=True)
+
+
+# Return assay result blocks as raw dictionaries (the results are still packed - see unpack_assay_results)
+def find_assay_result_blocks(assay_type, study_ids=None, data_label_type=None) -> List[dict]:
+    query = {'assay_type': assay_type}
+    if study_ids is not None:
+        query['study_id'] = {'$in': [int(study_id) for study_id in study_ids]}
+    if data_label_type is not None:
+        query['data_label_type'] = data_label_type
+
+    return list(AssayResultBlock._get_collection().find(query, {'created_by': 0, 'last_modified_by': 0}))
+
+
+# Return assay result blocks as a data frame, with one row per block (indexed by unique_id) and one
+# column per data label, after the study_id, timepoint, data_label_type, and dataset_name columns
+def find_assay_results_data_frame(assay_type, study_ids=None, data_label_type=None) -> pd.DataFrame:
+    blocks = find_assay_result_blocks(assay_type, study_ids=study_ids, data_label_type=data_label_type)
+    if len(blocks) < 1:
+        return pd.DataFrame()
+
+    df = pd.DataFrame([pd.Series(unpack_assay_results(block.get('results')),
+                                 index=block.get('data_labels', []),
+                                 name=block['unique_id']) for block in blocks])
+    df.insert(0, 'study_id', [block['study_id'] for block in blocks])
+    df.insert(1, 'timepoint', [block.get('timepoint') for block in blocks])
+    df.insert(2, 'data_label_type', [block['data_label_type'] for block in blocks])
+    df.insert(3, 'dataset_name', [block.get('dataset_name') for block in blocks])
+
+    return df
+
+
 def get_clinical_data_reference(active_account: User, documentName, study_id, data_file_name):
     clinical_data = find_clinical_data_by_study_id(study_id)
     if not clinical_data:
@@ -419,205 +881,229 @@ def save_clinical_data(active_account: User, clinical_data: ClinicalData, docume
     return
 
 
-def add_proteomic_data(active_account: User, df, data_file_name, metaDataDict):  # -> Proteomic:
-    documentName = set_up_globals.proteomics_document_name
-
-    for index, row in df.iterrows():
-        clinical_data = get_clinical_data_reference(active_account, documentName, row.study_id, data_file_name)
+# Import assay data (proteomic, cytokine, metabolomic, etc.) in batched mode. Rows are grouped by study ID,
+# all changes for a study are applied to its sub-document list in memory, and each study is then written
+# once as an UpdateOne operation. All of the updates are sent to the database in a single bulk_write.
+# If set_up_globals.assay_results_storage is 'columnar', the assay results themselves are written
+# to the assay_result_blocks collection (in a second bulk_write) instead of the sub-documents.
+def add_assay_data(active_account: User, df, data_file_name, metaDataDict, documentName, subDocumentName,
+                   dataClassType):
+    bulkOperationList = []
+    studyRowIndexList = []  # (clinical_data, study_id, list of row indexes) for each bulk operation
+    blockOperationList = []
+    blockRowIndexList = []  # Row index for each block operation
+    unchangedCount = 0
+
+    data_label_type = metaDataDict['data_label_type'].strip()
+    columnarStorage = set_up_globals.assay_results_storage == 'columnar'
+    uniqueIdField = utilities.db_field_name(dataClassType, 'unique_id')
+    existingBlockDict = {}
+    if columnarStorage and len(df) > 0:
+        check_data_labels(active_account, get_row_assay_results(df.iloc[0])[0], data_label_type, data_file_name)
+        studyIdList = [int(float(study_id)) for study_id in df['study_id'].unique()]
+        for block in find_assay_result_blocks(subDocumentName, study_ids=studyIdList, data_label_type=data_label_type):
+            existingBlockDict[(block['study_id'], block['unique_id'], block.get('dataset_name'))] = block
+
+    biospecimenDict, _ = find_biospecimen_maps(
+        specimen_ids=[assay_specimen_id(study_id, timepoint, metaDataDict['biospecimen_type'])
+                      for study_id, timepoint in zip(df['study_id'], df['timepoint'])])
+
+    # The ids the data labels resolve to are part of each row's content hash, so rows imported
+    # before their data labels existed are re-imported (and linked) once the labels have been loaded
+    dataLabelIdList = []
+    if len(df) > 0:
+        dataLabelIdList = [str(data_label_ref.id) if data_label_ref else None
+                           for data_label_ref in [resolve_data_label(data_label, data_label_type)
+                                                  for data_label in get_row_assay_results(df.iloc[0])[0]]]
+
+    for study_id, study_df in df.groupby('study_id', sort=False):
+        clinical_data = get_clinical_data_reference(active_account, documentName, study_id, data_file_name)
         if not clinical_data:
             continue  # Skip the rest of this loop
 
-        proteomic_data: Optional[Proteomic] = None
-        newRow = True
+        # Index existing rows once per study, rather than scanning the list for every spreadsheet row
+        subDocumentDict = index_sub_documents(clinical_data[subDocumentName], 'unique_id')
 
-        for b in clinical_data.proteomic:
-            if b.unique_id == index:
-                proteomic_data = b
-                newRow = False
-                break
+        rowIndexList = []
+        studyBlockOperationList = []
+        originalSubDocumentDict = {}  # Unique ID -> stored version of existing rows that failed validation
+        for index, row in study_df.iterrows():
+            assay_data = subDocumentDict.get(index)
+            newRow = assay_data is None
+            originalSubDocument = None if newRow else assay_data.to_mongo()
 
-        # If no data exists for this id, set created info
-        if not proteomic_data:
-            proteomic_data = Proteomic()
-            proteomic_data.created_by = active_account
-            proteomic_data.created_date = datetime.datetime.now()
+            # If no data exists for this id, set created info
+            if not assay_data:
+                assay_data = dataClassType()
+                assay_data.created_by = active_account
+                assay_data.created_date = datetime.datetime.now()
+
+            assay_data.unique_id = index
+
+            # Find associated biospecimens
+            specimen_id = assay_specimen_id(row.study_id, row.timepoint, metaDataDict['biospecimen_type'])
+            biospecimen_data = biospecimenDict.get(specimen_id)
+
+            # Skip rows that haven't changed since they were last imported
+            contentHash = row_content_hash(row, [metaDataDict,
+                                                 str(biospecimen_data.id) if biospecimen_data else None,
+                                                 set_up_globals.assay_results_storage,
+                                                 dataLabelIdList])
+            if not newRow and assay_data.content_hash == contentHash:
+                unchangedCount += 1
+                continue
 
-        proteomic_data.unique_id = index
+            if biospecimen_data:
+                assay_data.biospecimen_data_reference = biospecimen_data
 
-        # Find associated biospecimens
-        specimen_id = str(int(float(row.study_id))) + '-' + row.timepoint + '-' + metaDataDict['biospecimen_type']
-        biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
-        if biospecimen_data:
-            proteomic_data.biospecimen_data_reference = biospecimen_data
-
-        proteomic_data = add_common_data(active_account, row, proteomic_data, metaDataDict)
-
-        # //--- All of this code moved to add_common_data - remove after testing
-
-        # proteomic_data.last_modified_by = active_account
-        # proteomic_data.last_modified_date = datetime.datetime.now()
-        # proteomic_data.data_file_name = row.data_file_name
-        # # proteomic_data.excel_file_id = index
-        # # //--- proteomic_data.biospecimen_data_reference = biospecimen_data
-        # # proteomic_data.time = row.time
-        # # proteomic_data.cpet_day = row.cpet_day
-        # # proteomic_data.pre_post_cpet = row.pre_post_cpet
-        # # proteomic_data.run = row.run
-        # proteomic_data.timepoint = row.timepoint
-        # if len(str(row.annot_1).strip()) > 0 and str(row.annot_1).strip().lower() != 'nan':
-        #     proteomic_data.annot_1 = str(row.annot_1).strip()
-        # if len(str(row.annot_2).strip()) > 0 and str(row.annot_2).strip().lower() != 'nan':
-        #     proteomic_data.annot_2 = str(row.annot_2).strip()
-        # if len(str(row.annot_3).strip()) > 0 and str(row.annot_3).strip().lower() != 'nan':
-        #     proteomic_data.annot_3 = str(row.annot_3).strip()
-        #
-        # # Add assay results to data as a subdocument
-        # # //--- this should be a separate function, but let's get it working first
-        # # Gene symbols start at column 6. Subtract 2 from end to account for data_file_name and study_id
-        # for i in range(6, len(row)-2):
-        #     gene_symbol = row.index[i]
-        #     result = row[i]
-        #     # print(gene_symbol, result)
-        #
-        #     # Is this a new or existing assay result for this gene symbol?
-        #     assay_results: Optional[AssayResults] = None
-        #     newAssayResults = True
-        #     for a in proteomic_data.assay_results:
-        #         if a.gene_symbol == gene_symbol:  # //--- field in assay results needs to be passed parameter
-        #             assay_results = a
-        #             newAssayResults = False
-        #             break
-        #
-        #     if not assay_results:
-        #         assay_results = AssayResults()
-        #
-        #     assay_results.gene_symbol = gene_symbol
-        #     assay_results.result = result
-        #     if newAssayResults:
-        #         proteomic_data.assay_results.append(assay_results)
+            assay_data = add_common_data(active_account, row, assay_data, metaDataDict,
+                                         includeAssayResults=not columnarStorage)
+            assay_data.content_hash = contentHash
 
-        # If this a new row, append it to the clinical data (otherwise, the
-        # existing row will be updated upon saving of the clinical data)
-        if newRow:
-            clinical_data.proteomic.append(proteomic_data)
-
-        # Save sub document data
-        save_clinical_data(active_account, clinical_data, documentName, row.study_id, row.data_file_name, index)
-
-        # try:
-        #     clinical_data.save()
-        # except (ValueError, ValidationError) as e:
-        #     message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
-        #     add_event_log(active_account,
-        #                   message,
-        #                   success=False,
-        #                   event_type='Import',
-        #                   exception_type=e.__class__.__name__,
-        #                   file_name=row.data_file_name,
-        #                   study_id=row.study_id,
-        #                   document_id=str(clinical_data.id),
-        #                   sub_document_id=str(index))
-        #     error_msg(message)
-        #     continue  # Skip the rest of this loop
-        #
-        # message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {index}.'
-        # add_event_log(active_account,
-        #               message,
-        #               success=True,
-        #               event_type='Import',
-        #               file_name=data_file_name,
-        #               study_id=row.study_id,
-        #               document_id=str(clinical_data.id),
-        #               sub_document_id=str(index))
-        # success_msg(message)
+            # Results of this data label type that were stored in the sub-document before the switch to
+            # columnar storage are moved into the block, so that they can't shadow the results in the block
+            embeddedResultList = []
+            if columnarStorage:
+                embeddedResultList = [(a.data_label, a.result) for a in assay_data.assay_results
+                                      if a.data_label_type == data_label_type]
+                assay_data.assay_results = [a for a in assay_data.assay_results
+                                            if a.data_label_type != data_label_type]
 
-    return  # proteomic_data
+            # Validate each row, since bulk_write bypasses mongoengine validation. A row that fails is
+            # left out of the write (an existing row keeps its stored version), as a failed save() would be.
+            try:
+                assay_data.validate()
+            except (ValueError, ValidationError) as e:
+                message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
+                add_event_log(active_account,
+                              message,
+                              success=False,
+                              event_type='Import',
+                              exception_type=e.__class__.__name__,
+                              file_name=data_file_name,
+                              study_id=study_id,
+                              document_id=str(clinical_data.id),
+                              sub_document_id=str(index))
+                error_msg(message)
+                if not newRow:
+                    originalSubDocumentDict[originalSubDocument.get(uniqueIdField)] = originalSubDocument
+                continue  # Skip the rest of this loop
 
+            if columnarStorage:
+                existingBlock = existingBlockDict.get((clinical_data.study_id, str(index), assay_data.dataset_name))
+                if existingBlock is None and len(embeddedResultList) > 0:
+                    existingBlock = {'data_labels': [data_label for data_label, _ in embeddedResultList],
+                                     'results': pack_assay_results([result for _, result in embeddedResultList])}
+                studyBlockOperationList.append(build_assay_result_block_operation(active_account, row, assay_data,
+                                                                                  clinical_data.study_id,
+                                                                                  subDocumentName,
+                                                                                  data_label_type,
+                                                                                  existingBlock))
+
+            # If this a new row, append it to the clinical data (otherwise, the
+            # existing row will be updated in place)
+            if newRow:
+                clinical_data[subDocumentName].append(assay_data)
+                subDocumentDict[index] = assay_data
+
+            rowIndexList.append(index)
+
+        if len(rowIndexList) < 1:
+            continue  # Nothing has changed for this study
+
+        # Final check of the whole document before building the write (rows were validated above)
+        try:
+            clinical_data.validate()
+        except (ValueError, ValidationError) as e:
+            for index in rowIndexList:
+                message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
+                add_event_log(active_account,
+                              message,
+                              success=False,
+                              event_type='Import',
+                              exception_type=e.__class__.__name__,
+                              file_name=data_file_name,
+                              study_id=study_id,
+                              document_id=str(clinical_data.id),
+                              sub_document_id=str(index))
+                error_msg(message)
+            continue  # Skip the rest of this loop
 
-def add_cytokine_data(active_account: User, df, data_file_name, metaDataDict):  # -> Cytokine:
-    documentName = set_up_globals.cytokines_document_name
+        subDocumentData = [originalSubDocumentDict.get(sd.get(uniqueIdField), sd)
+                           for sd in clinical_data.to_mongo().get(subDocumentName, [])]
+        bulkOperationList.append(UpdateOne({'_id': clinical_data.id}, {'$set': {subDocumentName: subDocumentData}}))
+        studyRowIndexList.append((clinical_data, study_id, rowIndexList))
+        blockOperationList.extend(studyBlockOperationList)
+        blockRowIndexList.extend(rowIndexList)
 
-    for index, row in df.iterrows():
-        clinical_data = get_clinical_data_reference(active_account, documentName, row.study_id, data_file_name)
-        if not clinical_data:
-            continue  # Skip the rest of this loop
+    log_unchanged_rows(active_account, documentName, data_file_name, unchangedCount)
+    if len(bulkOperationList) < 1:
+        return
 
-        cytokine_data: Optional[Cytokine] = None
-        newRow = True
+    # Write all studies at once. Operations are unordered, so a failure
+    # for one study does not prevent the remaining studies from being written.
+    failedRows = {}  # Row index -> error message
+    try:
+        ClinicalData._get_collection().bulk_write(bulkOperationList, ordered=False)
+    except BulkWriteError as e:
+        for writeError in e.details.get('writeErrors', []):
+            for index in studyRowIndexList[writeError['index']][2]:
+                failedRows[index] = writeError.get('errmsg', str(writeError))
 
-        for b in clinical_data.cytokine:
-            if b.unique_id == index:
-                cytokine_data = b
-                newRow = False
-                break
+    if len(blockOperationList) > 0:
+        try:
+            AssayResultBlock._get_collection().bulk_write(blockOperationList, ordered=False)
+        except BulkWriteError as e:
+            for writeError in e.details.get('writeErrors', []):
+                failedRows[blockRowIndexList[writeError['index']]] = writeError.get('errmsg', str(writeError))
+
+    for clinical_data, study_id, rowIndexList in studyRowIndexList:
+        for index in rowIndexList:
+            if index in failedRows:
+                message = f'Save of {documentName} data with id={index} resulted in exception: {failedRows[index]}'
+                add_event_log(active_account,
+                              message,
+                              success=False,
+                              event_type='Import',
+                              exception_type=BulkWriteError.__name__,
+                              file_name=data_file_name,
+                              study_id=study_id,
+                              document_id=str(clinical_data.id),
+                              sub_document_id=str(index))
+                error_msg(message)
+                continue
 
-        # If no data exists for this id, set created info
-        if not cytokine_data:
-            cytokine_data = Cytokine()
-            cytokine_data.created_by = active_account
-            cytokine_data.created_date = datetime.datetime.now()
+            message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {index}.'
+            add_event_log(active_account,
+                          message,
+                          success=True,
+                          event_type='Import',
+                          file_name=data_file_name,
+                          study_id=study_id,
+                          document_id=str(clinical_data.id),
+                          sub_document_id=str(index))
+            success_msg(message)
 
-        cytokine_data.unique_id = index
+    return
 
-        # Find associated biospecimens
-        specimen_id = str(int(float(row.study_id))) + '-' + row.timepoint + '-' + metaDataDict['biospecimen_type']
-        biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
-        if biospecimen_data:
-            cytokine_data.biospecimen_data_reference = biospecimen_data
 
-        cytokine_data = add_common_data(active_account, row, cytokine_data, metaDataDict)
+def add_proteomic_data(active_account: User, df, data_file_name, metaDataDict):  # -> Proteomic:
+    documentName = set_up_globals.proteomics_document_name
+    add_assay_data(active_account, df, data_file_name, metaDataDict, documentName, 'proteomic', Proteomic)
+
+    return  # proteomic_data
 
-        # If this a new row, append it to the clinical data (otherwise, the
-        # existing row will be updated upon saving of the clinical data)
-        if newRow:
-            clinical_data.cytokine.append(cytokine_data)
 
-        # Save sub document data
-        save_clinical_data(active_account, clinical_data, documentName, row.study_id, row.data_file_name, index)
+def add_cytokine_data(active_account: User, df, data_file_name, metaDataDict):  # -> Cytokine:
+    documentName = set_up_globals.cytokines_document_name
+    add_assay_data(active_account, df, data_file_name, metaDataDict, documentName, 'cytokine', Cytokine)
 
     return  # cytokine_data
 
 
 def add_metabolomic_data(active_account: User, df, data_file_name, metaDataDict):  # -> Metabolomic:
     documentName = set_up_globals.metabolomics_document_name
-
-    for index, row in df.iterrows():
-        clinical_data = get_clinical_data_reference(active_account, documentName, row.study_id, data_file_name)
-        if not clinical_data:
-            continue  # Skip the rest of this loop
-
-        metabolomic_data: Optional[Metabolomic] = None
-        newRow = True
-
-        for b in clinical_data.metabolomic:
-            if b.unique_id == index:
-                metabolomic_data = b
-                newRow = False
-                break
-
-        # If no data exists for this id, set created info
-        if not metabolomic_data:
-            metabolomic_data = Metabolomic()
-            metabolomic_data.created_by = active_account
-            metabolomic_data.created_date = datetime.datetime.now()
-
-        metabolomic_data.unique_id = index
-
-        # Find associated biospecimens
-        specimen_id = str(int(float(row.study_id))) + '-' + row.timepoint + '-' + metaDataDict['biospecimen_type']
-        biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
-        if biospecimen_data:
-            metabolomic_data.biospecimen_data_reference = biospecimen_data
-
-        metabolomic_data = add_common_data(active_account, row, metabolomic_data, metaDataDict)
-
-        # If this a new row, append it to the clinical data (otherwise, the
-        # existing row will be updated upon saving of the clinical data)
-        if newRow:
-            clinical_data.metabolomic.append(metabolomic_data)
-
-        # Save sub document data
-        save_clinical_data(active_account, clinical_data, documentName, row.study_id, row.data_file_name, index)
+    add_assay_data(active_account, df, data_file_name, metaDataDict, documentName, 'metabolomic', Metabolomic)
 
     return  # metabolomic_data
 
@@ -627,8 +1113,22 @@ def add_metabolomic_data(active_account: User, df, data_file_name, metaDataDict)
 def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> ScRNAseqSummary:
     documentName = set_up_globals.scrnaseq_summary_document_name
 
+    # Clinical data (and an index of its existing scRNA-seq rows, keyed on sample ID)
+    # is loaded once per study and reused for every row belonging to that study
+    studyDict = {}
+    unchangedCount = 0
+
+    biospecimenDict, _ = find_biospecimen_maps(
+        specimen_ids=[scrnaseq_specimen_id(sample_name) for sample_name in df['sample_name']])
+
     for index, row in df.iterrows():
-        clinical_data = find_clinical_data_by_study_id(row.study_id)
+        if row.study_id in studyDict:
+            clinical_data, sampleDict = studyDict[row.study_id]
+        else:
+            clinical_data = find_clinical_data_by_study_id(row.study_id)
+            sampleDict = index_sub_documents(clinical_data.scrnaseq_summary, 'sampleid') if clinical_data else None
+            studyDict[row.study_id] = (clinical_data, sampleDict)
+
         if not clinical_data:
             message = f'You must import {set_up_globals.clinical_document_name} data for study ID {row.study_id} before importing {documentName} data.'
             add_event_log(active_account,
@@ -640,14 +1140,8 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
             error_msg(message)
             continue  # Skip the rest of this loop
 
-        scrnaseq_summary_data: Optional[ScRNAseqSummary] = None
-        newRow = True
-
-        for b in clinical_data.scrnaseq_summary:
-            if b.sampleid == index:
-                scrnaseq_summary_data = b
-                newRow = False
-                break
+        scrnaseq_summary_data: Optional[ScRNAseqSummary] = sampleDict.get(index)
+        newRow = scrnaseq_summary_data is None
 
         # If no data exists for this id, set created info
         if not scrnaseq_summary_data:
@@ -656,9 +1150,14 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
             scrnaseq_summary_data.created_date = datetime.datetime.now()
 
         # Find associated biospecimens (first strip tube number off of the sample name)
-        valMinusTubeNumberList = row.sample_name.split('-')[0:4]
-        specimen_id = '-'.join(valMinusTubeNumberList)
-        biospecimen_data = find_biospecimen_data_by_specimen_id(specimen_id)
+        specimen_id = scrnaseq_specimen_id(row.sample_name)
+        biospecimen_data = biospecimenDict.get(specimen_id)
+
+        # Skip rows that haven't changed since they were last imported
+        contentHash = row_content_hash(row, str(biospecimen_data.id) if biospecimen_data else None)
+        if not newRow and scrnaseq_summary_data.content_hash == contentHash:
+            unchangedCount += 1
+            continue
 
         scrnaseq_summary_data.last_modified_by = active_account
         scrnaseq_summary_data.last_modified_date = datetime.datetime.now()
@@ -699,6 +1198,7 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
         scrnaseq_summary_data.enid = int(row.enid)
         scrnaseq_summary_data.sample_name = row.sample_name
         scrnaseq_summary_data.bc = row.bc
+        scrnaseq_summary_data.content_hash = contentHash
 
         if len(str(row.notes).strip()) > 0 and str(row.notes).strip().lower() != 'nan':
             scrnaseq_summary_data.notes = str(row.notes).strip()
@@ -707,6 +1207,7 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
         # existing row will be updated upon saving of the clinical data)
         if newRow:
             clinical_data.scrnaseq_summary.append(scrnaseq_summary_data)
+            sampleDict[index] = scrnaseq_summary_data
 
         try:
             clinical_data.save()
@@ -722,6 +1223,8 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
                           document_id=str(clinical_data.id),
                           sub_document_id=str(index))
             error_msg(message)
+            # The in-memory document now holds the rejected row, so reload it for the next row of this study
+            studyDict.pop(row.study_id, None)
             continue  # Skip the rest of this loop
 
         message = f'Added / updated {documentName} data for ENID: {clinical_data.study_id} with id {index}.'
@@ -735,6 +1238,8 @@ def add_scrnaseq_summary_data(active_account: User, df, data_file_name):  # -> S
                       sub_document_id=str(index))
         success_msg(message)
 
+    log_unchanged_rows(active_account, documentName, data_file_name, unchangedCount)
+
     return  # scrnaseq_summary_data
 
 
@@ -815,23 +1320,48 @@ def add_redcap_data(active_account: User, df, data_file_name):  # -> Redcap:
 # def add_biospecimen_data(active_account: User, index, row) -> Biospecimen:
 def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospecimen:
     documentName = set_up_globals.biospecimen_document_name
+    unchangedCount = 0
+
+    # Existing biospecimens are fetched in one query. New ones are added to the map as they are saved,
+    # since a specimen can have several tubes (rows) in the spreadsheet.
+    biospecimenDict, _ = find_biospecimen_maps(specimen_ids=df.index)
 
     for index, row in df.iterrows():
         currentVersion = 0
-        biospecimen_data = find_biospecimen_data_by_specimen_id(index)
+        previousDocument = None
+        biospecimen_data = biospecimenDict.get(str(index))
+
+        # Is this a new or existing sample for this biospecimen?
+        biospecimen_tube_info: Optional[BiospecimenTubeInfo] = None
+        newBiospecimenTubeInfo = True
+        for a in (biospecimen_data.biospecimen_tube_info if biospecimen_data else []):
+            if a.sample_id == int(row.sample_id):
+                biospecimen_tube_info = a
+                newBiospecimenTubeInfo = False
+                break
+
+        # Skip rows that haven't changed, without adding to the version history
+        contentHash = row_content_hash(row)
+        if not newBiospecimenTubeInfo and biospecimen_tube_info.content_hash == contentHash:
+            unchangedCount += 1
+            continue
 
         if biospecimen_data:
             # If data exists, save in version history
             currentVersion = biospecimen_data.version_number
-            biospecimen_data_version_history = BiospecimenVersionHistory()
+            if set_up_globals.version_history_mode == 'delta':
+                # Recorded as a diff just before the save, below
+                previousDocument = biospecimen_data.to_mongo().to_dict()
+            else:
+                biospecimen_data_version_history = BiospecimenVersionHistory()
 
-            attributeList = utilities.attributes(Biospecimen)
-            # print(attributeList)
-            for attrib in attributeList:
-                # print(attrib)
-                biospecimen_data_version_history[attrib] = biospecimen_data[attrib]
+                attributeList = utilities.attributes(Biospecimen)
+                # print(attributeList)
+                for attrib in attributeList:
+                    # print(attrib)
+                    biospecimen_data_version_history[attrib] = biospecimen_data[attrib]
 
-            biospecimen_data_version_history.save()
+                biospecimen_data_version_history.save()
         else:
             # If no data exists for this id, set created info
             biospecimen_data = Biospecimen()
@@ -849,15 +1379,6 @@ def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospe
         biospecimen_data.specimen_type = row.specimen_type
 
         # Add biospecimen tube info to data as a subdocument
-        # Is this a new or existing sample for this biospecimen?
-        biospecimen_tube_info: Optional[BiospecimenTubeInfo] = None
-        newBiospecimenTubeInfo = True
-        for a in biospecimen_data.biospecimen_tube_info:
-            if a.sample_id == int(row.sample_id):
-                biospecimen_tube_info = a
-                newBiospecimenTubeInfo = False
-                break
-
         if not biospecimen_tube_info:
             biospecimen_tube_info = BiospecimenTubeInfo()
 
@@ -870,6 +1391,7 @@ def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospe
         biospecimen_tube_info.box_number = int(row.box_number)
         biospecimen_tube_info.box_position = int(row.box_position)
         biospecimen_tube_info.analysis_id = row.analysis_id
+        biospecimen_tube_info.content_hash = contentHash
 
         if row.is_removed == 'TRUE':
             biospecimen_tube_info.is_removed = True
@@ -900,7 +1422,15 @@ def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospe
         #     biospecimen_data.comments = str(row.comments).strip()
 
         try:
+            if previousDocument is not None:
+                version_history.record_version(active_account, 'biospecimen', biospecimen_data.id, previousDocument,
+                                               currentVersion, biospecimen_data.to_mongo().to_dict(),
+                                               biospecimen_data.version_number)
             biospecimen_data.save()
+            if set_up_globals.version_history_mode == 'delta' and currentVersion == 0:
+                # New documents only have an id once saved
+                version_history.record_version(active_account, 'biospecimen', biospecimen_data.id, None, 0,
+                                               biospecimen_data.to_mongo().to_dict(), biospecimen_data.version_number)
         except (ValueError, ValidationError) as e:
             message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
             add_event_log(active_account,
@@ -911,8 +1441,12 @@ def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospe
                           file_name=row.data_file_name,
                           document_id=str(index))
             error_msg(message)
+            # The document in the map may have unsaved changes, so go back to the saved version
+            biospecimenDict[str(index)] = find_biospecimen_data_by_specimen_id(index)
             continue  # Skip the rest of this loop
 
+        biospecimenDict[str(index)] = biospecimen_data
+
         message = f'Added / updated {documentName} data for Specimen ID: {index} with id {biospecimen_data.id}.'
         add_event_log(active_account,
                       message,
@@ -923,6 +1457,8 @@ def add_biospecimen_data(active_account: User, df, data_file_name):  # -> Biospe
                       document_id=str(index))
         success_msg(message)
 
+    log_unchanged_rows(active_account, documentName, data_file_name, unchangedCount)
+
     # //--- this would be a good place to check / update references in each sub-document in the clinical data
 
     return  # biospecimen_data
@@ -948,160 +1484,223 @@ def find_data_label_reference(data_label, data_label_type) -> DataLabels:
     return DataLabels.objects(Q(data_label=data_label) & Q(data_label_type=data_label_type)).first()
 
 
-def add_data_label_types(active_account: User, df, data_file_name):
-    documentName = set_up_globals.data_label_type_document_name
-    data_label_type_list = set_up_globals.data_label_type_list
+# In-memory cache of data labels keyed by (data_label_type, data_label). Each data label type is loaded
+# with a single query the first time it is needed, rather than one query per analyte column per row.
+# The cache is shared by every import and is cleared whenever add_data_label_types writes new labels.
+_data_label_cache = {}
+_data_label_types_loaded = set()
+_data_label_cache_lock = threading.Lock()
 
-    # gene_symbol_data_label_type = set_up_globals.gene_symbol_data_label_type
-    # ensembl_gene_id_data_label_type = set_up_globals.ensembl_gene_id_data_label_type
-    # cytokine_data_label_type = set_up_globals.cytokine_data_label_type
-    #
-    # gene_symbol_to_ensembl_geneid_ref = set_up_globals.gene_symbol_to_ensembl_geneid_ref
-    # gene_symbol_to_cytokine_label_ref = set_up_globals.gene_symbol_to_cytokine_label_ref
 
-    for index, row in df.iterrows():
+def load_data_label_cache(data_label_type):
+    with _data_label_cache_lock:
+        if data_label_type in _data_label_types_loaded:
+            return
 
-        # For testing, only load subset of genes (those starting with 'ACTN')
-        if set_up_globals.testMode:
-            testGeneList = ['A2M', 'ACTB', 'ACTN4', 'ACTR3', 'AGT', 'ALB', 'ALDOA', 'AMBP', 'APOA1', 'APOA4', 'APOC1',
-                            'NGFB', 'FGF2', 'CCL27', 'CCL11', 'CSF3', 'CSF2', 'CXCL1', 'HGF', 'IFNA2', 'IFNG', 'IL10',
-                            'IL12B', 'IL12B', 'IL13', 'IL15', 'IL16', 'IL17', 'IL18', 'IL1A', 'IL1B', 'IL1R1', 'IL2',
-                            'IL2RA', 'IL3', 'IL4', 'IL5', 'IL6', 'IL7', 'CXCL8', 'IL9', 'CXCL10', 'LIF', 'CSF1',
-                            'CCL2', 'CCL7', 'MIF', 'CXCR3', 'CCL3', 'CCL4', 'PDGFB', 'CCL5', 'KITLG', 'SCGF',
-                            'CXCL12', 'TNFB', 'TNFA', 'TNFSF10', 'VEGF',
-                            'IL_2ra', 'MIG', 'MIP_1B', 'IL_6', 'IFN_a2', 'IFN_g', 'SDF_1a', 'IL_1ra', 'MCP_3', 'IL_16',
-                            'IL_12p40', 'LIF', 'TNF_B', 'IL_5', 'GM_CSF', 'MIF', 'TNFa', 'RANTES', 'IL_2', 'IL_1B',
-                            'IL_18', 'Eotaxin', 'bFGF', 'VEGF', 'B_NGF', 'PDGF_BB', 'IP_10', 'IL_13', 'IL_4', 'MCP_1',
-                            'IL_8', 'MIP_1a', 'IL_10', 'G_CSF', 'GROa', 'HGF', 'IL_1a', 'IL_3', 'SCF', 'TRAIL',
-                            'M_CSF', 'CTACK', 'IL_15', 'IL_7', 'IL_12p70', 'IL_17', 'IL_9', 'SCGF_B']
-            if row.gene_name not in testGeneList:
-                continue
+        # Only the fields needed to identify a label are loaded - the cached documents are used as
+        # references, so there is no need to pull the (potentially long) cross-reference lists
+        query = DataLabels.objects(data_label_type=data_label_type).only('data_label_type',
+                                                                         'data_label',
+                                                                         'data_label_name').order_by()
+        for data_label_data in query:
+            _data_label_cache[(data_label_type, data_label_data.data_label)] = data_label_data
+        _data_label_types_loaded.add(data_label_type)
 
-        # currentVersion = 0
-
-        # First, save the data label only, without any references to other data labels
-        # (we need this first step, so that each label exists in the document prior to setting up
-        # reference lists. It sucks that we have to do two save operations, but there's no way around it)
-        for dlt in data_label_type_list:
-            data_label_name = ''
-            if dlt == set_up_globals.gene_symbol_data_label_type:
-                data_label = row.gene_name
-            elif dlt == set_up_globals.ensembl_gene_id_data_label_type:
-                data_label = row.gene_stable_id
-            elif dlt == set_up_globals.cytokine_data_label_type:
-                data_label = row.cytokine_label
-            elif dlt == set_up_globals.metabolomics_data_label_type:
-                data_label = row.comp_id
-                data_label_name = row.biochemical
-            else:
-                # This data label type not coded yet
-                error_msg(f"I haven't written code for data label type {dlt} yet.")
-                continue
-            # //--- set up remaining data label types
 
-            if len(data_label) < 1:
-                # This data label type is not part of this import
-                continue
+def resolve_data_label(data_label, data_label_type) -> Optional[DataLabels]:
+    if data_label_type not in _data_label_types_loaded:
+        load_data_label_cache(data_label_type)
 
-            data_label_data = find_data_label_reference(data_label, dlt)
+    return _data_label_cache.get((data_label_type, data_label))
 
-            if not data_label_data:
-                data_label_data = DataLabels()
 
-            data_label_data.data_label_type = dlt
-            data_label_data.data_label = data_label
-            if len(data_label_name) > 0:
-                data_label_data.data_label_name = data_label_name
+def invalidate_data_label_cache():
+    with _data_label_cache_lock:
+        _data_label_cache.clear()
+        _data_label_types_loaded.clear()
 
-            # Save data label
-            try:
-                data_label_data.save()
-            except (ValueError, ValidationError) as e:
-                message = f'Save of {documentName} data with {dlt}={data_label} resulted in exception: {e}'
-                add_event_log(active_account,
-                              message,
-                              success=False,
-                              event_type='Import',
-                              exception_type=e.__class__.__name__,
-                              file_name=row.data_file_name,
-                              document_id=str(data_label))
-                error_msg(message)
-                continue  # Skip the rest of this loop
 
-            message = f'Added / updated {documentName} data for {dlt}: {data_label} with id {data_label_data.id}.'
+# Reference list in a data label for each data label type it can refer to
+# //--- set up remaining data label types
+data_label_reference_fields = {set_up_globals.gene_symbol_data_label_type: 'gene_symbol_references',
+                               set_up_globals.ensembl_gene_id_data_label_type: 'ensembl_geneid_references',
+                               set_up_globals.cytokine_data_label_type: 'cytokine_label_references',
+                               set_up_globals.metabolomics_data_label_type: 'metabolomic_label_references'}
+
+
+# Data label and data label name of the given type in a row of a data label type spreadsheet
+def get_row_data_label(row, data_label_type):
+    if data_label_type == set_up_globals.gene_symbol_data_label_type:
+        return row.gene_name, ''
+    elif data_label_type == set_up_globals.ensembl_gene_id_data_label_type:
+        return row.gene_stable_id, ''
+    elif data_label_type == set_up_globals.cytokine_data_label_type:
+        return row.cytokine_label, ''
+    elif data_label_type == set_up_globals.metabolomics_data_label_type:
+        return row.comp_id, row.biochemical
+    # //--- set up remaining data label types
+
+    return None
+
+
+# (data label type, data label) -> _id for a list of (data label type, data label) pairs,
+# with one query per data label type
+def find_data_label_ids(dataLabelKeyList):
+    dataLabelsByType = {}
+    for data_label_type, data_label in dataLabelKeyList:
+        dataLabelsByType.setdefault(data_label_type, []).append(data_label)
+
+    dataLabelIdDict = {}
+    for data_label_type, dataLabelList in dataLabelsByType.items():
+        for data_label_data in DataLabels._get_collection().find({'data_label_type': data_label_type,
+                                                                  'data_label': {'$in': dataLabelList}},
+                                                                 {'data_label': 1}):
+            dataLabelIdDict[(data_label_type, data_label_data['data_label'])] = data_label_data['_id']
+
+    return dataLabelIdDict
+
+
+# Send a list of data label updates as (unordered) bulk_writes of import_chunk_size updates, and log the
+# ones that failed. keyList is the (data label type, data label) of each update. Returns the set of keys that failed.
+def bulk_write_data_labels(active_account: User, bulkOperationList, keyList, data_file_name):
+    failedKeys = set()
+    chunkSize = set_up_globals.import_chunk_size
+    for start in range(0, len(bulkOperationList), chunkSize):
+        failedKeys |= bulk_write_data_label_chunk(active_account, bulkOperationList[start:start + chunkSize],
+                                                  keyList[start:start + chunkSize], data_file_name)
+
+    return failedKeys
+
+
+def bulk_write_data_label_chunk(active_account: User, bulkOperationList, keyList, data_file_name):
+    documentName = set_up_globals.data_label_type_document_name
+    failedKeys = set()
+    try:
+        DataLabels._get_collection().bulk_write(bulkOperationList, ordered=False)
+    except BulkWriteError as e:
+        for writeError in e.details.get('writeErrors', []):
+            data_label_type, data_label = keyList[writeError['index']]
+            failedKeys.add((data_label_type, data_label))
+            message = f'Save of {documentName} data with {data_label_type}={data_label} resulted in exception: ' \
+                      f'{writeError.get("errmsg", str(writeError))}'
             add_event_log(active_account,
                           message,
-                          success=True,
+                          success=False,
                           event_type='Import',
+                          exception_type=BulkWriteError.__name__,
                           file_name=data_file_name,
-                          document_id=str(data_label_data.id))
-            success_msg(message)
+                          document_id=str(data_label))
+            error_msg(message)
 
-        # Now we can set up the references to other data labels
-        gene_symbol_ref = find_data_label_reference(row.gene_name, set_up_globals.gene_symbol_data_label_type)
-        ensembl_gene_id_ref = find_data_label_reference(row.gene_stable_id,
-                                                        set_up_globals.ensembl_gene_id_data_label_type)
-        cytokine_label_ref = find_data_label_reference(row.cytokine_label, set_up_globals.cytokine_data_label_type)
-        metabolomic_label_ref = find_data_label_reference(row.comp_id, set_up_globals.metabolomics_data_label_type)
-        # //--- set up remaining data label types
-
-        for dlt in data_label_type_list:
-            data_label = ''
-            if dlt == set_up_globals.gene_symbol_data_label_type:
-                data_label = row.gene_name
-            elif dlt == set_up_globals.ensembl_gene_id_data_label_type:
-                data_label = row.gene_stable_id
-            elif dlt == set_up_globals.cytokine_data_label_type:
-                data_label = row.cytokine_label
-            elif dlt == set_up_globals.metabolomics_data_label_type:
-                data_label = row.comp_id
-            else:
-                # This data label type not coded yet
-                error_msg(f"I haven't written code for data label type {dlt} yet.")
-                continue
-            # //--- set up remaining data label types
+    return failedKeys
 
-            if len(data_label) < 1:
-                # This data label type is not part of this import
-                continue
 
-            data_label_data = find_data_label_reference(data_label, dlt)
+# Import data labels in two phases. First, every data label in the spreadsheet is upserted in a single
+# bulk_write, and the _id of each label is read back into a (data label type, data label) -> _id map.
+# Then the references between the data labels in each row are written as a second bulk batch.
+def add_data_label_types(active_account: User, df, data_file_name):
+    documentName = set_up_globals.data_label_type_document_name
 
-            # //--- check to make sure ref not already in list !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-            # //--- set up remaining data label types
-            if gene_symbol_ref and gene_symbol_ref not in data_label_data.gene_symbol_references:
-                data_label_data.gene_symbol_references.append(gene_symbol_ref)
-            if ensembl_gene_id_ref and ensembl_gene_id_ref not in data_label_data.ensembl_geneid_references:
-                data_label_data.ensembl_geneid_references.append(ensembl_gene_id_ref)
-            if cytokine_label_ref and cytokine_label_ref not in data_label_data.cytokine_label_references:
-                data_label_data.cytokine_label_references.append(cytokine_label_ref)
-            if metabolomic_label_ref and metabolomic_label_ref not in data_label_data.metabolomic_label_references:
-                data_label_data.metabolomic_label_references.append(metabolomic_label_ref)
+    supportedTypeList = []
+    for dlt in set_up_globals.data_label_type_list:
+        if dlt in data_label_reference_fields:
+            supportedTypeList.append(dlt)
+        else:
+            # This data label type not coded yet
+            error_msg(f"I haven't written code for data label type {dlt} yet.")
+
+    # For testing, only load subset of genes
+    testGeneList = ['A2M', 'ACTB', 'ACTN4', 'ACTR3', 'AGT', 'ALB', 'ALDOA', 'AMBP', 'APOA1', 'APOA4', 'APOC1',
+                    'NGFB', 'FGF2', 'CCL27', 'CCL11', 'CSF3', 'CSF2', 'CXCL1', 'HGF', 'IFNA2', 'IFNG', 'IL10',
+                    'IL12B', 'IL12B', 'IL13', 'IL15', 'IL16', 'IL17', 'IL18', 'IL1A', 'IL1B', 'IL1R1', 'IL2',
+                    'IL2RA', 'IL3', 'IL4', 'IL5', 'IL6', 'IL7', 'CXCL8', 'IL9', 'CXCL10', 'LIF', 'CSF1',
+                    'CCL2', 'CCL7', 'MIF', 'CXCR3', 'CCL3', 'CCL4', 'PDGFB', 'CCL5', 'KITLG', 'SCGF',
+                    'CXCL12', 'TNFB', 'TNFA', 'TNFSF10', 'VEGF',
+                    'IL_2ra', 'MIG', 'MIP_1B', 'IL_6', 'IFN_a2', 'IFN_g', 'SDF_1a', 'IL_1ra', 'MCP_3', 'IL_16',
+                    'IL_12p40', 'LIF', 'TNF_B', 'IL_5', 'GM_CSF', 'MIF', 'TNFa', 'RANTES', 'IL_2', 'IL_1B',
+                    'IL_18', 'Eotaxin', 'bFGF', 'VEGF', 'B_NGF', 'PDGF_BB', 'IP_10', 'IL_13', 'IL_4', 'MCP_1',
+                    'IL_8', 'MIP_1a', 'IL_10', 'G_CSF', 'GROa', 'HGF', 'IL_1a', 'IL_3', 'SCF', 'TRAIL',
+                    'M_CSF', 'CTACK', 'IL_15', 'IL_7', 'IL_12p70', 'IL_17', 'IL_9', 'SCGF_B']
+
+    # Phase one: save the data labels only, without any references to other data labels
+    # (each label has to exist before it can be referred to by the others)
+    dataLabelDict = {}  # (data label type, data label) -> data label name
+    rowDataLabelList = []  # (data label type, data label) pairs in each row
+    for index, row in df.iterrows():
+        if set_up_globals.testMode and row.gene_name not in testGeneList:
+            continue
 
-            # Save data label
-            try:
-                data_label_data.save()
-            except (ValueError, ValidationError) as e:
-                message = f'Save of {documentName} data with {dlt}={data_label} resulted in exception: {e}'
-                add_event_log(active_account,
-                              message,
-                              success=False,
-                              event_type='Import',
-                              exception_type=e.__class__.__name__,
-                              file_name=row.data_file_name,
-                              document_id=str(data_label))
-                error_msg(message)
-                continue  # Skip the rest of this loop
+        rowDataLabels = []
+        for dlt in supportedTypeList:
+            data_label, data_label_name = get_row_data_label(row, dlt)
+            if len(data_label) < 1:
+                # This data label type is not part of this import
+                continue
 
-            message = f'Added / updated {documentName} data for {dlt}: {data_label} with id {data_label_data.id}.'
+            if len(data_label_name) > 0 or (dlt, data_label) not in dataLabelDict:
+                dataLabelDict[(dlt, data_label)] = data_label_name
+            rowDataLabels.append((dlt, data_label))
+        rowDataLabelList.append(rowDataLabels)
+
+    bulkOperationList = []
+    keyList = list(dataLabelDict)
+    for dlt, data_label in keyList:
+        dataLabelValues = {'data_label_type': dlt, 'data_label': data_label}
+        if len(dataLabelDict[(dlt, data_label)]) > 0:
+            dataLabelValues['data_label_name'] = dataLabelDict[(dlt, data_label)]
+        bulkOperationList.append(UpdateOne({'data_label_type': dlt, 'data_label': data_label},
+                                           {'$set': dataLabelValues},
+                                           upsert=True))
+    failedKeys = bulk_write_data_labels(active_account, bulkOperationList, keyList, data_file_name)
+
+    for dlt in supportedTypeList:
+        savedCount = len([key for key in keyList if key[0] == dlt and key not in failedKeys])
+        if savedCount > 0:
+            message = f'Added / updated {savedCount} {documentName} data labels for {dlt}.'
             add_event_log(active_account,
                           message,
                           success=True,
                           event_type='Import',
-                          file_name=data_file_name,
-                          document_id=str(data_label_data.id))
+                          file_name=data_file_name)
             success_msg(message)
 
+    # Phase two: set up the references between the data labels in each row
+    dataLabelIdDict = find_data_label_ids(keyList)
+    referenceDict = {}  # Data label _id -> {reference list: {referenced _id: None}} (dicts keep the order)
+    for rowDataLabels in rowDataLabelList:
+        rowReferences = [(data_label_reference_fields[key[0]], dataLabelIdDict[key])
+                         for key in rowDataLabels if key in dataLabelIdDict]
+        for key in rowDataLabels:
+            if key not in dataLabelIdDict:
+                continue  # Failed to save
+            labelReferences = referenceDict.setdefault(dataLabelIdDict[key], {})
+            for referenceField, referenceId in rowReferences:
+                labelReferences.setdefault(referenceField, {})[referenceId] = None
+
+    # References are added on the server with $addToSet, so the (possibly long) existing reference
+    # lists never have to be read, compared or rewritten here
+    idKeyDict = {dataLabelId: key for key, dataLabelId in dataLabelIdDict.items()}
+    bulkOperationList = []
+    keyList = []
+    for dataLabelId, labelReferences in referenceDict.items():
+        referenceUpdate = {referenceField: {'$each': list(referenceIds)}
+                           for referenceField, referenceIds in labelReferences.items()}
+        bulkOperationList.append(UpdateOne({'_id': dataLabelId}, {'$addToSet': referenceUpdate}))
+        keyList.append(idKeyDict[dataLabelId])
+    failedKeys = bulk_write_data_labels(active_account, bulkOperationList, keyList, data_file_name)
+
+    if len(keyList) > len(failedKeys):
+        message = f'Updated references for {len(keyList) - len(failedKeys)} {documentName} data labels.'
+        add_event_log(active_account,
+                      message,
+                      success=True,
+                      event_type='Import',
+                      file_name=data_file_name)
+        success_msg(message)
+
+    # New labels (or new names for existing labels) were written, so cached lookups are stale
+    invalidate_data_label_cache()
+
     return  # data_label_types
 
 
@@ -1109,58 +1708,74 @@ def find_data_label_pathway_reference(pathway_name) -> DataLabelPathways:
     return DataLabelPathways.objects(pathway_name=pathway_name).first()
 
 
+# Import pathways with one write per pathway. Rows are grouped by pathway name (the index), the member
+# data labels are resolved from the data label cache (one query per data label type), and every pathway
+# is upserted with $addToSet/$each in a single bulk_write.
 def add_data_label_pathways(active_account: User, df, data_file_name):
     documentName = set_up_globals.data_label_pathway_document_name
 
-    for index, row in df.iterrows():
-        data_label_pathway_data = find_data_label_pathway_reference(index)
+    bulkOperationList = []
+    pathwayList = []  # (pathway name, number of data labels) for each bulk operation
+    for pathway_name, pathway_df in df.groupby(level=0, sort=False):
+        dataLabelIds = {}  # Data label _id -> None (dicts keep the order)
+        for index, row in pathway_df.iterrows():
+            data_label_ref = resolve_data_label(row.data_label, row.data_label_type)
+            if not data_label_ref:
+                message = f'Data label {row.data_label} does not exist in the data labels table'
+                add_event_log(active_account,
+                              message,
+                              success=False,
+                              event_type='Import',
+                              file_name=data_file_name,
+                              document_id=str(index))
+                error_msg(message)
+                continue  # Skip the rest of this loop
 
-        if not data_label_pathway_data:
-            data_label_pathway_data = DataLabelPathways()
+            dataLabelIds[data_label_ref.id] = None
 
-        data_label_pathway_data.pathway_name = index
-        data_label_pathway_data.data_label_type = row.data_label_type
-        data_label_pathway_data.description = row.description
+        if len(dataLabelIds) < 1:
+            continue  # No data labels to add to this pathway
 
-        # Add data label reference if not already in list
-        data_label_ref = find_data_label_reference(row.data_label, row.data_label_type)
-        if not data_label_ref:
-            message = f'Data label {row.data_label} does not exist in the data labels table'
-            add_event_log(active_account,
-                          message,
-                          success=False,
-                          event_type='Import',
-                          file_name=data_file_name,
-                          document_id=str(index))
-            error_msg(message)
-            continue  # Skip the rest of this loop
+        lastRow = pathway_df.iloc[-1]
+        bulkOperationList.append(UpdateOne({'pathway_name': pathway_name},
+                                           {'$set': {'pathway_name': pathway_name,
+                                                     'data_label_type': lastRow.data_label_type,
+                                                     'description': lastRow.description},
+                                            '$addToSet': {'data_label_references': {'$each': list(dataLabelIds)}}},
+                                           upsert=True))
+        pathwayList.append((pathway_name, len(dataLabelIds)))
 
-        if data_label_ref in data_label_pathway_data.data_label_references:
-            continue  # Already in list - no need to save
-        else:
-            data_label_pathway_data.data_label_references.append(data_label_ref)
+    if len(bulkOperationList) < 1:
+        return  # data_label_pathways
 
-        try:
-            data_label_pathway_data.save()
-        except (ValueError, ValidationError) as e:
-            message = f'Save of {documentName} data with id={index} resulted in exception: {e}'
+    failedPathways = {}  # Pathway name -> error message
+    try:
+        DataLabelPathways._get_collection().bulk_write(bulkOperationList, ordered=False)
+    except BulkWriteError as e:
+        for writeError in e.details.get('writeErrors', []):
+            failedPathways[pathwayList[writeError['index']][0]] = writeError.get('errmsg', str(writeError))
+
+    for pathway_name, dataLabelCount in pathwayList:
+        if pathway_name in failedPathways:
+            message = f'Save of {documentName} data with id={pathway_name} resulted in exception: ' \
+                      f'{failedPathways[pathway_name]}'
             add_event_log(active_account,
                           message,
                           success=False,
                           event_type='Import',
-                          exception_type=e.__class__.__name__,
+                          exception_type=BulkWriteError.__name__,
                           file_name=data_file_name,
-                          document_id=str(index))
+                          document_id=str(pathway_name))
             error_msg(message)
-            continue  # Skip the rest of this loop
+            continue
 
-        message = f'Added / updated {documentName} data for pathway: {index} with id {data_label_pathway_data.id}.'
+        message = f'Added / updated {documentName} data for pathway: {pathway_name} ({dataLabelCount} data labels).'
         add_event_log(active_account,
                       message,
                       success=True,
                       event_type='Import',
                       file_name=data_file_name,
-                      document_id=str(index))
+                      document_id=str(pathway_name))
         success_msg(message)
 
     return  # data_label_pathways
@@ -1384,11 +1999,16 @@ def add_event_log(active_account: User,
         if len(str(comment).strip()) > 0 and str(comment).strip().lower() != 'nan':
             event_log_data.comment = str(comment).strip()
 
-    event_log_data.save()
+    event_log_buffer.add(event_log_data)
 
     return event_log_data
 
 
+# Write any buffered event log entries now (e.g. before querying the event log)
+def flush_event_log():
+    return event_log_buffer.flush()
+
+
 def success_msg(text):
     print(Fore.LIGHTGREEN_EX + text + Fore.WHITE)
 
@@ -0,0 +1,143 @@
+# Server-side summaries of distributions for violin / box plots.
+# px.violin with points='all' sends every value to the browser, which then computes the kernel
+# density estimate itself; with thousands of samples that makes the plots slow to draw. Here the
+# quartiles, whiskers and a KDE on a fixed grid are computed with NumPy, and each group is drawn
+# as a few light-weight scatter traces (violin outline, box and an optional sample of the points).
+# plotly 4.5.x can't draw go.Violin / go.Box traces from precomputed statistics, which is why the
+# shapes are drawn as scatter traces.
+
+
+import math
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+
+# Quartiles, Tukey whiskers, KDE and a sample of the points for one group of values.
+# labels (e.g. study ids) are kept with the sampled points, for hover text.
+def summarize_distribution(values, labels=None, gridSize=100, maxPoints=200, seed=0):
+    values = np.asarray(values, dtype='<f8')
+    keep = ~np.isnan(values)
+    values = values[keep]
+    labels = None if labels is None else np.asarray(labels, dtype=object)[keep]
+    count = len(values)
+    if count < 1:
+        return None
+
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    lowerWhisker = values[values >= q1 - 1.5 * iqr].min()
+    upperWhisker = values[values <= q3 + 1.5 * iqr].max()
+
+    # Gaussian KDE with Silverman's rule of thumb for the bandwidth
+    std = values.std(ddof=1) if count > 1 else 0.0
+    spread = min(std, iqr / 1.34) if iqr > 0 else std
+    bandwidth = 0.9 * spread * count ** (-0.2)
+    if bandwidth <= 0:
+        bandwidth = abs(median) * 0.01 or 1.0
+    grid = np.linspace(values.min() - 2 * bandwidth, values.max() + 2 * bandwidth, gridSize)
+    density = np.zeros(gridSize)
+    for start in range(0, count, 5000):  # Limit memory use for very large groups
+        z = (grid[:, None] - values[None, start:start + 5000]) / bandwidth
+        density += np.exp(-0.5 * z * z).sum(axis=1)
+    density /= count * bandwidth * math.sqrt(2 * math.pi)
+
+    # Random (but repeatable) sample of the points
+    if maxPoints is not None and count > maxPoints:
+        sample = np.sort(np.random.RandomState(seed).choice(count, maxPoints, replace=False))
+    else:
+        sample = np.arange(count)
+
+    return {'count': count,
+            'q1': q1, 'median': median, 'q3': q3,
+            'lower_whisker': lowerWhisker, 'upper_whisker': upperWhisker,
+            'mean': values.mean(),
+            'grid': grid, 'density': density,
+            'points': values[sample],
+            'point_labels': None if labels is None else labels[sample]}
+
+
+# Order categories as given in categoryOrder, then in order of appearance
+def ordered_categories(series, categoryOrder=None):
+    present = list(pd.unique(series.dropna()))
+    ordered = [c for c in (categoryOrder or []) if c in present]
+    return ordered + [c for c in present if c not in ordered]
+
+
+# Build a grouped violin plot (with a box and, optionally, some of the points) of y for each
+# value of x, with one color per value of color. Takes the same main arguments as px.violin.
+def violin_figure(df, x, y, color=None, category_orders=None, color_discrete_sequence=None, points=True,
+                  hover_name=None, maxPoints=200, gridSize=100, title=None, height=600, template='ggplot2'):
+    category_orders = category_orders or {}
+    colorSequence = color_discrete_sequence or px.colors.qualitative.Plotly
+
+    yValues = pd.to_numeric(df[y], errors='coerce')
+    xCategories = ordered_categories(df[x], category_orders.get(x))
+    colorGroups = ordered_categories(df[color], category_orders.get(color)) if color is not None else [None]
+
+    groupWidth = 0.8 / max(1, len(colorGroups))
+    fig = go.Figure()
+    for j, colorGroup in enumerate(colorGroups):
+        lineColor = colorSequence[j % len(colorSequence)]
+        groupMask = df[color] == colorGroup if color is not None else pd.Series(True, index=df.index)
+        violinX, violinY, boxX, boxY, boxText, pointX, pointY, pointText = [], [], [], [], [], [], [], []
+
+        for i, category in enumerate(xCategories):
+            mask = groupMask & (df[x] == category)
+            labels = df.loc[mask, hover_name] if hover_name is not None else None
+            summary = summarize_distribution(yValues[mask], labels, gridSize=gridSize,
+                                             maxPoints=maxPoints if points else 0, seed=i * len(colorGroups) + j)
+            if summary is None:
+                continue
+
+            center = i - 0.4 + groupWidth * (j + 0.5)
+
+            # Violin outline, scaled so that every violin has the same maximum width
+            halfWidth = 0.45 * groupWidth * summary['density'] / summary['density'].max()
+            violinX += list(center + halfWidth) + list((center - halfWidth)[::-1]) + [None]
+            violinY += list(summary['grid']) + list(summary['grid'][::-1]) + [None]
+
+            # Box (q1 to q3), median line and whiskers
+            w = 0.1 * groupWidth
+            stats = (f"{category}<br>n={summary['count']}<br>median={summary['median']:.4g}<br>"
+                     f"q1={summary['q1']:.4g}, q3={summary['q3']:.4g}<br>"
+                     f"whiskers={summary['lower_whisker']:.4g}, {summary['upper_whisker']:.4g}")
+            segments = [[(center - w, summary['q1']), (center + w, summary['q1']), (center + w, summary['q3']),
+                         (center - w, summary['q3']), (center - w, summary['q1'])],
+                        [(center - w, summary['median']), (center + w, summary['median'])],
+                        [(center, summary['q1']), (center, summary['lower_whisker'])],
+                        [(center, summary['q3']), (center, summary['upper_whisker'])]]
+            for segment in segments:
+                boxX += [p[0] for p in segment] + [None]
+                boxY += [p[1] for p in segment] + [None]
+                boxText += [stats] * len(segment) + [None]
+
+            # Jittered sample of the points
+            if points and len(summary['points']) > 0:
+                jitter = np.random.RandomState(i).uniform(-0.3, 0.3, len(summary['points']))
+                pointX += list(center + jitter * groupWidth)
+                pointY += list(summary['points'])
+                if summary['point_labels'] is not None:
+                    pointText += [str(label) for label in summary['point_labels']]
+
+        name = str(colorGroup) if colorGroup is not None else y
+        fig.add_trace(go.Scatter(x=violinX, y=violinY, name=name, legendgroup=name, mode='lines',
+                                 fill='toself', line=dict(color=lineColor, width=1), opacity=0.5,
+                                 hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=boxX, y=boxY, name=name, legendgroup=name, showlegend=False, mode='lines',
+                                 line=dict(color=lineColor, width=2), text=boxText, hoverinfo='text'))
+        if points and len(pointX) > 0:
+            fig.add_trace(go.Scatter(x=pointX, y=pointY, name=name, legendgroup=name, showlegend=False,
+                                     mode='markers', marker=dict(color=lineColor, size=4),
+                                     text=pointText if len(pointText) > 0 else None,
+                                     hoverinfo='text+y' if len(pointText) > 0 else 'y'))
+
+    fig.update_layout(title=title, height=height, template=template,
+                      legend_title_text=color,
+                      xaxis=dict(title=x, tickvals=list(range(len(xCategories))),
+                                 ticktext=[str(c) for c in xCategories],
+                                 range=[-0.6, len(xCategories) - 0.4]),
+                      yaxis=dict(title=y))
+    return fig
@@ -0,0 +1,105 @@
+# Buffered writer for the event log. Events are held in memory and written to the database with
+# insert_many, either when the buffer reaches flush_size events or every flush_interval seconds
+# (whichever comes first). Documents keep the Event_log schema, so existing querysets such as
+# Event_log.find_failures work unchanged once the buffer has been flushed.
+# Each event is given its _id before it is first written, so an event that is retried after a failed
+# flush can't be inserted twice: if it did reach the database, the retry fails with a duplicate key error
+# and the event is counted as written. Events that fail for any other non-transient reason are reported
+# and dropped rather than retried forever.
+
+
+import threading
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from data.event_log import Event_log
+
+# Server error codes for which a failed insert is worth retrying (the server was unavailable,
+# stepping down or shutting down, or the write timed out)
+retryableErrorCodeSet = {6, 7, 50, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+duplicateKeyErrorCode = 11000
+
+
+class EventLogBuffer:
+    def __init__(self, flush_size=500, flush_interval=5.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_lock = threading.Lock()  # Protects the buffer itself
+        self._write_lock = threading.Lock()  # Makes sure only one thread writes at a time
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+    def add(self, event_log_data: Event_log):
+        # Validate up front, since insert_many bypasses mongoengine validation
+        event_log_data.validate()
+
+        with self._buffer_lock:
+            self._buffer.append(event_log_data)
+            flushNow = len(self._buffer) >= self.flush_size
+            self._start_flush_thread()
+
+        if flushNow:
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._buffer_lock:
+                pending = self._buffer
+                self._buffer = []
+
+            if len(pending) < 1:
+                return 0
+
+            for event_log_data in pending:
+                if event_log_data.id is None:
+                    event_log_data.id = ObjectId()
+
+            try:
+                Event_log._get_collection().insert_many([e.to_mongo() for e in pending], ordered=False)
+            except BulkWriteError as e:
+                retryList = []
+                droppedCount = 0
+                for writeError in e.details.get('writeErrors', []):
+                    event_log_data = pending[writeError['index']]
+                    if writeError.get('code') == duplicateKeyErrorCode and \
+                            ('_id' in writeError.get('keyPattern', {}) or ' _id_ ' in writeError.get('errmsg', '')):
+                        continue  # Written by an earlier flush that was then retried
+                    elif writeError.get('code') in retryableErrorCodeSet:
+                        retryList.append(event_log_data)
+                    else:
+                        droppedCount += 1
+                        print(f'Event log entry "{event_log_data.message}" was not saved: {writeError.get("errmsg")}')
+
+                # Put the retryable events back (ahead of anything added since) so they are not lost
+                with self._buffer_lock:
+                    self._buffer = retryList + self._buffer
+                return len(pending) - len(retryList) - droppedCount
+            except Exception:
+                # Put the events back (ahead of anything added since) so they are not lost
+                with self._buffer_lock:
+                    self._buffer = pending + self._buffer
+                raise
+
+            return len(pending)
+
+    def close(self):
+        self._stop_event.set()
+        self.flush()
+
+    # Must be called while holding the buffer lock
+    def _start_flush_thread(self):
+        if self._flush_thread is not None and self._flush_thread.is_alive():
+            return
+
+        self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flush_thread.start()
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the thread alive - the events stay in the buffer and are retried on the next flush
+                print(f'Flush of event log resulted in exception: {e}')
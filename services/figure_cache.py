@@ -0,0 +1,115 @@
+# Cache of plotly figures built by the Dash page callbacks, so that going back to a combination
+# of dropdown / slider values that has already been plotted doesn't rebuild the figure.
+# Figures are keyed by (page, input values, dataset version), so a new import invalidates them.
+# Recently used figures are kept in memory (LRU); if a directory is given they are also written
+# there as JSON, which lets several gunicorn workers on the same machine share them.
+
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import services.data_service as svc
+
+import set_up_globals
+
+
+class FigureCache:
+    def __init__(self, max_size=64, directory=None, max_files=1000, version=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_files = max_files
+        self.version = version  # Function returning the current dataset version
+        self._figures = OrderedDict()  # Key -> figure dict, least recently used first
+        self._lock = threading.Lock()
+
+    def key(self, page, inputs):
+        version = self.version() if self.version is not None else None
+        keyString = json.dumps([page, inputs, version], sort_keys=True, default=str)
+        return hashlib.sha256(keyString.encode('utf-8')).hexdigest()
+
+    # Return the cached figure (as a dict that can be given to dcc.Graph), or None
+    def get(self, key):
+        with self._lock:
+            figure = self._figures.get(key)
+            if figure is not None:
+                self._figures.move_to_end(key)
+                return figure
+
+        if self.directory is None:
+            return None
+        try:
+            with open(self._file_name(key), 'r') as f:
+                figure = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self._remember(key, figure)
+        return figure
+
+    def put(self, key, fig):
+        figureJson = fig if isinstance(fig, str) else fig.to_json()
+        figure = json.loads(figureJson)
+        self._remember(key, figure)
+
+        if self.directory is not None:
+            # Write to a temporary file first, so other workers never read a partial figure.
+            # The directory is created here, when the first figure is written, rather than on import.
+            fileName = self._file_name(key)
+            tempFileName = f'{fileName}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(tempFileName, 'w') as f:
+                    f.write(figureJson)
+                os.replace(tempFileName, fileName)
+                self._evict_files()
+            except OSError as e:
+                print(f'Unable to write figure to cache: {e}')
+
+        return figure
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for fileName in os.listdir(self.directory):
+                if fileName.endswith('.json'):
+                    os.remove(os.path.join(self.directory, fileName))
+
+    def _remember(self, key, figure):
+        with self._lock:
+            self._figures[key] = figure
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.max_size:
+                self._figures.popitem(last=False)
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    # Remove the least recently written figures once there are more than max_files on disk
+    def _evict_files(self):
+        fileTimes = []
+        for fileName in os.listdir(self.directory):
+            if fileName.endswith('.json'):
+                fileName = os.path.join(self.directory, fileName)
+                try:
+                    fileTimes.append((os.path.getmtime(fileName), fileName))
+                except OSError:
+                    pass  # Removed by another worker
+        if len(fileTimes) <= self.max_files:
+            return
+
+        fileTimes.sort()
+        for _, fileName in fileTimes[:len(fileTimes) - self.max_files]:
+            try:
+                os.remove(fileName)
+            except OSError:
+                pass
+
+
+figure_cache = FigureCache(max_size=set_up_globals.figure_cache_max_size,
+                           directory=set_up_globals.figure_cache_folder,
+                           max_files=set_up_globals.figure_cache_max_files,
+                           version=svc.cached_dataset_version)
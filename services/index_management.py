@@ -0,0 +1,181 @@
+# Index management and query plan auditing.
+# The indexes themselves are declared in the 'indexes' entry of each model's meta. ensure_indexes()
+# creates any that are missing (it is called when the Dash app starts, and by
+# python program_actions.py --ensure-indexes). audit_query_plans() runs explain() on the query made by
+# each query function in services/data_service.py (including the find_pathway_scores aggregation), and
+# reports any that scan a whole collection (COLLSCAN) or sort in memory (SORT), so that a missing index is
+# noticed before it reaches production:
+#     python program_actions.py --audit-indexes
+# A new query function should be added to audited_queries() along with its index.
+
+
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from data.assay_result_blocks import AssayResultBlock
+from data.biospecimens import Biospecimen
+from data.clinical_data import ClinicalData
+from data.data_label_types import DataLabels
+from data.data_label_types import DataLabelPathways
+from data.event_log import Event_log
+from data.users import User
+from data.version_history_deltas import VersionHistoryDelta
+from services.data_service import success_msg, error_msg, pathway_scores_pipeline
+
+indexedDocumentList = [User,
+                       ClinicalData,
+                       Biospecimen,
+                       DataLabels,
+                       DataLabelPathways,
+                       AssayResultBlock,
+                       Event_log,
+                       VersionHistoryDelta]
+
+# Plan stages that mean a query isn't (fully) supported by an index
+problemStageList = ['COLLSCAN', 'SORT']
+
+# Queries that read a whole collection by design, and the problem stages expected in their plans
+# (find_pathway_scores scores every sample in the database)
+expectedProblemDict = {'find_pathway_scores': ['COLLSCAN']}
+
+
+# Gives a database command (e.g. aggregate or distinct, which have no cursor) the explain() of a find,
+# so that it can be audited in the same way
+class CommandPlan:
+    def __init__(self, documentClass, command):
+        self.documentClass = documentClass
+        self.command = command  # e.g. {'distinct': collection name, 'key': field name}
+
+    def explain(self):
+        explanation = self.documentClass._get_collection().database.command('explain', self.command)
+        # For an aggregation that doesn't run entirely in the query layer, the query plan is in the $cursor stage
+        if 'queryPlanner' not in explanation:
+            for stage in explanation.get('stages', []):
+                if '$cursor' in stage:
+                    return stage['$cursor']
+        return explanation
+
+
+# Create any indexes declared in the models that don't exist yet (existing indexes are left as they are)
+def ensure_indexes():
+    for documentClass in indexedDocumentList:
+        documentClass.ensure_indexes()
+
+
+# Indexes declared in the models that are missing from the database, and indexes in the database
+# that aren't declared, as {collection name: {'missing': [...], 'extra': [...]}}
+def compare_indexes():
+    indexDict = {}
+    for documentClass in indexedDocumentList:
+        indexDict[documentClass._get_collection_name()] = documentClass.compare_indexes()
+
+    return indexDict
+
+
+# The query made by each query function in services/data_service.py. The values are placeholders,
+# since the plan depends on the shape of the query (fields, sort order), not on the values.
+def audited_queries():
+    return [
+        ('find_account_by_email', lambda: User.objects(email='').limit(1)),
+        ('find_clinical_data_by_study_id', lambda: ClinicalData.objects(study_id=0).limit(1)),
+        ('find_clinical_data', lambda: ClinicalData.objects().order_by('phenotype')),
+        ('find_cytokine_data', lambda: ClinicalData.objects(cytokine__unique_id__exists=True).order_by('phenotype')),
+        ('find_clinical_data_for_user', lambda: ClinicalData.objects(id__in=[ObjectId()]).order_by('phenotype')),
+        ('find_proteomic_data_only', lambda: ClinicalData.proteomic_data_only().order_by('phenotype')),
+        ('find_cytokine_data_only', lambda: ClinicalData.cytokine_data_only().order_by('phenotype')),
+        ('find_metabolomic_data_only', lambda: ClinicalData.metabolomic_data_only().order_by('phenotype')),
+        ('find_scrnaseq_summary_data_only', lambda: ClinicalData.scrnaseq_summary_data_only().order_by('phenotype')),
+        ('find_sub_document_data_as_dicts',
+         lambda: ClinicalData._get_collection().find({}, {'study_id': 1}).sort('phenotype', 1)),
+        ('find_biospecimen_data_by_specimen_id', lambda: Biospecimen.objects(specimen_id='').limit(1)),
+        ('find_biospecimen_data_by_study_id', lambda: Biospecimen.objects(study_id=0)),
+        ('find_biospecimen_maps',
+         lambda: Biospecimen.objects(__raw__={'$or': [{'specimen_id': {'$in': ['']}},
+                                                      {'study_id': {'$in': [0]}}]})),
+        ('find_pathway_data', lambda: DataLabelPathways.objects(pathway_name='').limit(1)),
+        ('find_pathway_names',
+         lambda: CommandPlan(DataLabelPathways, {'distinct': DataLabelPathways._get_collection_name(),
+                                                 'key': 'pathway_name'})),
+        ('find_pathway_scores',
+         lambda: CommandPlan(ClinicalData, {'aggregate': ClinicalData._get_collection_name(),
+                                            'pipeline': pathway_scores_pipeline(
+                                                [ObjectId()], ['proteomic', 'cytokine'], None,
+                                                ['unique_id', 'timepoint', 'assay_type', 'assay_method',
+                                                 'biospecimen_type', 'dataset_name']),
+                                            'cursor': {}})),
+        ('find_dataset_version',
+         lambda: Event_log._get_collection().find({'event_type': 'Import', 'success': True},
+                                                  {'created_date': 1}).sort('created_date', -1).limit(1)),
+        ('find_assay_result_blocks',
+         lambda: AssayResultBlock._get_collection().find({'assay_type': '', 'study_id': {'$in': [0]},
+                                                          'data_label_type': ''})),
+        ('find_data_label_reference', lambda: DataLabels.objects(data_label='', data_label_type='').limit(1)),
+        ('load_data_label_cache', lambda: DataLabels.objects(data_label_type='').order_by()),
+        ('find_data_label_ids',
+         lambda: DataLabels._get_collection().find({'data_label_type': '', 'data_label': {'$in': ['']}},
+                                                   {'data_label': 1})),
+        ('version_history.reconstruct_document',
+         lambda: VersionHistoryDelta._get_collection().find({'document_type': 'demographic',
+                                                             'document_id': ObjectId(),
+                                                             'version_number': {'$lte': 1}}
+                                                            ).sort('version_number', 1)),
+    ]
+
+
+# Every stage in a query plan (explain() output has the stages nested through inputStage / inputStages,
+# and, for the slot-based execution engine, queryPlan)
+def plan_stages(plan):
+    stageList = []
+    if not isinstance(plan, dict):
+        return stageList
+
+    if 'stage' in plan:
+        stageList.append(plan['stage'])
+    for key in ['queryPlan', 'inputStage']:
+        stageList.extend(plan_stages(plan.get(key)))
+    for inputStage in plan.get('inputStages', []):
+        stageList.extend(plan_stages(inputStage))
+
+    return stageList
+
+
+# Run explain() on each audited query and print its plan. Returns a list of (query function, problem stages)
+# for the queries that need attention. Queries on an empty (or missing) collection show as EOF.
+def audit_query_plans():
+    problemList = []
+    for functionName, query in audited_queries():
+        try:
+            explanation = query().explain()
+        except PyMongoError as e:
+            error_msg(f'{functionName}: explain() failed: {e}')
+            problemList.append((functionName, [e.__class__.__name__]))
+            continue
+
+        stageList = plan_stages(explanation.get('queryPlanner', {}).get('winningPlan', {}))
+        problemStages = [stage for stage in problemStageList
+                         if stage in stageList and stage not in expectedProblemDict.get(functionName, [])]
+        if len(problemStages) > 0:
+            error_msg(f'{functionName}: {" <- ".join(stageList)}')
+            problemList.append((functionName, problemStages))
+        else:
+            success_msg(f'{functionName}: {" <- ".join(stageList)}')
+
+    return problemList
+
+
+# Print any differences between the declared indexes and the database, then audit the query plans
+def print_index_report():
+    for collectionName, indexDiff in compare_indexes().items():
+        for index in indexDiff.get('missing', []):
+            error_msg(f'{collectionName}: missing index {index}')
+        for index in indexDiff.get('extra', []):
+            print(f'{collectionName}: index {index} is not declared in the model')
+
+    problemList = audit_query_plans()
+    if len(problemList) > 0:
+        error_msg(f'{len(problemList)} queries are not fully supported by an index: '
+                  f'{", ".join(functionName for functionName, _ in problemList)}')
+    else:
+        success_msg('Every audited query uses an index.')
+
+    return problemList
@@ -0,0 +1,167 @@
+# Query engine for Dash DataTables in server-side mode (page_action, filter_action and sort_action
+# set to 'custom'). The table's filter_query (e.g. {age} > 30 && {phenotype} = "HC") is parsed once,
+# and can then be applied to a pandas data frame or translated into a MongoDB query. Only the
+# current page, and only the visible columns, are returned to the browser.
+
+
+import math
+import re
+
+import pandas as pd
+
+# DataTable filter operators, and their symbolic equivalents
+filterOperatorDict = {'=': 'eq', 'eq': 'eq',
+                      '!=': 'ne', 'ne': 'ne',
+                      '<': 'lt', 'lt': 'lt',
+                      '<=': 'le', 'le': 'le',
+                      '>': 'gt', 'gt': 'gt',
+                      '>=': 'ge', 'ge': 'ge',
+                      'contains': 'contains',
+                      'datestartswith': 'datestartswith',
+                      'is blank': 'blank',
+                      'is not blank': 'not blank'}
+
+filterPartPattern = re.compile(r'^\s*\{(?P<column>[^}]+)\}\s*'
+                               r'(?P<operator>is not blank|is blank|datestartswith|contains|'
+                               r'<=|>=|!=|<|>|=|eq|ne|lt|le|gt|ge)'
+                               r'\s*(?P<value>.*?)\s*$', re.IGNORECASE)
+
+mongoOperatorDict = {'eq': '$eq', 'ne': '$ne', 'lt': '$lt', 'le': '$lte', 'gt': '$gt', 'ge': '$gte'}
+
+
+# Convert a filter value to a number if possible (quoted values are always strings)
+def parse_filter_value(value):
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+        return value[1:-1]
+    try:
+        number = float(value)
+        return int(number) if number.is_integer() and '.' not in value else number
+    except ValueError:
+        return value
+
+
+# Parse a DataTable filter_query into a list of (column, operator, value) tuples.
+# Parts that can't be parsed are skipped, which matches how the table treats invalid filters.
+def parse_filter_query(filter_query):
+    filters = []
+    if not filter_query:
+        return filters
+
+    for filterPart in filter_query.split(' && '):
+        match = filterPartPattern.match(filterPart)
+        if not match:
+            continue
+        operator = filterOperatorDict[match.group('operator').lower()]
+        value = None if operator in ('blank', 'not blank') else parse_filter_value(match.group('value'))
+        filters.append((match.group('column'), operator, value))
+
+    return filters
+
+
+# Return a boolean mask for one filter applied to a data frame column
+def filter_mask(series, operator, value):
+    if operator == 'blank':
+        return series.isna() | (series.astype(str).str.strip() == '')
+    if operator == 'not blank':
+        return ~filter_mask(series, 'blank', None)
+    if operator == 'contains':
+        return series.astype(str).str.contains(str(value), regex=False)
+    if operator == 'datestartswith':
+        return series.astype(str).str.startswith(str(value))
+
+    # Compare numerically when the value is a number (non-numeric cells never match),
+    # otherwise compare as strings
+    if isinstance(value, (int, float)):
+        series = pd.to_numeric(series, errors='coerce')
+    else:
+        series = series.astype(str)
+        value = str(value)
+
+    if operator == 'eq':
+        return series == value
+    if operator == 'ne':
+        return series != value
+    if operator == 'lt':
+        return series < value
+    if operator == 'le':
+        return series <= value
+    if operator == 'gt':
+        return series > value
+    return series >= value
+
+
+def filter_data_frame(df, filters):
+    for column, operator, value in filters:
+        if column not in df.columns:
+            continue
+        df = df.loc[filter_mask(df[column], operator, value)]
+    return df
+
+
+def sort_data_frame(df, sort_by):
+    sort_by = [s for s in (sort_by or []) if s['column_id'] in df.columns]
+    if len(sort_by) < 1:
+        return df
+    return df.sort_values([s['column_id'] for s in sort_by],
+                          ascending=[s['direction'] == 'asc' for s in sort_by],
+                          na_position='last',
+                          kind='mergesort')
+
+
+# Run a DataTable query against a data frame. Returns the records for the current
+# page (only the given columns, if any) and the number of pages.
+def query_data_frame(df, page_current, page_size, sort_by=None, filter_query=None, columns=None):
+    dff = filter_data_frame(df, parse_filter_query(filter_query))
+    dff = sort_data_frame(dff, sort_by)
+
+    page_current = page_current or 0
+    page_count = max(1, math.ceil(len(dff) / page_size))
+    dff = dff.iloc[page_current * page_size:(page_current + 1) * page_size]
+    if columns is not None:
+        dff = dff[[c for c in columns if c in dff.columns]]
+
+    return dff.to_dict('records'), page_count
+
+
+# Translate parsed filters into a MongoDB query. fieldMap maps table column ids
+# to database fields (e.g. 'sampleid' -> 'scrnaseq_summary._id'), if they differ.
+def filters_to_mongo_query(filters, fieldMap=None):
+    fieldMap = fieldMap or {}
+    conditions = []
+    for column, operator, value in filters:
+        field = fieldMap.get(column, column)
+        if operator == 'blank':
+            conditions.append({'$or': [{field: None}, {field: ''}]})
+        elif operator == 'not blank':
+            conditions.append({field: {'$nin': [None, '']}})
+        elif operator == 'contains':
+            conditions.append({field: {'$regex': re.escape(str(value))}})
+        elif operator == 'datestartswith':
+            conditions.append({field: {'$regex': '^' + re.escape(str(value))}})
+        else:
+            conditions.append({field: {mongoOperatorDict[operator]: value}})
+
+    if len(conditions) < 1:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+
+# Run a DataTable query against a MongoDB collection. Returns the documents for the
+# current page (only the given columns, if any) and the number of pages.
+def query_collection(collection, page_current, page_size, sort_by=None, filter_query=None, columns=None,
+                     fieldMap=None):
+    fieldMap = fieldMap or {}
+    query = filters_to_mongo_query(parse_filter_query(filter_query), fieldMap)
+    projection = None if columns is None else {fieldMap.get(c, c): 1 for c in columns}
+
+    cursor = collection.find(query, projection)
+    if sort_by:
+        cursor = cursor.sort([(fieldMap.get(s['column_id'], s['column_id']), 1 if s['direction'] == 'asc' else -1)
+                              for s in sort_by])
+    page_current = page_current or 0
+    documents = list(cursor.skip(page_current * page_size).limit(page_size))
+    page_count = max(1, math.ceil(collection.count_documents(query) / page_size))
+
+    return documents, page_count
@@ -0,0 +1,159 @@
+# Delta-based version history for demographic (ClinicalData) and biospecimen documents.
+# In the default 'full' mode (set_up_globals.version_history_mode), every update copies the whole
+# document, including all of its embedded assay data, into a version history collection. In 'delta'
+# mode each version is stored in the version_history_deltas collection as a JSON-patch style list of
+# changes from the previous version, with a full snapshot every version_history_snapshot_interval
+# versions, so that any version can be rebuilt from a snapshot and a few patches.
+# The embedded assay, scRNA-seq summary and REDCap arrays of the demographic data are left out of the
+# delta history (see historyExcludedFieldDict): they are written by the import functions without a new
+# version being created, so a patch computed from them wouldn't belong to any one version. Only the
+# demographic fields themselves are versioned, and a reconstructed version doesn't include those arrays.
+
+
+import copy
+import datetime
+
+from pymongo import UpdateOne
+
+from data.clinical_data import ClinicalData
+from data.biospecimens import Biospecimen
+from data.users import User
+from data.version_history_deltas import VersionHistoryDelta
+
+import set_up_globals
+
+documentClassDict = {'demographic': ClinicalData,
+                     'biospecimen': Biospecimen}
+
+# Fields of each document type that aren't kept in the delta history
+historyExcludedFieldDict = {'demographic': ['redcap', 'proteomic', 'cytokine', 'metabolomic', 'scrnaseq_summary'],
+                            'biospecimen': []}
+
+
+def escape_path_key(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def unescape_path_key(key):
+    return key.replace('~1', '/').replace('~0', '~')
+
+
+# JSON-patch style operations that turn oldDocument into newDocument. Embedded documents are
+# compared field by field; lists (e.g. of assay results) are replaced as a whole if they differ.
+def compute_patch(oldDocument, newDocument, path=''):
+    patch = []
+    for key in oldDocument:
+        if key not in newDocument:
+            patch.append({'op': 'remove', 'path': f'{path}/{escape_path_key(key)}'})
+
+    for key, value in newDocument.items():
+        keyPath = f'{path}/{escape_path_key(key)}'
+        if key not in oldDocument:
+            patch.append({'op': 'add', 'path': keyPath, 'value': value})
+        elif isinstance(value, dict) and isinstance(oldDocument[key], dict):
+            patch.extend(compute_patch(oldDocument[key], value, keyPath))
+        elif oldDocument[key] != value:
+            patch.append({'op': 'replace', 'path': keyPath, 'value': value})
+
+    return patch
+
+
+def apply_patch(document, patch):
+    document = copy.deepcopy(document)
+    for operation in patch:
+        keys = [unescape_path_key(key) for key in operation['path'].split('/')[1:]]
+        target = document
+        for key in keys[:-1]:
+            target = target[key]
+        if operation['op'] == 'remove':
+            target.pop(keys[-1], None)
+        else:
+            target[keys[-1]] = copy.deepcopy(operation['value'])
+
+    return document
+
+
+# The part of a raw document that is kept in the delta history
+def history_document(documentType, document):
+    if document is None:
+        return None
+    return {key: value for key, value in document.items() if key not in historyExcludedFieldDict[documentType]}
+
+
+# Record a new version of a document. oldDocument is the raw current version of the document
+# (None if the document is new), and newDocument the raw version about to be saved.
+# Entries are upserted on version number, so retrying a failed save doesn't duplicate them.
+def record_version(active_account: User, documentType, documentId, oldDocument, oldVersion, newDocument,
+                   newVersion):
+    oldDocument = history_document(documentType, oldDocument)
+    newDocument = history_document(documentType, newDocument)
+    collection = VersionHistoryDelta._get_collection()
+    documentFilter = {'document_type': documentType, 'document_id': documentId}
+    latest = collection.find_one(dict(documentFilter, version_number={'$lt': newVersion}),
+                                 {'version_number': 1, 'snapshot_version': 1},
+                                 sort=[('version_number', -1)])
+
+    def history_entry(version, snapshotVersion, snapshot, patch):
+        return UpdateOne(dict(documentFilter, version_number=version),
+                         {'$set': {'created_by': active_account.id,
+                                   'created_date': datetime.datetime.now(),
+                                   'snapshot_version': snapshotVersion,
+                                   'snapshot': snapshot,
+                                   'patch': patch}},
+                         upsert=True)
+
+    operations = []
+    snapshotVersion = latest['snapshot_version'] if latest else None
+    if oldDocument is not None and (latest is None or latest['version_number'] != oldVersion):
+        # The current version hasn't been recorded (e.g. it was saved before delta mode was turned on)
+        operations.append(history_entry(oldVersion, oldVersion, oldDocument, []))
+        snapshotVersion = oldVersion
+
+    if snapshotVersion is None or newVersion - snapshotVersion >= set_up_globals.version_history_snapshot_interval:
+        operations.append(history_entry(newVersion, newVersion, newDocument, []))
+    else:
+        operations.append(history_entry(newVersion, snapshotVersion, None, compute_patch(oldDocument, newDocument)))
+
+    collection.bulk_write(operations, ordered=True)
+
+
+# Rebuild a version of a document (as a raw dict, without the fields in historyExcludedFieldDict)
+# from the delta history, or return None if that version isn't in the history
+def reconstruct_document(documentType, documentId, version):
+    currentDocument = documentClassDict[documentType]._get_collection().find_one({'_id': documentId})
+    if currentDocument is not None and currentDocument.get('version_number') == version:
+        return history_document(documentType, currentDocument)
+
+    collection = VersionHistoryDelta._get_collection()
+    documentFilter = {'document_type': documentType, 'document_id': documentId}
+    entry = collection.find_one(dict(documentFilter, version_number=version), {'snapshot_version': 1})
+    if entry is None:
+        return None
+
+    entryList = list(collection.find(dict(documentFilter,
+                                          version_number={'$gte': entry['snapshot_version'], '$lte': version}),
+                                     sort=[('version_number', 1)]))
+    if len(entryList) < 1 or entryList[0]['version_number'] != entry['snapshot_version']:
+        return None  # The snapshot is missing
+
+    document = entryList[0]['snapshot']
+    for entry in entryList[1:]:
+        document = apply_patch(document, entry['patch'])
+
+    return document
+
+
+# Rebuild a version of the demographic data for a study
+def reconstruct(study_id, version):
+    clinical_data = ClinicalData._get_collection().find_one({'study_id': int(study_id)}, {'_id': 1})
+    if clinical_data is None:
+        return None
+    return reconstruct_document('demographic', clinical_data['_id'], version)
+
+
+# Rebuild a version of a biospecimen
+def reconstruct_biospecimen(specimen_id, version):
+    biospecimen_data = Biospecimen._get_collection().find_one({'specimen_id': specimen_id}, {'_id': 1})
+    if biospecimen_data is None:
+        return None
+    return reconstruct_document('biospecimen', biospecimen_data['_id'], version)
@@ -23,6 +23,64 @@ exitResponseList = ['x', 'bye', 'exit', 'exit()']
 
 import_log_file = 'data_import.log'
 
+# Assay spreadsheets are read and imported import_chunk_size rows at a time (see workbook_reader.py)
+import_chunk_size = 5000
+
+# Number of threads saving data in a batch import (python program_actions.py --batch PATH --user EMAIL)
+batch_import_writers = 4
+
+# Most workbooks a batch import holds in memory at once (being read, waiting to be saved, or being saved)
+batch_import_max_parsed = 8
+
+# Event log entries are buffered and written in batches of event_log_flush_size
+# entries, or every event_log_flush_interval seconds, whichever comes first
+event_log_flush_size = 500
+event_log_flush_interval = 5
+
+# Where assay results (proteomic, cytokine, metabolomic) are stored:
+# 'embedded' - as assay_results lists inside each sub-document of the demographic data
+# 'columnar' - as packed blocks in the assay_result_blocks collection (one block per sample)
+# After switching to 'columnar', re-import the assay data: the results of each re-imported row are
+# moved from the sub-document into its block, and the pages only read results from the blocks
+assay_results_storage = 'embedded'
+
+# How previous versions of demographic and biospecimen data are kept:
+# 'full'  - a full copy of the document in the version history collections for every update
+# 'delta' - a JSON-patch style diff per version, with a full snapshot every
+#           version_history_snapshot_interval versions (see services/version_history.py)
+version_history_mode = 'full'
+version_history_snapshot_interval = 10
+
+# Create any missing indexes declared in the models when the Dash app starts (see services/index_management.py)
+ensure_indexes_on_startup = True
+
+# Data frames used by the Dash pages are built on first use and cached (see services/data_cache.py).
+# At most data_cache_max_size datasets are kept, and each one is rebuilt after data_cache_ttl seconds
+data_cache_max_size = 8
+data_cache_ttl = 600
+
+# The dataset version (time of the latest import) used by the data and figure caches is
+# re-read from the database at most every dataset_version_ttl seconds
+dataset_version_ttl = 5
+
+# Number of pathway score data frames kept by svc.pathway_scores
+pathway_scores_cache_size = 32
+
+# Rows per page for data tables in server-side mode (see utilities.data_table)
+data_table_page_size = 25
+
+# Figures built by the Dash pages are cached (see services/figure_cache.py): the most recent
+# figure_cache_max_size in memory, and up to figure_cache_max_files in figure_cache_folder,
+# which is shared by all the app's worker processes (set it to None for memory only)
+figure_cache_max_size = 64
+figure_cache_folder = '../figure_cache/'
+figure_cache_max_files = 1000
+
+# Scatter plots with more than scatter_webgl_threshold points are drawn with WebGL, and data sets with
+# more than scatter_max_points points are downsampled before plotting (see utilities.grid_downsample)
+scatter_webgl_threshold = 1000
+scatter_max_points = 5000
+
 clinical_document_name = 'demographic'
 redcap_document_name = 'REDCap'
 biospecimen_document_name = 'biospecimens'
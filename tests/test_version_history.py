@@ -0,0 +1,166 @@
+# Tests for the delta version history (services/version_history.py). The Mongo collections are replaced
+# by an in-memory FakeCollection that supports the few queries version_history makes.
+
+import copy
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('mongoengine')
+pytest.importorskip('pymongo')
+
+import set_up_globals
+import services.version_history as version_history
+
+
+# Does a document match a filter of plain values and $lt / $lte / $gte conditions
+def matches(document, documentFilter):
+    for key, condition in documentFilter.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            if '$lt' in condition and not (value is not None and value < condition['$lt']):
+                return False
+            if '$lte' in condition and not (value is not None and value <= condition['$lte']):
+                return False
+            if '$gte' in condition and not (value is not None and value >= condition['$gte']):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeUpdateOne:
+    def __init__(self, documentFilter, update, upsert=False):
+        self.documentFilter = documentFilter
+        self.update = update
+        self.upsert = upsert
+
+
+class FakeCollection:
+    def __init__(self, documentList=None):
+        self.documentList = copy.deepcopy(documentList or [])
+
+    def find(self, documentFilter, projection=None, sort=None):
+        documentList = [copy.deepcopy(document) for document in self.documentList if matches(document, documentFilter)]
+        for key, direction in reversed(sort or []):
+            documentList.sort(key=lambda document: document[key], reverse=direction < 0)
+        return documentList
+
+    def find_one(self, documentFilter, projection=None, sort=None):
+        documentList = self.find(documentFilter, projection, sort)
+        return documentList[0] if len(documentList) > 0 else None
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            documentList = [document for document in self.documentList if matches(document, operation.documentFilter)]
+            if len(documentList) == 0 and operation.upsert:
+                document = dict(operation.documentFilter)
+                self.documentList.append(document)
+                documentList = [document]
+            for document in documentList:
+                document.update(copy.deepcopy(operation.update['$set']))
+
+
+@pytest.mark.parametrize('oldDocument, newDocument', [
+    ({}, {}),
+    ({'a': 1}, {'a': 1}),
+    ({'a': 1}, {'a': 2}),
+    ({'a': 1, 'b': 2}, {'a': 1}),
+    ({'a': 1}, {'a': 1, 'b': [1, 2]}),
+    ({'a': {'b': 1, 'c': 2}}, {'a': {'b': 1, 'd': 3}}),
+    ({'a': {'b': {'c': 1}}}, {'a': {'b': {'c': 2}, 'e': None}}),
+    ({'a': {'b': 1}}, {'a': 5}),
+    ({'a': 5}, {'a': {'b': 1}}),
+    ({'a': [1, 2, 3]}, {'a': [1, 3]}),
+    ({'a': [{'b': 1}]}, {'a': [{'b': 2}, {'c': 3}]}),
+    ({'a/b': 1, 'c~d': 2, '~1': 3}, {'a/b': 2, '~1': {'/': 4}, 'e~/': 5}),
+])
+def test_apply_patch_round_trip(oldDocument, newDocument):
+    originalDocument = copy.deepcopy(oldDocument)
+    patch = version_history.compute_patch(oldDocument, newDocument)
+
+    assert version_history.apply_patch(oldDocument, patch) == newDocument
+    assert oldDocument == originalDocument  # apply_patch works on a copy
+
+
+def test_apply_patch_empty_when_unchanged():
+    document = {'a': {'b': [1, 2]}, 'c': 'd'}
+    assert version_history.compute_patch(document, copy.deepcopy(document)) == []
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    deltaCollection = FakeCollection()
+    documentCollection = FakeCollection()
+    monkeypatch.setattr(version_history, 'UpdateOne', FakeUpdateOne)
+    monkeypatch.setattr(version_history.VersionHistoryDelta, '_get_collection', lambda: deltaCollection)
+    monkeypatch.setattr(version_history.ClinicalData, '_get_collection', lambda: documentCollection)
+    monkeypatch.setattr(set_up_globals, 'version_history_snapshot_interval', 3)
+    return SimpleNamespace(deltas=deltaCollection, documents=documentCollection)
+
+
+# Save versions 0..count-1 of a demographic document the way add_clinical_data does in delta mode
+def save_versions(collections, documentId, versionList):
+    account = SimpleNamespace(id='account')
+    previousDocument = None
+    for version, document in enumerate(versionList):
+        document = dict(document, _id=documentId, version_number=version)
+        if previousDocument is None:
+            version_history.record_version(account, 'demographic', documentId, None, None, document, version)
+        else:
+            version_history.record_version(account, 'demographic', documentId, previousDocument, version - 1,
+                                           document, version)
+        collections.documents.documentList = [copy.deepcopy(document)]
+        previousDocument = document
+
+
+def test_reconstruct_round_trip(collections):
+    versionList = [{'study_id': 1, 'phenotype': 'ME/CFS', 'age': 30}]
+    for version in range(1, 8):
+        document = copy.deepcopy(versionList[-1])
+        document['age'] = 30 + version
+        if version % 2 == 0:
+            document['biospecimen_data_references'] = [f'specimen {index}' for index in range(version)]
+        if version == 5:
+            document.pop('phenotype')
+        versionList.append(document)
+
+    save_versions(collections, 'document id', versionList)
+
+    for version, document in enumerate(versionList):
+        expectedDocument = dict(document, _id='document id', version_number=version)
+        assert version_history.reconstruct_document('demographic', 'document id', version) == expectedDocument
+
+    assert version_history.reconstruct_document('demographic', 'document id', len(versionList)) is None
+    assert version_history.reconstruct_document('demographic', 'other id', 0) is None
+
+
+def test_reconstruct_ignores_embedded_assay_arrays(collections):
+    versionList = [{'study_id': 1, 'age': 30, 'cytokine': [{'unique_id': 'a'}]},
+                   {'study_id': 1, 'age': 31, 'cytokine': [{'unique_id': 'a'}, {'unique_id': 'b'}]},
+                   {'study_id': 1, 'age': 32, 'cytokine': [], 'redcap': [{'excel_file_id': 0}]}]
+    save_versions(collections, 'document id', versionList)
+
+    # The assay import functions change the embedded arrays without creating a new version
+    collections.documents.documentList[0]['cytokine'] = [{'unique_id': 'c'}]
+
+    for entry in collections.deltas.documentList:
+        for field in version_history.historyExcludedFieldDict['demographic']:
+            assert field not in (entry['snapshot'] or {})
+            assert all(operation['path'] != f'/{field}' for operation in entry['patch'])
+
+    for version, document in enumerate(versionList):
+        expectedDocument = {'_id': 'document id', 'version_number': version, 'study_id': 1, 'age': document['age']}
+        assert version_history.reconstruct_document('demographic', 'document id', version) == expectedDocument
+
+
+def test_record_version_for_document_saved_before_delta_mode(collections):
+    account = SimpleNamespace(id='account')
+    oldDocument = {'_id': 'document id', 'version_number': 4, 'age': 30}
+    newDocument = {'_id': 'document id', 'version_number': 5, 'age': 31}
+    version_history.record_version(account, 'demographic', 'document id', oldDocument, 4, newDocument, 5)
+    collections.documents.documentList = [copy.deepcopy(newDocument)]
+
+    assert version_history.reconstruct_document('demographic', 'document id', 4) == oldDocument
+    assert version_history.reconstruct_document('demographic', 'document id', 5) == newDocument
+    assert version_history.reconstruct_document('demographic', 'document id', 3) is None
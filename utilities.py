@@ -6,14 +6,20 @@
 # Created: 10/19/2020
 
 
+import functools
+
 import numpy as np
 import pandas as pd
 import dash_table
 import dash_core_components as dcc
+from dash.dependencies import Input, Output
 # import dash_bootstrap_components as dbc
 import plotly.express as px
 
 from data.clinical_data import ClinicalData
+from data.data_label_types import DataLabels
+import services.table_query as table_query
+import set_up_globals
 
 
 # Get attributes for class that do not start with '_'
@@ -22,6 +28,34 @@ def attributes(cls):
     return [i for i in cls.__dict__.keys() if not i.startswith('_') and i not in excludeFields]
 
 
+# Return the name a field is stored under in the database (e.g. a primary key is stored as _id)
+def db_field_name(cls, fieldName):
+    field = cls._fields.get(fieldName)
+    return field.db_field if field is not None else fieldName
+
+
+# Return a document as a raw (pymongo) dictionary. Raw dictionaries are used as is, which
+# avoids the cost of building mongoengine documents (and dereferencing their references)
+def as_raw_document(document):
+    if isinstance(document, dict):
+        return document
+    return document.to_mongo()
+
+
+# Resolve the data labels that belong to a pathway, as a set of ObjectIds. A data label is in the
+# pathway if its (first) gene symbol reference is one of the pathway's data label references
+def pathway_data_label_ids(dataLabelPathway):
+    if dataLabelPathway is None:
+        return set()
+    pathwayReferences = dataLabelPathway.to_mongo().get('data_label_references', [])
+    return {d['_id'] for d in DataLabels._get_collection().find(
+        {'gene_symbol_references.0': {'$in': pathwayReferences}}, {'_id': 1})}
+
+
+# Build a data frame with one row per sub-document (or per study, if the study has no sub-documents).
+# Values are collected in long form and the assay results are pivoted to one column per data label,
+# in the order the data labels are first seen. object_list can hold raw dictionaries (see
+# svc.find_sub_document_data_as_dicts) or mongoengine documents.
 def create_df_from_object_list(object_list, clsList, subDocumentList, assayResultsFlag=False, dataLabelPathwayIDs=None):
     # columnsFromClinicalData = ['study_id', 'phenotype', 'site', 'sex', 'age',
     #                            'height_in', 'weight_lbs', 'bmi', 'ethnicity',
@@ -32,7 +66,7 @@ def create_df_from_object_list(object_list, clsList, subDocumentList, assayResul
     attribute_names = attributes(clsList[0])  # Use attributes from first class (should match other classes)
     # Remove non-JSON serializable objects (of type User, Biospecimen, etc.)
     itemsToRemove = ['created_by', 'last_modified_by', 'created_date', 'last_modified_date',
-                     'biospecimen_data_reference', 'biospecimen_data_references', 'assay_results']
+                     'biospecimen_data_reference', 'biospecimen_data_references', 'assay_results', 'content_hash']
     for item in itemsToRemove:
         if item in attribute_names:
             attribute_names.remove(item)
@@ -42,97 +76,51 @@ def create_df_from_object_list(object_list, clsList, subDocumentList, assayResul
     print('Attributes:', attribute_names)
     print('columnsFromClinicalData:', columnsFromClinicalData)
 
-    # Build list of data labels up front - this means looping thru
-    # the object list twice, but I don't see a better way to do it
-    dataLabelsList = []
-    for c in object_list:
-        for subDocument in subDocumentList:
-            for sd in c[subDocument]:
-                if assayResultsFlag:
-                    for assayResult in sd.assay_results:
-                        # If dataLabelPathwayIDs is empty then get all data labels,
-                        # otherwise, only get those in dataLabelPathwayIDs
-                        if dataLabelPathwayIDs is None:
-                            if assayResult['data_label'] not in dataLabelsList:
-                                dataLabelsList.append(assayResult['data_label'])
-                        else:
-                            if assayResult.data_label_reference is None:
-                                # print('assayResult.data_label:', assayResult.data_label, 'is missing a data label reference')
-                                continue
-                            # print('assayResult.data_label_reference.gene_symbol_references:', assayResult.data_label_reference.gene_symbol_references[0].data_label)
-                            if assayResult['data_label'] not in dataLabelsList and \
-                                    assayResult.data_label_reference.gene_symbol_references[
-                                        0] in dataLabelPathwayIDs.data_label_references:
-                                dataLabelsList.append(assayResult['data_label'])
-    # print('dataLabelsList:', dataLabelsList)
+    clinicalDBFields = [db_field_name(ClinicalData, dataColumn) for dataColumn in columnsFromClinicalData]
+    subDocumentDBFields = [db_field_name(clsList[0], dataColumn) for dataColumn in attribute_names]
+    emptySubDocument = [None] * len(attribute_names)
+
+    # If dataLabelPathwayIDs is empty then get all data labels,
+    # otherwise, only get those in the pathway (resolved once, up front)
+    pathwayDataLabelIDs = None
+    if dataLabelPathwayIDs is not None:
+        pathwayDataLabelIDs = pathway_data_label_ids(dataLabelPathwayIDs)
 
     data = []
+    resultData = []  # (row number, data label, result)
+    dataLabelsDict = {}  # Keeps data labels in the order they are first seen
     for c in object_list:
-        # print('Study ID: {} - {}, {}, {}'.format(
-        #     c['study_id'],
-        #     'ME/CFS patient' if c['phenotype'] == 'ME/CFS' else 'Healthy control',
-        #     c['sex'],
-        #     c['proteomic']))
+        c = as_raw_document(c)
+        clinicalRow = [c.get(dbField) for dbField in clinicalDBFields]
         for subDocument in subDocumentList:
-            if not c[subDocument]:
-                dataRow = []
-                # Add clinical data
-                for dataColumn in columnsFromClinicalData:
-                    dataRow.append(c[dataColumn])
-
-                attributeNameList = np.repeat(None, len(attribute_names)).tolist()
-                for val in attributeNameList:
-                    dataRow.append(val)
+            subDocumentData = c.get(subDocument) or []
+            if len(subDocumentData) < 1:
+                data.append(clinicalRow + emptySubDocument)
+                continue
 
+            for sd in subDocumentData:
                 if assayResultsFlag:
-                    resultList = np.repeat(None, len(dataLabelsList)).tolist()
-                    for val in resultList:
-                        dataRow.append(val)
-
-                data.append(dataRow)
-            else:
-                for sd in c[subDocument]:
-                    dataRow = []
-                    # Add clinical data
-                    for dataColumn in columnsFromClinicalData:
-                        dataRow.append(c[dataColumn])
-
-                    for dataColumn in attribute_names:
-                        dataRow.append(sd[dataColumn])
-
-                    if assayResultsFlag:
-                        # So that we keep all data labels in the correct order and position (for assays with different
-                        # symbols), first build a list of 'None' and then insert the result in the appropriate position
-                        resultList = np.repeat(None, len(dataLabelsList)).tolist()
-                        for assayResult in sd.assay_results:
-                            # If dataLabelPathwayIDs is empty then get all data labels,
-                            # otherwise, only get those in dataLabelPathwayIDs
-                            dataLabel = assayResult['data_label']
-                            if dataLabel not in dataLabelsList:
-                                continue  # These are not the labels you are looking for...
-                            # Get position in dataLabelsList
-                            dataLabelIndex = dataLabelsList.index(dataLabel)
-                            # Insert result into that position in resultList
-                            resultList[dataLabelIndex] = assayResult['result']
-                        for val in resultList:
-                            dataRow.append(val)
-
-                    # print('len dataRow:', len(dataRow))
-                    # print('dataRow:', dataRow)
-                    data.append(dataRow)
-    # print('data:', data)
-
-    # Build list of column names
-    colNamesList = []
-    for dataColumn in columnsFromClinicalData:
-        colNamesList.append(dataColumn)
-    for dataColumn in attribute_names:
-        colNamesList.append(dataColumn)
-    for dataColumn in dataLabelsList:
-        colNamesList.append(dataColumn)
-
-    # print('data:', data)
-    df = pd.DataFrame(data, columns=colNamesList)
+                    rowNumber = len(data)
+                    for assayResult in sd.get('assay_results', []):
+                        if pathwayDataLabelIDs is not None and \
+                                assayResult.get('data_label_reference') not in pathwayDataLabelIDs:
+                            continue  # These are not the labels you are looking for...
+                        dataLabelsDict.setdefault(assayResult['data_label'])
+                        resultData.append((rowNumber, assayResult['data_label'], assayResult.get('result')))
+
+                data.append(clinicalRow + [sd.get(dbField) for dbField in subDocumentDBFields])
+
+    dataLabelsList = list(dataLabelsDict)
+    df = pd.DataFrame(data, columns=columnsFromClinicalData + attribute_names)
+
+    if assayResultsFlag:
+        # Pivot the results to wide form (if a data label appears twice in a sub-document, the last result is kept)
+        resultDF = pd.DataFrame(resultData, columns=['row_number', 'data_label', 'result'])
+        resultDF = resultDF.drop_duplicates(subset=['row_number', 'data_label'], keep='last')
+        resultDF = resultDF.pivot(index='row_number', columns='data_label', values='result')
+        resultDF = resultDF.reindex(index=range(len(data)), columns=dataLabelsList)
+        resultDF.columns.name = None
+        df = pd.concat([df, resultDF.astype(float)], axis=1)
 
     return df, dataLabelsList
 
@@ -155,15 +143,58 @@ def spinner_wrapper(component):
         color="#119DFF", type="default", fullscreen=False, )
 
 
-def data_table(table_id, df):
+def data_table_columns(columnList):
+    return [
+        {"name": i, "id": i, "deletable": True, "selectable": True, "hideable": True}
+        if i == "study_id" or i == "site" or i == "id" or i == "created_date" or i == "last_modified_date"
+        else {"name": i, "id": i, "deletable": True, "selectable": True}
+        for i in columnList
+    ]
+
+
+# With server_side=True, paging, filtering and sorting are done on the server, and only the current page
+# is sent to the browser. The table data is then filled in by a callback (see register_server_side_table).
+# columns limits the table to a subset of the data frame columns (default is all of them).
+def data_table(table_id, df, server_side=False, columns=None):
+    if server_side:
+        return dash_table.DataTable(
+            id=table_id,
+            columns=data_table_columns(df.columns if columns is None else columns),
+            data=[],  # filled in by the server-side callback
+            editable=False,
+            filter_action="custom",  # filter_query is applied on the server
+            filter_query='',
+            sort_action="custom",  # sort_by is applied on the server
+            sort_mode="single",
+            sort_by=[],
+            column_selectable="multi",
+            row_selectable="multi",
+            row_deletable=False,  # a deleted row would come back with the next page request
+            selected_columns=[],
+            selected_rows=[],
+            page_action="custom",  # only the current page is sent to the browser
+            page_current=0,
+            page_size=set_up_globals.data_table_page_size,
+            page_count=1,
+            hidden_columns=[],
+            style_cell={
+                'minWidth': 95, 'maxWidth': 95, 'width': 95
+            },
+            style_cell_conditional=[
+                {
+                    'if': {'column_id': c},
+                    'textAlign': 'left'
+                } for c in ['sex', 'phenotype']
+            ],
+            style_data={
+                'whiteSpace': 'normal',
+                'height': 'auto'
+            }
+        )
+
     return dash_table.DataTable(
         id=table_id,
-        columns=[
-            {"name": i, "id": i, "deletable": True, "selectable": True, "hideable": True}
-            if i == "study_id" or i == "site" or i == "id" or i == "created_date" or i == "last_modified_date"
-            else {"name": i, "id": i, "deletable": True, "selectable": True}
-            for i in df.columns
-        ],
+        columns=data_table_columns(df.columns if columns is None else columns),
         data=df.to_dict('records'),  # the contents of the table
         editable=False,  # allow editing of data inside all cells
         filter_action="native",  # allow filtering of data by user ('native') or not ('none')
@@ -191,3 +222,102 @@ def data_table(table_id, df):
             'height': 'auto'
         }
     )
+
+
+# Register the callback that serves a server-side data table (see data_table). get_data_frame is called
+# for every request, so it should return a cached data frame. Only the current page of the filtered and
+# sorted data is returned, and only for the columns that are visible (not deleted or hidden).
+def register_server_side_table(app, table_id, get_data_frame):
+    @app.callback(
+        [Output(table_id, 'data'),
+         Output(table_id, 'page_count')],
+        [Input(table_id, 'page_current'),
+         Input(table_id, 'page_size'),
+         Input(table_id, 'sort_by'),
+         Input(table_id, 'filter_query'),
+         Input(table_id, 'columns'),
+         Input(table_id, 'hidden_columns')]
+    )
+    def update_server_side_table(page_current, page_size, sort_by, filter_query, columns, hidden_columns):
+        hiddenColumns = set(hidden_columns or [])
+        visibleColumns = [c['id'] for c in columns or [] if c['id'] not in hiddenColumns]
+        return table_query.query_data_frame(get_data_frame(), page_current,
+                                            page_size or set_up_globals.data_table_page_size,
+                                            sort_by, filter_query, visibleColumns)
+
+    return update_server_side_table
+
+
+# Demographic and metadata columns of an assay data frame, i.e. every column except the analytes
+def metadata_columns(df, dataLabelList):
+    dataLabelSet = set(dataLabelList)
+    return [c for c in df.columns if c not in dataLabelSet]
+
+
+# Searchable picker for the analyte columns of a wide assay table (see register_column_picker)
+def column_picker(picker_id, dataLabelList):
+    return dcc.Dropdown(
+        id=picker_id, value=[],
+        options=[{'label': x, 'value': x} for x in dataLabelList],
+        multi=True,
+        searchable=True,
+        placeholder='Add analyte columns to the table',
+        style={"width": "90%"}
+    )
+
+
+# Show the metadata columns of a server-side data table, plus the analytes chosen in its column picker.
+# The server-side table callback only returns visible columns, so an analyte is only sent to the
+# browser once it has been picked. get_data should return (df, dataLabelList), e.g. from the data cache.
+def register_column_picker(app, picker_id, table_id, get_data):
+    @app.callback(
+        Output(table_id, 'columns'),
+        [Input(picker_id, 'value')]
+    )
+    def update_table_columns(analytes_chosen):
+        df, dataLabelList = get_data()
+        return data_table_columns(metadata_columns(df, dataLabelList) + list(analytes_chosen or []))
+
+    return update_table_columns
+
+
+# Reduce a data frame to about maxPoints rows for plotting without changing the shape of the point cloud.
+# The plot area (the given columns) is divided into a grid of bins, and the same fraction of rows is kept
+# from every bin, with at least one row per bin so that sparse regions and outliers are still shown.
+def grid_downsample(df, columns, maxPoints, bins=50, seed=0):
+    if len(df) <= maxPoints:
+        return df
+
+    cell = np.zeros(len(df), dtype=np.int64)
+    for column in columns:
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype='<f8')
+        codes = np.full(len(df), bins, dtype=np.int64)  # Missing (or non-numeric) values get their own bin
+        valid = ~np.isnan(values)
+        if valid.any():
+            low, high = values[valid].min(), values[valid].max()
+            scale = bins / (high - low) if high > low else 0
+            codes[valid] = np.minimum(((values[valid] - low) * scale).astype(np.int64), bins - 1)
+        cell = cell * (bins + 1) + codes
+
+    cellSeries = pd.Series(cell)
+    rank = pd.Series(np.random.RandomState(seed).random_sample(len(df))).groupby(cell).rank(method='first')
+    cellCount = cellSeries.map(cellSeries.value_counts())
+    keep = (rank <= np.ceil(cellCount * maxPoints / len(df))).to_numpy()
+
+    return df[keep]
+
+
+# Use WebGL for 2D scatter plots with a lot of points (3D scatter plots always use WebGL)
+def scatter_render_mode(df):
+    return 'webgl' if len(df) > set_up_globals.scatter_webgl_threshold else 'svg'
+
+
+# Animation frames that rotate the camera of a 3D plot around the z axis, starting from the given eye
+# position. These are the same for every plot, so they are only built once.
+@functools.lru_cache(maxsize=8)
+def rotation_frames(x_eye, y_eye, z_eye):
+    frames = []
+    for t in np.arange(0, 6.26, 0.1):
+        w = (x_eye + 1j * y_eye) * np.exp(-1j * t)
+        frames.append(dict(layout=dict(scene_camera_eye=dict(x=float(np.real(w)), y=float(np.imag(w)), z=z_eye))))
+    return tuple(frames)
@@ -0,0 +1,154 @@
+# Streaming reader for Excel workbooks
+
+# pd.read_excel loads a whole workbook into memory, and has to re-open the file for every sheet.
+# WorkbookReader opens the file once (openpyxl read-only mode for .xlsx, xlrd for .xls), and reads
+# sheets row by row, returning them as data frames of at most chunk_size rows. Data frames look
+# the same as those from pd.read_excel(..., keep_default_na=False): empty cells are '', whole
+# numbers are ints, unnamed columns are called 'Unnamed: n', and duplicate names get '.1', '.2', ...
+
+# Author: Paul Munn, Genomics Innovation Hub, Cornell University
+
+
+import openpyxl
+import xlrd
+import pandas as pd
+
+
+class WorkbookReader:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.xls_format = file_name.lower().endswith('.xls')
+        if self.xls_format:
+            self._workbook = xlrd.open_workbook(file_name, on_demand=True)
+        else:
+            self._workbook = openpyxl.load_workbook(file_name, read_only=True, data_only=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.xls_format:
+            self._workbook.release_resources()
+        else:
+            self._workbook.close()
+
+    @property
+    def sheet_names(self):
+        if self.xls_format:
+            return self._workbook.sheet_names()
+        return self._workbook.sheetnames
+
+    # Column names of a sheet, without reading the rest of it
+    def read_header(self, sheet_name=0, skiprows=0):
+        if isinstance(skiprows, range):
+            skiprows = len(skiprows)
+
+        rows = self._sheet_rows(sheet_name)
+        for _ in range(skiprows or 0):
+            if next(rows, None) is None:
+                break
+
+        return column_names(next(rows, None) or [])
+
+    # Read a whole sheet into one data frame
+    def read_sheet(self, sheet_name=0, skiprows=0):
+        chunks = list(self.iter_sheet_chunks(sheet_name, skiprows))
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks)
+
+    # Yield the rows of a sheet as data frames of at most chunk_size rows. The first row after skiprows
+    # is the header. The index of each data frame carries on from the previous one, as if the whole sheet
+    # had been read at once. At least one (possibly empty) data frame is always returned.
+    def iter_sheet_chunks(self, sheet_name=0, skiprows=0, chunk_size=5000):
+        if isinstance(skiprows, range):
+            skiprows = len(skiprows)
+
+        rows = self._sheet_rows(sheet_name)
+        for _ in range(skiprows or 0):
+            if next(rows, None) is None:
+                break
+
+        headerRow = next(rows, None)
+        columns = column_names(headerRow or [])
+        columnCount = len(columns)
+
+        chunkRows = []
+        rowNumber = 0  # Row number in the data frame, to match pd.read_excel
+        for row in rows:
+            if all(value is None or value == '' for value in row):
+                continue  # Skip blank rows (their index column would be empty anyway)
+            row = [convert_value(value) for value in row[:columnCount]]
+            row += [''] * (columnCount - len(row))
+            chunkRows.append(row)
+
+            if len(chunkRows) >= chunk_size:
+                yield self._data_frame(chunkRows, columns, rowNumber)
+                rowNumber += len(chunkRows)
+                chunkRows = []
+
+        if len(chunkRows) > 0 or rowNumber == 0:
+            yield self._data_frame(chunkRows, columns, rowNumber)
+
+    def _sheet_rows(self, sheet_name):
+        if self.xls_format:
+            if isinstance(sheet_name, int):
+                sheet = self._workbook.sheet_by_index(sheet_name)
+            else:
+                sheet = self._workbook.sheet_by_name(sheet_name)
+            for i in range(sheet.nrows):
+                yield [self._xls_value(cell) for cell in sheet.row(i)]
+        else:
+            if isinstance(sheet_name, int):
+                sheet = self._workbook.worksheets[sheet_name]
+            else:
+                sheet = self._workbook[sheet_name]
+            for row in sheet.iter_rows(values_only=True):
+                yield list(row)
+
+    def _xls_value(self, cell):
+        if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+            return None
+        if cell.ctype == xlrd.XL_CELL_DATE:
+            return xlrd.xldate_as_datetime(cell.value, self._workbook.datemode)
+        if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+            return bool(cell.value)
+        return cell.value
+
+    @staticmethod
+    def _data_frame(rows, columns, start):
+        df = pd.DataFrame(rows, columns=columns, index=range(start, start + len(rows)))
+        return df.infer_objects()
+
+
+# Empty cells become '' and whole numbers become ints, as in pd.read_excel(..., keep_default_na=False)
+def convert_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+# Column names from a header row, named the way pd.read_excel names them
+def column_names(headerRow):
+    columns = []
+    nameCounts = {}
+    for i, value in enumerate(headerRow):
+        name = f'Unnamed: {i}' if value is None or value == '' else convert_value(value)
+        if name in nameCounts:
+            nameCounts[name] += 1
+            newName = f'{name}.{nameCounts[name]}'
+            while newName in nameCounts:
+                nameCounts[name] += 1
+                newName = f'{name}.{nameCounts[name]}'
+            nameCounts[newName] = 0
+            name = newName
+        else:
+            nameCounts[name] = 0
+        columns.append(name)
+
+    return columns